@@ -14,15 +14,26 @@ and open sockets in the console.
 HTTPS requests should be sent through CONNECT method.
 """
 
+import collections
+import heapq
+import itertools
 import logging
 import multiprocessing
-import select
+import queue
+import selectors
 from statistics import mode
 import sys
 import time
 
-from proxy import storage
-from proxy.logger import log, log_basic_config, logger, init_lock
+from proxy import ProxyException, storage
+from proxy.async_worker_process import AsyncWorkerProcess
+from proxy.autoscaler import Autoscaler
+from proxy.cache_sweeper import CacheSweeper
+from proxy import write_behind
+from proxy.config import Config
+from proxy.logger import LogProcess, create_log_queue, log, log_basic_config, log_directly
+from proxy.logger import log_queue_enabled, log_through_queue, logf, logger, init_lock
+from proxy.metrics import AdminServer, MetricsRegion
 import proxy.network as net
 from proxy.connection_worker_process import ConnectionWorkerProcess, ProcData
 from proxy.const import Const
@@ -33,164 +44,476 @@ def _clog(message):
     message - str
     """
     log(message, logging.WARNING)
+
+SYNC_MODE = "sync"
+ASYNC_MODE = "async"
+DISPATCHER_MODE = "dispatcher"
+REUSEPORT_MODE = "reuseport"
+# seconds the log process gets to write the rest of the queue on exit
+LOG_STOP_TIMEOUT = 5
  
 class ProxyServer:
     """Accepts incoming connections and passes them to worker processes. The latter
        are created once in a fixed number and then accepted sockets are passed to them
        through UNIX socket"""
-    def __init__(self, server_ip, port, max_processes):
+    def __init__(self, server_ip, port, max_processes, worker_mode=None):
         """
         server_ip - str, accept connections on this address
         port - int, accept on this port
         max_processes - number of processes to spawn. Those are spawned once and terminated
-            on the application exit
+            on the application exit, unless [Autoscale] is enabled: it's the initial number then
+        worker_mode - "sync": a worker process handles one client socket at a time and returns it
+            back after the request; "async": a worker process owns many client sockets, see
+            AsyncWorkerProcess; None - take it from proxy.ini
         """ 
+        if worker_mode is None:
+            worker_mode = Config.value(Const.MAIN_SECTION, "worker_mode")
+        if worker_mode not in (SYNC_MODE, ASYNC_MODE):
+            raise ProxyException("Need either sync or async worker mode")
+        self._worker_mode = worker_mode
+        self._max_processes = max_processes
+        self._max_connections = int(Config.value(Const.MAIN_SECTION, "max_connections"))
+        self._accept_mode = Config.value(Const.MAIN_SECTION, "accept_mode")
+        if self._accept_mode not in (DISPATCHER_MODE, REUSEPORT_MODE):
+            raise ProxyException("Need either dispatcher or reuseport accept mode")
         multiprocessing.set_start_method("spawn")
         log_basic_config()
         self._stdout_lock = multiprocessing.Lock()
         init_lock(self._stdout_lock)
 
-        self._server_socket = net.bound_socket(server_ip, port)
-        TCP_BACKLOG = 32
-        self._server_socket.listen(TCP_BACKLOG)
+        self._listen_address = (server_ip, port)
+        self._server_socket = None
+        if DISPATCHER_MODE == self._accept_mode:
+            self._server_socket = net.bound_socket(server_ip, port)
+            self._server_socket.listen(net.TCP_BACKLOG)
 
         #stats-related stuff 
         self._total_req = 1
         self._complete_req = 0
         self._failed_read_req = 0
+        self._dropped_writes = 0
         self._proc_avg = 0
         self._proc_avg_cnt = 1
         self._proc_vals = []
         self._start_time = None
-        self._all_open = []
+        self._all_open = set()
+        #dispatcher mode: idle keep-alive client sockets -> deadline, the heap of the deadlines
+        self._keep_alive_timeout = float(Config.value(Const.MAIN_SECTION, "keep_alive_timeout"))
+        self._idle = {}
+        self._idle_timers = []
+        self._timer_seq = itertools.count()
+        self._selector = None
         #the list of worker processes records
         self._processes = [] 
+        self._proc_seq = itertools.count()
+        #dispatcher mode: the pool size follows the load, see autoscaler
+        self._scaler = None
+        #workers told to exit or waiting for their connections to be closed before that
+        self._retiring = []
+        self._retire_timeout = float(Config.value(Const.AUTOSCALE_SECTION, "retire_timeout"))
+        #worker counters and histograms, the admin endpoint serving them, see metrics
+        self._metrics = None
+        self._admin = None
+        self._sweeper = None
+        #write-behind queue and the cache writer processes
+        self._write_queue = None
+        self._writers = []
+        #the log process and its queue, see logger
+        self._log_queue = None
+        self._log_process = None
+        self._status_interval = float(Config.value(Const.LOGGING_SECTION, "status_interval"))
+        self._status_time = 0
+
+    def _process_if_done(self, proc_data, free):
+        """A worker process reported it's done with some FD. The latter is either being closed
+        or watched by the selector for later read. The worker goes back to the free queue
+
+        proc_data - ProcessData
+        free - deque of ProcessData
+        """
+        try:
+            proc_data.ipc_socket_parent.recv(net.IPC_BUF)
+        except OSError as errv:
+            _clog("\nIPC read failed %s " % str(errv))
+            return
+        if not proc_data.client_sock:
+            return
+        if ProcData.DONE_OPEN == proc_data.status.value:
+            logf("B-%i-%s", proc_data.client_sock.fileno(), proc_data.process_name)
+            self._watch_idle(proc_data.client_sock)
+        elif ProcData.DONE_CLOSE == proc_data.status.value:
+            logf("Cl-%i-%s ", proc_data.client_sock.fileno(), proc_data.process_name)
+            #done with the socket in both parent and child processes
+            self._close_client(proc_data.client_sock)
+        else:
+            return
+        proc_data.status.value = ProcData.READY
+        proc_data.client_sock = None
+        free.append(proc_data)
+
+    def _watch_idle(self, sock):
+        """Wait for the next request on a keep-alive socket, until keep_alive_timeout expires
+
+        sock - client socket
+        """
+        deadline = time.time() + self._keep_alive_timeout
+        self._idle[sock] = deadline
+        heapq.heappush(self._idle_timers, (deadline, next(self._timer_seq), sock))
+        self._selector.register(sock, selectors.EVENT_READ)
 
+    def _unwatch_idle(self, sock):
+        """Stop waiting on the socket. The timer entry is left in the heap and skipped later
 
-    def _process_if_done(self, proc_data, input_sockets):
-       """After a worker process id done with some FD the latter is either being closed or returned
-       back to select() for later read
-      
-       proc_data - ProcessData
-       input_sockets - socket list
-       """
-       if proc_data.client_sock:
-            if ProcData.DONE_OPEN == proc_data.status.value:
-                self._count_req(proc_data)
-                input_sockets.append(proc_data.client_sock)
-                log("B-%i-%s" % (proc_data.client_sock.fileno(), proc_data.process_name))
-                proc_data.status.value = ProcData.READY
-                proc_data.client_sock = None
-            if ProcData.DONE_CLOSE == proc_data.status.value:
-                self._count_req(proc_data)
-#done with the socket in both parent and child processes
-                net.shutdown(proc_data.client_sock)
-                self._all_open.remove(proc_data.client_sock)
-                log("Cl-%i-%s " % (proc_data.client_sock.fileno(), proc_data.process_name))
-                proc_data.client_sock.close()
-                proc_data.status.value = ProcData.READY
-                proc_data.client_sock = None
+        sock - client socket
+        """
+        self._selector.unregister(sock)
+        del self._idle[sock]
+
+    def _expire_idle(self):
+        """Close keep-alive sockets idle for longer than keep_alive_timeout"""
+        now = time.time()
+        while self._idle_timers and self._idle_timers[0][0] <= now:
+            deadline, _, sock = heapq.heappop(self._idle_timers)
+            if deadline == self._idle.get(sock):
+                self._unwatch_idle(sock)
+                logf("E-%i ", sock.fileno())
+                self._close_client(sock)
+
+    def _close_client(self, sock):
+        """sock - client socket, the parent copy of which is not needed any more"""
+        net.shutdown(sock)
+        self._all_open.discard(sock)
+
+    def _start_process(self, proc_data, name):
+        """Spawn a worker process. In the reuseport mode the worker gets the address to listen
+        on, otherwise the IPC socket to receive client sockets from
+
+        proc_data - ProcessData, shared with the new process
+        name - str, process name
+        """
+        worker_class = AsyncWorkerProcess if ASYNC_MODE == self._worker_mode else ConnectionWorkerProcess
+        if REUSEPORT_MODE == self._accept_mode:
+            args = (proc_data, None, self._stdout_lock, self._listen_address)
+        else:
+            ipc_socket_parent, ipc_socket_child = net.ipc_socket_pair()
+            proc_data.ipc_socket_parent = ipc_socket_parent
+            args = (proc_data, ipc_socket_child, self._stdout_lock)
+        new_proc = multiprocessing.Process(group=None, target=worker_class(), name=name, args=args,
+                                           kwargs={"write_queue": self._write_queue,
+                                                   "log_queue": self._log_queue})
+        proc_data.process_name = new_proc.name
+        proc_data.process = new_proc
+        new_proc.start()
+
+    def _new_worker(self):
+        """Start one more worker process
+
+        return - ProcessData, used to get statistics and monitor/change state of the process
+        """
+        proc_data = ProcData()
+        proc_data.metrics = self._metrics.allocate()
+        self._processes.append(proc_data)
+        self._start_process(proc_data, "p%i" % next(self._proc_seq))
+        return proc_data
 
     def main_loop(self):
         """Loops infinitely to handle application events until KeyboardInterrupted"""
 
-        input_sockets = [self._server_socket]
-        active_proc_num = 0
+        if log_queue_enabled():
+            self._log_queue = create_log_queue(multiprocessing)
+            self._log_process = multiprocessing.Process(target=LogProcess(), name="logger",
+                                                        args=(self._log_queue,))
+            self._log_process.start()
+            log_through_queue(self._log_queue)
 
+        storage.init_shared()
         # init database, if DB storage is chosen
         storage.get_storage()
 
+        if write_behind.enabled():
+            self._write_queue = write_behind.create_queue(multiprocessing)
+            for number in range(int(Config.value(Const.WRITE_BEHIND_SECTION, "writers"))):
+                writer = multiprocessing.Process(target=write_behind.CacheWriter(),
+                    name="writer%i" % number,
+                    args=(self._write_queue, self._stdout_lock, self._log_queue))
+                writer.start()
+                self._writers.append(writer)
+
+        process_number = self._max_processes
+        if DISPATCHER_MODE == self._accept_mode:
+            self._scaler = Autoscaler.from_config()
+            if self._scaler:
+                process_number = self._scaler.clamp(process_number)
+        #the retiring workers keep their slots until they exit
+        self._metrics = MetricsRegion(2 * self._scaler.max_workers if self._scaler else process_number)
+        self._admin = AdminServer.from_config(self._metrics, self._gauges)
         #create child processes
-        for _ in range(max_proc):
-            ipc_socket_parent, ipc_socket_child = net.ipc_socket_pair()
-            #this is used to get statistics and monitor/change state of child process
-            new_data = ProcData()
-            new_proc = multiprocessing.Process(group=None, target=ConnectionWorkerProcess(), name="p%i" % _, 
-                args=(new_data,ipc_socket_child,self._stdout_lock))
-            new_data.process_name = new_proc.name
-            new_data.ipc_socket_parent = ipc_socket_parent
-            new_data.process = new_proc
-            self._processes.append(new_data)
-            new_proc.start()
+        for _ in range(process_number):
+            self._new_worker()
+
+        if CacheSweeper.enabled():
+            self._sweeper = multiprocessing.Process(target=CacheSweeper(), name="sweeper",
+                                                    args=(self._stdout_lock, self._log_queue))
+            self._sweeper.start()
+
+        if REUSEPORT_MODE == self._accept_mode:
+            self._supervise_loop()
+        else:
+            self._dispatch_loop()
+
+    def _supervise_loop(self):
+        """Reuseport mode: workers accept and serve clients themselves, only restart the ones
+        which died and collect statistics"""
+        SLEEP_PERIOD = 1
+
+        selector = selectors.DefaultSelector()
+        if self._admin:
+            selector.register(self._admin.socket, selectors.EVENT_READ)
+
+        while 1:
+            #sleeps if there is no admin endpoint
+            if selector.select(SLEEP_PERIOD):
+                self._admin.accept_all()
+            self._collect_stats()
+            for proc_data in self._processes:
+                if not proc_data.process.is_alive():
+                    _clog("\nRestarting %s " % proc_data.process_name)
+                    proc_data.status.value = ProcData.READY
+                    proc_data.connections.value = 0
+                    self._start_process(proc_data, proc_data.process_name)
+
+            if None == self._start_time and self._total_req > 1:
+                self._start_time = time.time()
+            active_proc_num = self._active_proc_num()
+            if active_proc_num:
+                self._proc_avg += active_proc_num
+                self._proc_avg_cnt += 1
+                self._proc_vals.append(active_proc_num)
 
+            if self._status_due():
+                _clog("\nReqs:%i ActiveProc:%i Dropped:%i " % (self._complete_req, active_proc_num,
+                    self._dropped_writes))
+
+    def _busy_workers(self):
+        """return - float, the occupancy of the pool in workers; async workers count in
+            max_connections units
+        """
+        if ASYNC_MODE == self._worker_mode:
+            return (sum(proc_data.connections.value for proc_data in self._processes)
+                    / self._max_connections)
+        return self._active_proc_num()
+
+    def _autoscale(self, free, ready):
+        """Grow or shrink the worker pool following its occupancy, see autoscaler
+
+        free - deque of ProcessData, sync workers ready to get a socket
+        ready - deque of sockets waiting for a worker
+        """
+        step = self._scaler.sample(self._busy_workers(), len(ready), len(self._processes),
+                                   time.time())
+        for _ in range(min(step, self._metrics.free_slots())):
+            proc_data = self._new_worker()
+            self._selector.register(proc_data.ipc_socket_parent, selectors.EVENT_READ, proc_data)
+            if SYNC_MODE == self._worker_mode:
+                free.append(proc_data)
+            _clog("\nStarted %s " % proc_data.process_name)
+        if step < 0:
+            self._retire_worker(free)
+        self._reap_retired()
+
+    def _retire_worker(self, free):
+        """Take a worker out of the pool: an idle sync one, or the async one having the fewest
+        connections, which gets no new ones and exits when the last one is closed
+
+        free - deque of ProcessData, sync workers ready to get a socket
+        """
+        if SYNC_MODE == self._worker_mode:
+            if not free:
+                return
+            #idle for the longest time
+            proc_data = free.popleft()
+        else:
+            proc_data = min(self._processes, key=lambda data: data.connections.value)
+        self._processes.remove(proc_data)
+        self._selector.unregister(proc_data.ipc_socket_parent)
+        self._retiring.append(proc_data)
+        _clog("\nRetiring %s " % proc_data.process_name)
+
+    def _reap_retired(self):
+        """Tell the retired workers with no connections left to exit; terminate the ones which
+        haven't done it in retire_timeout"""
+        now = time.time()
+        for proc_data in list(self._retiring):
+            if proc_data.retire_time is None:
+                if proc_data.connections.value:
+                    continue
+                net.retire_through_socket(proc_data.ipc_socket_parent)
+                proc_data.retire_time = now
+            if proc_data.process.is_alive():
+                if now - proc_data.retire_time < self._retire_timeout:
+                    continue
+                _clog("\nTerminating %s " % proc_data.process_name)
+                proc_data.process.terminate()
+            proc_data.process.join()
+            proc_data.ipc_socket_parent.close()
+            self._metrics.release(proc_data.metrics)
+            self._retiring.remove(proc_data)
+
+    def _active_proc_num(self):
+        """return - int, the number of processes serving clients at the moment"""
+        if ASYNC_MODE == self._worker_mode:
+            return len([1 for proc_data in self._processes if proc_data.connections.value])
+        return len([1 for proc_data in self._processes if ProcData.ACTIVE == proc_data.status.value])
+
+    def _dispatch_loop(self):
+        """Dispatcher mode: accept clients and pass the sockets having data to worker processes.
+        The selector reports new clients, data on idle keep-alive sockets and workers being done
+        with their sockets, so nothing is polled"""
         SLEEP_PERIOD = 1
 
-        self._all_open = [self._server_socket,]
-        ready = []
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._server_socket, selectors.EVENT_READ)
+        if self._admin:
+            self._selector.register(self._admin.socket, selectors.EVENT_READ)
+        #workers ready to get a socket, the one done first is the first to get the next socket
+        free = collections.deque()
+        for proc_data in self._processes:
+            self._selector.register(proc_data.ipc_socket_parent, selectors.EVENT_READ, proc_data)
+            free.append(proc_data)
+
+        self._all_open = {self._server_socket}
+        ready = collections.deque()
 
         while 1:
+            timeout = SLEEP_PERIOD
+            if self._idle_timers:
+                timeout = max(0, min(timeout, self._idle_timers[0][0] - time.time()))
             #will block here if no new sockets
-            inputs, outputs, failed = select.select(input_sockets, [], input_sockets, SLEEP_PERIOD)
+            events = self._selector.select(timeout)
             changes = False
 
-            for sock in inputs:
+            for key, mask in events:
+                sock = key.fileobj
                 if self._server_socket == sock:
-                    connection, addr = self._server_socket.accept()
-                    #those needed to be passed back to select at the end of the iteration
-                    input_sockets.append(connection)
-                    #this is just to monitor the list of FDs in charge
-                    self._all_open.append(connection)
-
+                    self._accept_all(ready)
+                elif self._admin and self._admin.socket == sock:
+                    self._admin.accept_all()
+                elif key.data is not None:
+                    self._process_if_done(key.data, free)
                 else:
+                    self._unwatch_idle(sock)
+                    if net.peer_closed(sock):
+                        #closed by client while idle, no need to bother a worker
+                        logf("Cl-%i ", sock.fileno())
+                        self._close_client(sock)
+                        continue
                     if None == self._start_time:
                         self._start_time = time.time()
                     #those ready to read go to ready list immediately
                     ready.append(sock)
-                    input_sockets.remove(sock)
                     changes = True
 
-            for sock in ready.copy():                
-                    assigned = False
-                    for proc_data in self._processes:
-                        if ProcData.READY == proc_data.status.value:
-                            #assign to processes if there are available non-busy ones 
-                            ready.remove(sock)
-                            proc_data.client_sock = sock
-                            log("A-%i-%s " % (sock.fileno(), proc_data.process_name))
-                            proc_data.status.value = ProcData.ACTIVE
-                            #this is the only way you can pass an open socket to already running process
-                            net.fd_through_socket(proc_data.ipc_socket_parent, sock.fileno())
-                            assigned = True
-                            break
-            for sock in input_sockets.copy():
-                if not sock == self._server_socket and not net.is_connected(sock):
-                #they tend to shut down eventually so cleanup needed
-                    input_sockets.remove(sock)
-                    sock.close()
-                    self._all_open.remove(sock)
-
-            for sock in failed:
-                #this surprisingly never happenens, dont know why?
-                log("F-%i " % sock.fileno())
-                sock.close()
-                input_sockets.remove(sock)
-
-            for proc_data in self._processes:
-                self._process_if_done(proc_data, input_sockets)
-       
-            active_proc_num = len([1 for proc_data in self._processes if ProcData.ACTIVE == proc_data.status.value])
+            if ASYNC_MODE == self._worker_mode:
+                self._assign_async(ready)
+                changes = changes or bool(events)
+            else:
+                #assign to processes if there are available non-busy ones
+                while ready and free:
+                    sock = ready.popleft()
+                    proc_data = free.popleft()
+                    proc_data.client_sock = sock
+                    logf("A-%i-%s ", sock.fileno(), proc_data.process_name)
+                    proc_data.status.value = ProcData.ACTIVE
+                    #this is the only way you can pass an open socket to already running process
+                    net.fd_through_socket(proc_data.ipc_socket_parent, sock.fileno())
+
+            self._expire_idle()
+            if self._scaler:
+                self._autoscale(free, ready)
+            self._collect_stats()
+
+            active_proc_num = self._active_proc_num()
             #statistics of active processes, can actually be done at different places
             if changes:
                 self._proc_avg += active_proc_num
                 self._proc_avg_cnt += 1
                 self._proc_vals.append(active_proc_num)
 
-            _clog(".")            
-            _clog("\nReqs:%i ActiveProc:%i %i " % (self._complete_req, active_proc_num,  len(self._all_open)) 
-                + str([s.fileno() for s in input_sockets])
-                + str([s.fileno() for s in ready] ))
+            if self._status_due():
+                _clog("\nReqs:%i ActiveProc:%i/%i %i Idle:%i Ready:%i Dropped:%i " % (
+                    self._complete_req, active_proc_num, len(self._processes), len(self._all_open),
+                    len(self._idle), len(ready), self._dropped_writes))
 
-    def _count_req(self, proc_data):
-        """Pick up the statistics from process going inactive
-        
-        proc_data - ProcessData
+    def _status_due(self):
+        """return - bool, status_interval has passed since the last status line was shown"""
+        now = time.time()
+        if now - self._status_time < self._status_interval:
+            return False
+        self._status_time = now
+        return True
+
+    def _accept_all(self, ready):
+        """Accept all the pending connections. Sockets for sync workers are watched until the
+        request data comes, async workers get them at once
+
+        ready - deque of sockets waiting for a worker
+        """
+        while 1:
+            try:
+                connection, addr = self._server_socket.accept()
+            except BlockingIOError:
+                return
+            #this is just to monitor the list of FDs in charge
+            self._all_open.add(connection)
+            if ASYNC_MODE == self._worker_mode:
+                #async workers read the socket themselves, pass it at once
+                if None == self._start_time:
+                    self._start_time = time.time()
+                ready.append(connection)
+            else:
+                self._watch_idle(connection)
+
+    def _assign_async(self, ready):
+        """Pass accepted sockets to the least loaded async workers. The socket is owned by the
+        worker afterwards, so the parent copy is closed. Sockets stay in ready while all the
+        workers have max_connections
+
+        ready - deque of sockets
         """
-        self._total_req += proc_data.session_req.value
-        self._complete_req += proc_data.complete_req.value
-        self._failed_read_req += proc_data.failed_read_req.value
-        proc_data.session_req.value = 0
-        proc_data.complete_req.value = 0
-        proc_data.failed_read_req.value = 0
+        while ready:
+            proc_data = min(self._processes, key=lambda data: data.connections.value)
+            if proc_data.connections.value >= self._max_connections:
+                break
+            sock = ready.popleft()
+            with proc_data.connections.get_lock():
+                proc_data.connections.value += 1
+            logf("A-%i-%s ", sock.fileno(), proc_data.process_name)
+            net.fd_through_socket(proc_data.ipc_socket_parent, sock.fileno())
+            self._all_open.discard(sock)
+            sock.close()
+
+    def _collect_stats(self):
+        """Sum the console statistics up from the worker metrics slots"""
+        self._total_req = 1 + self._metrics.total("requests")
+        self._complete_req = self._metrics.total("complete")
+        self._failed_read_req = self._metrics.total("failed_reads")
+        self._dropped_writes = self._metrics.total("dropped_writes")
+
+    def _gauges(self):
+        """return - list of (name, help, value), the main process state for the admin endpoint"""
+        return [("workers", "Worker processes in the pool", len(self._processes)),
+                ("active_workers", "Worker processes serving clients", self._active_proc_num()),
+                ("retiring_workers", "Worker processes leaving the pool", len(self._retiring)),
+                ("idle_connections", "Keep-alive client connections waiting for a request",
+                 len(self._idle)),
+                ("dns_hit_rate", "Part of the host name lookups answered from the resolver cache",
+                 self._dns_hit_rate())]
+
+    def _dns_hit_rate(self):
+        """return - float, the resolver cache hit rate of all the workers"""
+        hits = self._metrics.total("dns_hits")
+        lookups = hits + self._metrics.total("dns_misses")
+        return hits / lookups if lookups else 0.0
 
     def __enter__(self):
         return self
@@ -202,15 +525,19 @@ class ProxyServer:
         exc_value -
         tracebak - 
         """
+        if self._metrics:
+            self._collect_stats()
         if self._start_time is not None:
            elapsed = time.time() - self._start_time 
            _clog("\n\nElapsed: %f Average a.proc count: %f Success: %f Complete: %i Total: %i FailedRead: %i "
+               "DroppedWrites: %i "
                % (elapsed, 
                   self._proc_avg / self._proc_avg_cnt,
                   self._complete_req / self._total_req,
                   self._complete_req,
                   self._total_req,
-                  self._failed_read_req))
+                  self._failed_read_req,
+                  self._dropped_writes))
            _clog("A.proc count mode: %f" % mode(self._proc_vals))
 
         self._stop_all()
@@ -221,22 +548,41 @@ class ProxyServer:
 
     def _stop_all(self):            
         """Stop all child processes"""
-        pids = [proc_data.process.pid for proc_data in self._processes]
+        workers = self._processes + self._retiring
+        pids = [proc_data.process.pid for proc_data in workers]
         _clog("Stopping processes {}".format(pids))
-        for proc_data in self._processes:
+        for proc_data in workers:
             """They don't have children - OK to terminate"""
             proc_data.process.terminate()
+        if self._sweeper:
+            self._sweeper.terminate()
+        for writer in self._writers:
+            writer.terminate()
+        if self._log_process:
+            self._stop_logging()
+
+    def _stop_logging(self):
+        """Let the log process write what has been queued and exit, log from here afterwards"""
+        try:
+            self._log_queue.put_nowait(None)
+            self._log_process.join(LOG_STOP_TIMEOUT)
+        except queue.Full:
+            pass
+        if self._log_process.is_alive():
+            self._log_process.terminate()
+        log_directly()
 
 
 
 if __name__ == "__main__":
     if len(sys.argv) < 4:
-            _clog('Usage : "python ProxyServer.py server_ip server_port max_process_number"\n')
+            _clog('Usage : "python ProxyServer.py server_ip server_port max_process_number [sync|async]"\n')
             sys.exit(2)
     
     max_proc = int(sys.argv[3])
+    worker_mode = sys.argv[4] if len(sys.argv) > 4 else None
     _clog("Max processes: %i" % max_proc)
 
-    with ProxyServer(sys.argv[1], int(sys.argv[2]), max_proc) as proxy:
+    with ProxyServer(sys.argv[1], int(sys.argv[2]), max_proc, worker_mode) as proxy:
         proxy.main_loop()
 
@@ -0,0 +1,740 @@
+"""
+Updated: 2017
+Author: Sergei Shliakhtin
+Contact: xxx.serj@gmail.com
+Notes: Worker process multiplexing many client connections on an asyncio event loop
+
+Client sockets are passed from the main process the same way as for ConnectionWorkerProcess,
+but they are never returned back: the worker keeps a connection until the client closes it
+or it stays idle longer than keep_alive_timeout.
+
+The storage calls block on the disk or the database, so they run in a storage thread of the
+worker instead of the event loop: a slow one holds up the clients waiting for the cache only.
+It's one thread, the index and the hot cache are locked with flock, which doesn't exclude the
+threads of one process sharing a file.
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import socket
+import time
+
+from proxy.config import Config
+from proxy.const import Const
+from proxy import compression, freshness
+from proxy.freshness import CachePolicy
+import proxy.http_response as Response
+from proxy.logger import proc_error, proc_state
+import proxy.logger
+from proxy.http_parser import HttpParser
+from proxy.message_reader import set_keep_alive
+import proxy.network as net
+from proxy.pipeline import PipelinePrefetcher
+from proxy.request_handling import RequestHandling
+from proxy import request_handling
+from proxy.request_reader import RequestReader
+from proxy.resolver import get_resolver
+from proxy.response_reader import ResponseReader, ResponseRelay
+from proxy import tracing
+from proxy.tracing import RequestTrace
+
+BUF_SIZE = 4096
+# Seconds to wait for the origin server to connect and to respond
+ORIGIN_TIMEOUT = 20
+
+class AsyncWorkerProcess(RequestHandling):
+    """Handles one process. Get an IPC socket initially which is then used to retrieve
+    client sockets. Each client socket is served by its own coroutine
+    """
+    def __init__(self):
+        """Should be called from parent process"""
+        self.is_init = False
+
+    def _init_this_process(self, process_data, write_queue=None, log_queue=None):
+        """Initialize process variables and determined storage type configured.
+        Should be called in child process
+
+        process_data - ProcessData associated with this process
+        write_queue - multiprocessing.Queue of the cache writer processes or None
+        log_queue - multiprocessing.Queue of the log process or None
+        """
+        assert not self.is_init
+        self.is_init = True
+        self._init_handling(process_data, write_queue, log_queue)
+        self._keep_alive_timeout = float(Config.value(Const.MAIN_SECTION, "keep_alive_timeout"))
+        self._max_ahead = PipelinePrefetcher.max_ahead_from_config()
+        self._loop = None
+        self._storage_thread = None
+
+        if self._use_cache:
+            self._storage_thread = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+                thread_name_prefix="storage")
+
+    def __call__(self, process_data, ipc_socket, stdout_lock, listen_address=None,
+                 write_queue=None, log_queue=None):
+        """Run the event loop of this process. Terminate on SIGINT.
+
+        process_data - ProcessData associated with this process
+        ipc_socket - unix socket to suck FDs from
+        stdout_lock - limit access to STDOUT
+        listen_address - (ip, port), if given accept clients directly on own SO_REUSEPORT
+            listener instead of waiting for them on ipc_socket
+        write_queue - multiprocessing.Queue to hand the cache saves over to the writer
+            processes, None to save them in this process
+        log_queue - multiprocessing.Queue of the log process, None to write the log directly
+        """
+        self._init_this_process(process_data, write_queue, log_queue)
+        proxy.logger.init_lock(stdout_lock)
+
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        if listen_address:
+            listener = net.bound_socket(*listen_address, reuse_port=True)
+            listener.listen(net.TCP_BACKLOG)
+            self._loop.add_reader(listener.fileno(), self._on_accept, listener)
+        else:
+            ipc_socket.setblocking(0)
+            self._loop.add_reader(ipc_socket.fileno(), self._on_ipc_readable, ipc_socket)
+        try:
+            proc_state("Wait fd")
+            self._loop.run_forever()
+        except KeyboardInterrupt:
+            proc_state(get_resolver().summary())
+            return
+
+    def _on_ipc_readable(self, ipc_socket):
+        """Pick up a client socket passed by the main process and start serving it
+
+        ipc_socket - unix socket to suck FDs from
+        """
+        fd = net.fd_from_socket(ipc_socket)
+        if net.RETIRE == fd:
+            #the main process shrinks the pool, it's retired only with no connections left
+            proc_state("Retired")
+            self._loop.remove_reader(ipc_socket.fileno())
+            self._loop.stop()
+            return
+        if fd is None:
+            return
+        proc_state("Got fd")
+        client_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, fileno=fd)
+        client_sock.setblocking(0)
+        self._loop.create_task(self._serve_client(client_sock))
+
+    def _on_accept(self, listener):
+        """Accept a client socket on own listener and start serving it
+
+        listener - non-blocking listening socket
+        """
+        try:
+            client_sock, addr = listener.accept()
+        except BlockingIOError:
+            return
+        proc_state("Accepted")
+        self._count(self._proc_data.connections)
+        client_sock.setblocking(0)
+        self._loop.create_task(self._serve_client(client_sock))
+
+    def _log_tag(self):
+        """Tell the async worker records apart"""
+        return "A:"
+
+    async def _read_message(self, sock, buffered, timeout, arrival=None):
+        """Read from the socket until the parser gets one complete message
+
+        sock - non-blocking socket
+        buffered - bytes already read from this socket
+        timeout - seconds to wait for every next piece of data
+        arrival - list, gets time.monotonic() the first data has been read at, if given
+        return - HttpParser, done if the message is complete
+        """
+        parser = HttpParser()
+        parser.feed(buffered)
+        if arrival is not None and buffered:
+            arrival.append(time.monotonic())
+        buf = bytearray(BUF_SIZE)
+        while not parser.done and not parser.error:
+            try:
+                size = await asyncio.wait_for(self._loop.sock_recv_into(sock, buf), timeout)
+            except asyncio.TimeoutError:
+                break
+            except OSError as errv:
+                proc_error("Message read failed (3) %s " % str(errv))
+                break
+            # empty chunk means peer shutted down
+            if not size:
+                break
+            if arrival is not None and not arrival:
+                arrival.append(time.monotonic())
+            parser.feed(memoryview(buf)[:size])
+        return parser
+
+    async def _in_executor(self, func, *args):
+        """Run a blocking storage call in the storage thread
+
+        return - what func returns
+        """
+        return await self._loop.run_in_executor(self._storage_thread, functools.partial(func, *args))
+
+    async def _send_all(self, sock, data):
+        """Async counterpart of net.send_all
+
+        return - bool, True on success
+        """
+        try:
+            await self._loop.sock_sendall(sock, data)
+            return True
+        except OSError as errv:
+            proc_error("Sending failed: %s" % str(errv))
+            return False
+
+    async def _serve_client(self, client_sock):
+        """Handle requests from one client until it closes the connection, an error occurs
+        or it stays idle for too long
+
+        client_sock - non-blocking socket
+        """
+        buffered = b""
+        prefetcher = None
+        if self._max_ahead:
+            prefetcher = PipelinePrefetcher(self._spawn_fetch, self._max_ahead, self._flights)
+        try:
+            while 1:
+                proc_state("Readclient")
+                arrival = []
+                parser = await self._read_message(client_sock, buffered, self._keep_alive_timeout,
+                                                  arrival)
+                if not parser.buffer:
+                    #idle connection closed or timed out
+                    break
+                request = RequestReader(None, parser=parser)
+                request.trace = RequestTrace(arrival[0])
+                request.trace.add(tracing.CLIENT_READ, request.received - arrival[0])
+                buffered = request.tail
+                if not request.ok:
+                    await self._send_all(client_sock, self._bad_request())
+                    break
+                self._metrics.count("requests")
+
+                if RequestReader.GET == request.method:
+                    prefetched, flight = None, None
+                    if prefetcher:
+                        prefetched, flight = prefetcher.take(request)
+                        await self._fetch_ahead(client_sock, request, prefetcher)
+                        buffered = request.tail
+                    client_ok = await self._do_GET(client_sock, request, prefetched, flight)
+                    self._finish_trace(request)
+                    if not client_ok:
+                        break
+                elif RequestReader.CONNECT == request.method:
+                    await self._do_CONNECT(client_sock, request)
+                    break
+                else:
+                    await self._send_all(client_sock, self._unsupported(request))
+                    break
+        finally:
+            if prefetcher:
+                prefetcher.clear()
+            net.shutdown(client_sock)
+            self._count(self._proc_data.connections, -1)
+
+    async def _fetch_ahead(self, client_sock, request, prefetcher):
+        """Read what else the client has pipelined after the request and start fetching the
+        complete requests which aren't cached
+
+        request - RequestReader, its tail gets the data read
+        prefetcher - PipelinePrefetcher of this client
+        """
+        for ahead in self._pipelined(client_sock, request):
+            if self._use_cache and self._storage:
+                state = await self._in_executor(self._policy.lookup, ahead.cache_location,
+                                                ahead.header)
+                if CachePolicy.MISS != state:
+                    continue
+            prefetcher.start(ahead)
+
+    def _spawn_fetch(self, host, request_message):
+        """return - asyncio.Task of the fetch ahead, see pipeline"""
+        return self._loop.create_task(self._fetch(host, request_message))
+
+    async def _fetch(self, host, request_message):
+        """Async counterpart of pipeline.fetch
+
+        return - ResponseReader or None on failure
+        """
+        origin_srv = await self._connected_socket(host)
+        if not origin_srv:
+            return None
+        try:
+            if not await self._send_all(origin_srv, request_message):
+                return None
+            parser = await self._read_message(origin_srv, b"", ORIGIN_TIMEOUT)
+            return ResponseReader(None, parser=parser)
+        finally:
+            origin_srv.close()
+
+    def _count(self, value, delta=1):
+        """Update one of the shared ProcData counters
+
+        value - multiprocessing.Value
+        """
+        with value.get_lock():
+            value.value += delta
+
+    async def _do_GET(self, client_sock, request, prefetched=None, flight=None):
+        """Serve the request from cache or pass it to the origin server, then pass the response
+        back to client and cache it, if needed
+
+        client_sock - non-blocking socket
+        request - RequestReader
+        prefetched - asyncio.Task of the origin response fetched ahead or None, see pipeline
+        flight - Flight led since the fetch ahead or None, released here
+        return - bool, True if the client connection can be used further
+        """
+        state = None
+        if self._use_cache and self._storage:
+            with request.trace.phase(tracing.CACHE_LOOKUP):
+                state = await self._in_executor(self._policy.lookup, request.cache_location,
+                                                request.header)
+            if self._needs_flight(state, flight):
+                flight, state = await self._join_flight(request.cache_location, request.header)
+        try:
+            return await self._serve_GET(client_sock, request, state, prefetched)
+        finally:
+            if flight:
+                #let the processes waiting for the resource go on
+                flight.release()
+
+    async def _join_flight(self, cache_location, request_header):
+        """Lead the fetch of the resource or wait for the process which leads it
+
+        return - (Flight to be released once the response is saved or None,
+            CachePolicy state of the resource after that)
+        """
+        flight = self._flights.join(cache_location)
+        if not flight.leader:
+            proc_state("Waitflight")
+            deadline = time.time() + self._flights.wait_timeout
+            while not flight.landed():
+                if time.time() > deadline:
+                    flight.release()
+                    #fetch it independently
+                    self._log_code("FW", "Collapsed forwarding wait timeout")
+                    break
+                await asyncio.sleep(self._flights.poll_interval)
+            return None, await self._in_executor(self._policy.lookup, cache_location, request_header)
+        state = await self._in_executor(self._policy.lookup, cache_location, request_header)
+        return self._lead_flight(flight, state), state
+
+    async def _serve_GET(self, client_sock, request, state, prefetched=None):
+        """Serve the request from cache or pass it to the origin server
+
+        client_sock - non-blocking socket
+        request - RequestReader
+        state - CachePolicy state of the resource, None if the cache is off
+        prefetched - asyncio.Task of the origin response fetched ahead or None
+        return - bool, True if the client connection can be used further
+        """
+        request_message = self._origin_request(request)
+
+        cache_location = request.cache_location
+        trace = request.trace
+        if state is not None:
+            cached = None
+            if CachePolicy.STALE_REVALIDATE == state:
+                #serve the stale copy at once, the origin server is asked meanwhile
+                with trace.phase(tracing.CACHE_LOOKUP):
+                    cached = await self._in_executor(self._storage.fetch, cache_location)
+                if self._refresh_behind(request, cached):
+                    state = CachePolicy.FRESH
+            if CachePolicy.FRESH == state:
+                sent = await self._send_cached(client_sock, request, cached)
+                if sent is None:
+                    #removed meanwhile or read error, get it from the origin server
+                    self._log_code("CE", "Cached resource unavailable")
+                    return await self._forward(client_sock, request, request_message,
+                                               prefetched=prefetched)
+                return self._cache_sent(request, sent, "C" if cached is None else "CW",
+                                        "Sent from cache")
+            elif state in (CachePolicy.STALE_IF_ERROR, CachePolicy.STALE):
+                with trace.phase(tracing.CACHE_LOOKUP):
+                    cached = await self._in_executor(self._storage.fetch, cache_location)
+                revalidation = self._revalidation(request_message, cached, state)
+                if revalidation:
+                    conditional, stale_if_error = revalidation
+                    return await self._forward(client_sock, request, conditional, cached=cached,
+                                               stale_if_error=stale_if_error)
+
+        return await self._forward(client_sock, request, request_message, prefetched=prefetched)
+
+    async def _send_cached(self, client_sock, request, cached=None):
+        """Send the cached resource to client, with sendfile if the storage keeps it in a file
+
+        request - RequestReader
+        cached - bytes, the resource if it has been fetched already
+        return - bool, True if sent; None if the resource can't be read
+        """
+        trace = request.trace
+        if cached is None:
+            opened = None
+            if not freshness.is_conditional(request.header):
+                with trace.phase(tracing.CACHE_LOOKUP):
+                    opened = await self._in_executor(self._open_cached, request.cache_location,
+                                                     not compression.accepts_gzip(request.header))
+            if opened:
+                trace.status = Const.HTTP_OK
+                with trace.phase(tracing.CLIENT_SEND):
+                    return self._count_sent(request, await self._send_file(client_sock, opened),
+                                            len(Response.STATUS_200) + opened[2])
+            with trace.phase(tracing.CACHE_LOOKUP):
+                cached = await self._in_executor(self._storage.fetch, request.cache_location)
+            if not cached:
+                return None
+        response = self._cached_response(request, cached)
+        if response is None:
+            return None
+        with trace.phase(tracing.CLIENT_SEND):
+            return self._count_sent(request, await self._send_all(client_sock, response), len(response))
+
+    async def _send_file(self, client_sock, opened):
+        """opened - (file object, offset, size) as returned by fetch_file(), closed when sent
+        return - bool, True if sent
+        """
+        cache_file, offset, size = opened
+        try:
+            await self._loop.sock_sendall(client_sock, Response.STATUS_200)
+            await self._loop.sock_sendfile(client_sock, cache_file, offset, size)
+            return True
+        except OSError as errv:
+            proc_error("Sending failed: %s" % str(errv))
+            return False
+        finally:
+            cache_file.close()
+
+    async def _send_to_origin(self, host, request_message, reuse):
+        """Send the request over a pooled connection to the origin server or a new one
+
+        host - bytes, "host[:port]"
+        request_message - bytes
+        reuse - bool, try a pooled connection first
+        return - (socket or None on failure, bool - the connection is a pooled one)
+        """
+        if self._pool and reuse:
+            origin_srv = self._pool.get(host)
+            if origin_srv:
+                if await self._send_all(origin_srv, request_message):
+                    return origin_srv, True
+                self._pool.put(host, origin_srv, False)
+
+        origin_srv = await self._connected_socket(host)
+        if not origin_srv:
+            return None, False
+        if self._pool:
+            self._pool.opened(host)
+        if not await self._send_all(origin_srv, request_message):
+            self._release_origin(host, origin_srv, False)
+            return None, False
+        return origin_srv, False
+
+    async def _forward(self, client_sock, request, request_message, reuse=True, cached=None,
+                       stale_if_error=False, prefetched=None):
+        """Pass the request to the origin server and the response back to client. Cache it, if needed
+
+        client_sock - non-blocking socket
+        request - RequestReader
+        request_message - bytes, the request to send
+        reuse - bool, allow a pooled origin connection
+        cached - bytes, the stale cached resource request_message revalidates; it's served if
+            the origin server replies 304 Not Modified
+        stale_if_error - bool, serve cached if the origin server fails or replies 5xx
+        prefetched - asyncio.Task of the origin response fetched ahead or None; the request is
+            sent again if that has failed
+        return - bool, True if the client connection can be used further
+        """
+        host = request.hostname
+        trace = request.trace
+        proc_state("Recsrv")
+        with trace.phase(tracing.ORIGIN_READ):
+            response = await prefetched if prefetched else None
+        reused = False
+        if response and response.ok:
+            self._log_code("A", "Fetched ahead")
+        else:
+            response = None
+            with trace.phase(tracing.ORIGIN_CONNECT):
+                origin_srv, reused = await self._send_to_origin(host, request_message, reuse)
+            if origin_srv:
+                if self._stream_responses and cached is None:
+                    return await self._relay_response(client_sock, origin_srv, request,
+                                                      request_message, reused)
+                proc_state("Readsrv")
+                with trace.phase(tracing.ORIGIN_READ):
+                    parser = await self._read_message(origin_srv, b"", ORIGIN_TIMEOUT)
+                response = ResponseReader(None, parser=parser)
+                self._release_origin(host, origin_srv, response.reusable)
+
+        outcome = self._origin_outcome(response, reused, cached, stale_if_error)
+        if request_handling.RETRY == outcome:
+            return await self._forward(client_sock, request, request_message, reuse=False,
+                                       cached=cached, stale_if_error=stale_if_error)
+        if request_handling.STALE == outcome:
+            return await self._serve_stale(client_sock, request, cached)
+        if request_handling.REVALIDATED == outcome:
+            return await self._serve_revalidated(client_sock, request, response, cached)
+        if request_handling.SEND != outcome:
+            return await self._send_error(client_sock, request, outcome)
+
+        response_message = set_keep_alive(response.message, len(response.header), keep_alive=True)
+        proc_state("Sendclient")
+        with trace.phase(tracing.CLIENT_SEND):
+            sent = await self._send_all(client_sock, response_message)
+        if not self._origin_sent(request, sent, response.response_status, len(response_message)):
+            return False
+
+        if self._cacheable(response.response_status):
+            response_message_cache = set_keep_alive(response.response_data, len(response.header),
+                                                    keep_alive=True)
+            with trace.phase(tracing.CACHE_WRITE):
+                saved = await self._in_executor(self._policy.save, request.cache_location,
+                                                response.header, response_message_cache)
+            if not saved:
+                self._log_code("CSX", "Cache write fail")
+        return True
+
+    async def _send_error(self, client_sock, request, outcome):
+        """Tell client the origin server has failed
+
+        client_sock - non-blocking socket
+        outcome - request_handling.BAD_GATEWAY or GATEWAY_TIMEOUT
+        return - bool, True if the client connection can be used further
+        """
+        if not await self._send_all(client_sock, self._gateway_error(request, outcome)):
+            self._log_code("RRX", "Client err response send failed")
+            return False
+        return request_handling.BAD_GATEWAY == outcome
+
+    async def _serve_revalidated(self, client_sock, request, response, cached):
+        """The origin server has replied 304 Not Modified to the revalidation request: refresh
+        the cached copy and serve it
+
+        client_sock - non-blocking socket
+        request - RequestReader
+        response - ResponseReader, the 304 response
+        cached - bytes, the cached resource
+        return - bool, True if the client connection can be used further
+        """
+        with request.trace.phase(tracing.CACHE_WRITE):
+            await self._in_executor(self._policy.refresh, request.cache_location, cached,
+                                    response.header)
+        return self._cache_sent(request, await self._send_cached(client_sock, request, cached),
+                                "CV", "Revalidated, sent from cache")
+
+    async def _serve_stale(self, client_sock, request, cached):
+        """The origin server has failed to revalidate the cached resource, serve it as it is
+
+        client_sock - non-blocking socket
+        request - RequestReader
+        cached - bytes, the cached resource
+        return - bool, True if the client connection can be used further
+        """
+        return self._cache_sent(request, await self._send_cached(client_sock, request, cached),
+                                "CS", "Origin failed, stale sent from cache")
+
+    async def _relay_response(self, client_sock, origin_srv, request, request_message, reused):
+        """Pass the origin response to client as soon as it arrives, writing it into the cache
+        at the same time. The cached copy is committed only if the whole response has come.
+
+        client_sock - non-blocking socket
+        origin_srv - non-blocking socket the request has been sent to
+        request - RequestReader
+        request_message - bytes, the request sent, to repeat it if a pooled connection is dead
+        reused - bool, origin_srv is a pooled connection
+        return - bool, True if the client connection can be used further
+        """
+        host = request.hostname
+        open_writer = self._relay_writer(request)
+        relay = ResponseRelay(open_writer)
+
+        proc_state("Readsrv")
+        trace = request.trace
+        buf = bytearray(BUF_SIZE)
+        received = 0
+        while not relay.done and not relay.error:
+            started = time.monotonic()
+            try:
+                size = await asyncio.wait_for(self._loop.sock_recv_into(origin_srv, buf), ORIGIN_TIMEOUT)
+            except (OSError, asyncio.TimeoutError) as errv:
+                proc_error("Origin read failed %s " % str(errv))
+                break
+            read = time.monotonic()
+            trace.add(tracing.ORIGIN_READ, read - started)
+            if not size:
+                break
+            received += size
+            #the piece is written into the cache while fed
+            if relay.caching or (open_writer and relay.header is None):
+                data = await self._in_executor(relay.feed, memoryview(buf)[:size])
+            else:
+                data = relay.feed(memoryview(buf)[:size])
+            fed = time.monotonic()
+            trace.add(tracing.CACHE_WRITE, fed - read)
+            sent = not data or await self._send_all(client_sock, data)
+            trace.add(tracing.CLIENT_SEND, time.monotonic() - fed)
+            if not sent:
+                self._metrics.count("bytes_in", received)
+                self._origin_sent(request, False, relay.response_status)
+                await self._in_executor(relay.finish)
+                self._release_origin(host, origin_srv, False)
+                return False
+            if data:
+                self._count_out(request, len(data))
+        self._release_origin(host, origin_srv, relay.reusable)
+
+        outcome = self._relay_outcome(relay, received, reused)
+        if request_handling.SEND != outcome:
+            await self._in_executor(relay.finish)
+            if request_handling.RETRY == outcome:
+                return await self._forward(client_sock, request, request_message, reuse=False)
+            if request_handling.TRUNCATED == outcome:
+                return False
+            await self._send_error(client_sock, request, outcome)
+            return False
+
+        self._origin_sent(request, True, relay.response_status)
+        if self._cacheable(relay.response_status) and relay.caching:
+            with trace.phase(tracing.CACHE_WRITE):
+                saved = await self._in_executor(relay.finish)
+            if not saved:
+                self._log_code("CSX", "Cache write fail")
+        return True
+
+    async def _resolve(self, host):
+        """Look the host name up in the resolver cache, the system resolver is queried in
+        the event loop executor on a miss
+
+        host - str
+        return - str address or None if it can't be resolved
+        """
+        resolver = get_resolver()
+        found, address = resolver.cached(host)
+        if found:
+            return address
+        try:
+            infos = await asyncio.wait_for(self._loop.getaddrinfo(host, None,
+                family=socket.AF_INET, type=socket.SOCK_STREAM), ORIGIN_TIMEOUT)
+            address = infos[0][4][0] if infos else None
+        except (OSError, asyncio.TimeoutError) as errv:
+            proc_error("Failed to resolve %s : %s" % (host, str(errv)))
+            address = None
+        resolver.store(host, address)
+        return address
+
+    async def _connected_socket(self, host):
+        """Async counterpart of net.connected_socket
+
+        host - bytes, "host[:port]"
+        return - connected non-blocking socket or None
+        """
+        host, port = net.host_port(host)
+        address = await self._resolve(host)
+        if address is None:
+            return None
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        try:
+            await asyncio.wait_for(self._loop.sock_connect(sock, (address, port)), ORIGIN_TIMEOUT)
+        except (OSError, asyncio.TimeoutError):
+            proc_error("Failed to connect socket to %s:%i" % (host, port))
+            sock.close()
+            return None
+        return sock
+
+    async def _do_CONNECT(self, client_sock, request):
+        """Open tunnel from client to the origin server and pipe data both ways until done.
+        Dispose the origin socket after done
+
+        client_sock - non-blocking socket
+        request - RequestReader
+        """
+        orig_sock = await self._connected_socket(request.hostname)
+        get_resolver().publish(self._metrics)
+        if not orig_sock:
+            await self._send_all(client_sock, self._tunnel_failed())
+            return
+        directions = (net.TunnelDirection(client_sock, orig_sock),
+                      net.TunnelDirection(orig_sock, client_sock))
+        try:
+            if not await self._send_all(client_sock, Response.CONNECTION_ESTABLISHED):
+                return
+            #the client may have sent the tunnel data without waiting for the reply
+            if request.tail and not await self._send_all(orig_sock, request.tail):
+                return
+            self._log_code("JS", "Tunnel start")
+            #time of the last data moved either way
+            activity = [time.monotonic()]
+            pending = {asyncio.ensure_future(self._relay(direction, activity))
+                       for direction in directions}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                if not all(task.result() for task in done):
+                    #failed or idle, the other way goes down too
+                    for task in pending:
+                        task.cancel()
+                    await asyncio.gather(*pending, return_exceptions=True)
+                    break
+            self._tunnel_done(directions[0].moved, directions[1].moved)
+        finally:
+            for direction in directions:
+                direction.close()
+            orig_sock.close()
+
+    async def _relay(self, direction, activity):
+        """Pipe data in one direction until the reading side shuts down
+
+        direction - net.TunnelDirection
+        activity - [float], time of the last data moved by any direction, updated
+        return - bool, True if done; False if a socket has failed or the tunnel is idle
+        """
+        try:
+            while not direction.done:
+                if direction.want_read():
+                    moved = direction.read()
+                    sock, write = direction.sock_from, False
+                else:
+                    moved = direction.write()
+                    sock, write = direction.sock_to, True
+                if moved:
+                    activity[0] = time.monotonic()
+                elif not await self._wait_ready(sock, write, activity):
+                    self._log_code("JT", "Tunnel idle")
+                    return False
+            return True
+        except OSError as errv:
+            proc_error("Tunnel closed: %s" % str(errv))
+            return False
+
+    async def _wait_ready(self, sock, write, activity):
+        """Wait until the socket can be read or written
+
+        write - bool, wait for writing
+        activity - [float], time of the last data moved through the tunnel
+        return - bool, False if nothing has moved for tunnel_idle_timeout
+        """
+        fd = sock.fileno()
+        add, remove = ((self._loop.add_writer, self._loop.remove_writer) if write
+                       else (self._loop.add_reader, self._loop.remove_reader))
+        while 1:
+            remaining = activity[0] + self._tunnel_idle_timeout - time.monotonic()
+            if remaining <= 0:
+                return False
+            ready = self._loop.create_future()
+            add(fd, lambda: ready.done() or ready.set_result(None))
+            try:
+                await asyncio.wait_for(ready, remaining)
+                return True
+            except asyncio.TimeoutError:
+                #the other direction may have been busy meanwhile
+                continue
+            finally:
+                remove(fd)
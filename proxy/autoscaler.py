@@ -0,0 +1,95 @@
+"""
+Updated: 2017
+Author: Sergei Shliakhtin
+Contact: xxx.serj@gmail.com
+Notes: Worker pool autoscaling
+
+The main process samples the worker occupancy on every dispatch loop pass: the busy workers
+(for async workers, their connections in max_connections units) and the client sockets waiting
+for a worker. The pool grows when the busy part of it stays above grow_at, or clients keep
+waiting, for window seconds; it shrinks by one idle worker when the busy ones would stay below
+shrink_at of the pool without it for as long. shrink_at is less than grow_at, and the pool isn't
+changed again for cooldown seconds and until a new window of samples has been collected, so it
+doesn't flap around one size.
+"""
+
+import collections
+import math
+
+from proxy import ProxyException
+from proxy.config import Config
+from proxy.const import Const
+
+class Autoscaler:
+    """Decides when the worker pool grows or shrinks"""
+
+    def __init__(self, min_workers, max_workers, grow_at, shrink_at, window, cooldown):
+        """
+        min_workers, max_workers - int, the pool size limits
+        grow_at - float, busy part of the pool to grow at
+        shrink_at - float, busy part of the pool without one worker to shrink at
+        window - float, seconds the load should stay high or low
+        cooldown - float, seconds between the changes
+        """
+        if not 1 <= min_workers <= max_workers:
+            raise ProxyException("Need 1 <= min_workers <= max_workers")
+        if not 0 < shrink_at < grow_at:
+            raise ProxyException("Need 0 < shrink_at < grow_at")
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self._grow_at = grow_at
+        self._shrink_at = shrink_at
+        self._window = window
+        self._cooldown = cooldown
+        #(time, busy, waiting) since the last change
+        self._samples = collections.deque()
+        self._last_change = None
+
+    @staticmethod
+    def from_config():
+        """return - Autoscaler configured in proxy.ini or None if disabled"""
+        if "True" != Config.value(Const.AUTOSCALE_SECTION, "enable"):
+            return None
+        return Autoscaler(int(Config.value(Const.AUTOSCALE_SECTION, "min_workers")),
+                          int(Config.value(Const.AUTOSCALE_SECTION, "max_workers")),
+                          float(Config.value(Const.AUTOSCALE_SECTION, "grow_at")),
+                          float(Config.value(Const.AUTOSCALE_SECTION, "shrink_at")),
+                          float(Config.value(Const.AUTOSCALE_SECTION, "window")),
+                          float(Config.value(Const.AUTOSCALE_SECTION, "cooldown")))
+
+    def clamp(self, workers):
+        """return - int, the pool size within the limits"""
+        return min(max(workers, self.min_workers), self.max_workers)
+
+    def sample(self, busy, waiting, workers, now):
+        """Take the current occupancy into account and tell how the pool should change
+
+        busy - float, busy workers
+        waiting - int, clients waiting for a worker
+        workers - int, the pool size
+        now - float, time
+        return - int, workers to add; negative - to retire; 0 - keep the pool as it is
+        """
+        if self._last_change is None:
+            self._last_change = now
+        self._samples.append((now, busy, waiting))
+        while self._samples and self._samples[0][0] < now - self._window:
+            self._samples.popleft()
+        if now - self._last_change < max(self._window, self._cooldown):
+            return 0
+        count = len(self._samples)
+        avg_busy = sum(sample[1] for sample in self._samples) / count
+        avg_waiting = sum(sample[2] for sample in self._samples) / count
+        peak_busy = max(sample[1] for sample in self._samples)
+        step = 0
+        if workers < self.max_workers and (avg_busy >= self._grow_at * workers or avg_waiting >= 1):
+            #enough to get below grow_at with the waiting clients served
+            needed = math.ceil((avg_busy + avg_waiting) / self._grow_at) - workers
+            step = min(self.max_workers - workers, max(1, needed))
+        elif (workers > self.min_workers and not any(sample[2] for sample in self._samples)
+              and peak_busy <= self._shrink_at * (workers - 1)):
+            step = -1
+        if step:
+            self._last_change = now
+            self._samples.clear()
+        return step
@@ -0,0 +1,129 @@
+"""
+Updated: 2017
+Author: Sergei Shliakhtin
+Contact: xxx.serj@gmail.com
+Notes: Revalidation of stale cached resources nobody waits for
+
+A resource stale for less than stale_while_revalidate is sent to client from cache as it is,
+then refreshed from the origin server by a few threads of the worker process. Only one process
+refreshes a resource at a time, holding its collapsed forwarding flight; the others just serve
+the stale copy meanwhile.
+
+A refresh thread has its own origin connections and its own storage: the index and the hot
+cache are locked with flock, which doesn't exclude the threads of one process sharing a file.
+"""
+
+import concurrent.futures
+import threading
+
+from proxy.compression import Compressor
+from proxy.config import Config
+from proxy.const import Const
+from proxy import freshness
+from proxy.freshness import CachePolicy
+from proxy.logger import proc_error
+from proxy.message_reader import set_keep_alive
+import proxy.network as net
+from proxy.response_reader import ResponseReader
+import proxy.storage
+
+# Seconds to wait for the origin server to connect and to respond
+ORIGIN_TIMEOUT = 20
+
+def refresh(policy, key_path, host, request_message, cached, flight=None):
+    """Revalidate the cached resource, or fetch it again if it has no validators, and save the
+    result. Blocks until done
+
+    policy - CachePolicy
+    key_path - bytes
+    host - bytes, "host[:port]"
+    request_message - bytes, the client request, with Connection: close if it has Connection
+    cached - bytes, the stale cached resource
+    flight - Flight led by this refresh, released when done
+    return - bool, True if the cached resource has been refreshed
+    """
+    try:
+        message = freshness.conditional_request(request_message, freshness.cached_header(cached))
+        origin_srv = net.connected_socket(host, timeout=ORIGIN_TIMEOUT)
+        if not origin_srv:
+            return False
+        try:
+            if not net.send_all(origin_srv, message or request_message):
+                return False
+            response = ResponseReader(origin_srv)
+        finally:
+            net.shutdown(origin_srv)
+        if not response.ok:
+            proc_error("Background refresh of %s failed" % key_path)
+            return False
+        if message and Const.HTTP_NOT_MODIFIED == response.response_status:
+            return policy.refresh(key_path, cached, response.header)
+        if Const.HTTP_OK != response.response_status:
+            #the stale copy stays until it's out of the window
+            return False
+        return policy.save(key_path, response.header,
+            set_keep_alive(response.response_data, len(response.header), keep_alive=True))
+    finally:
+        if flight:
+            flight.release()
+
+class BackgroundRefresher:
+    """Runs the refreshes of one worker process"""
+
+    def __init__(self, flights, threads):
+        """Should be called in the worker process
+
+        flights - FlightRegistry or None if collapsed forwarding is off
+        threads - int, refreshes running at the same time
+        """
+        self._flights = flights
+        self._local = threading.local()
+        #resources being refreshed by this process
+        self._pending = set()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads,
+            thread_name_prefix="refresh", initializer=self._init_thread)
+
+    @staticmethod
+    def from_config(flights):
+        """return - BackgroundRefresher configured in proxy.ini or None if disabled"""
+        threads = int(Config.value(Const.STORAGE_SECTION, "refresh_threads"))
+        if not threads or not float(Config.value(Const.STORAGE_SECTION, "stale_while_revalidate")):
+            return None
+        return BackgroundRefresher(flights, threads)
+
+    def _init_thread(self):
+        self._local.policy = CachePolicy(proxy.storage.get_storage(),
+                                         compressor=Compressor.from_config())
+
+    def start(self, key_path, host, request_message, cached):
+        """Schedule the refresh of the resource unless it's being refreshed already
+
+        key_path - bytes
+        host - bytes, "host[:port]"
+        request_message - bytes, the client request, with Connection: close if it has Connection
+        cached - bytes, the stale cached resource
+        return - bool, True if scheduled
+        """
+        if key_path in self._pending:
+            return False
+        flight = None
+        if self._flights:
+            flight = self._flights.join(key_path)
+            if not flight.leader:
+                #another process is on it
+                flight.release()
+                return False
+        self._pending.add(key_path)
+        future = self._executor.submit(self._refresh, key_path, host, request_message, cached,
+                                       flight)
+        future.add_done_callback(lambda _: self._pending.discard(key_path))
+        return True
+
+    def _refresh(self, key_path, host, request_message, cached, flight):
+        try:
+            return refresh(self._local.policy, key_path, host, request_message, cached, flight)
+        except Exception as errv:
+            proc_error("Background refresh failed: %s" % str(errv))
+            if flight:
+                flight.release()
+            return False
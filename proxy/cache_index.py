@@ -0,0 +1,364 @@
+"""
+Updated: 2017
+Author: Sergei Shliakhtin
+Contact: xxx.serj@gmail.com
+Notes: Cache metadata index shared by the worker processes
+
+Tells whether a resource is cached, when it has been stored and how large it is without asking
+the storage. The main process creates the mapped file and fills it from the storage contents
+on start; the workers update it on save and erase. While every resource has fit into the
+index it's complete, and a resource missing from the index is missing from the storage too.
+
+Writers are serialized with flock, readers take no locks: a slot is protected by a sequence
+number which is odd while the slot is being changed.
+
+Layout: header | slots
+    header - magic, slot count, complete flag, resource count, resources size
+    slot - sequence, key hash, check word, size, stored time, expiry time, last access time,
+        hits, status
+A slot matches a resource by its index key: the key hash locating it and the check word, an
+independent 64-bit part of the same SHA-1 telling apart the resources with equal key hashes.
+The access time and hits are updated by the readers without locking, they only need to be
+roughly right for the eviction.
+Slots are found by open addressing, probing at most PROBE_SLOTS ones from the hash position.
+"""
+
+import collections
+import fcntl
+import hashlib
+import mmap
+import struct
+import time
+
+from proxy.config import Config
+from proxy.const import Const
+from proxy.encoding import to_bytes
+from proxy.logger import log, proc_error
+
+MAGIC = b"RAROGCI2"
+_HEADER = struct.Struct("=8sQQQQ")
+_HEADER_SIZE = 64
+# offsets of the header fields changed at run time
+_COMPLETE = 16
+_TOTALS = 24
+_SLOT = struct.Struct("=QQQQdddII")
+# slot without the sequence
+_SLOT_DATA = struct.Struct("=QQQdddII")
+# offset and layout of the access statistics in a slot
+_ACCESS = 48
+_ACCESS_DATA = struct.Struct("=dI")
+_SEQ = struct.Struct("=Q")
+_TOTALS_DATA = struct.Struct("=QQ")
+PROBE_SLOTS = 16
+# key hashes reserved for empty and erased slots
+_EMPTY = 0
+_ERASED = 1
+# times to reread a slot being changed before giving up
+_READ_RETRIES = 100
+
+# expiry - float, time the resource goes stale, 0 if the default age limit applies
+# status - int, HTTP status of the cached response
+# last_access - float, time the resource has been looked up the last time
+# hits - int, lookups of the resource
+Entry = collections.namedtuple("Entry", "size stored expiry status last_access hits")
+
+def new_entry(size, stored, expiry=0.0, status=Const.HTTP_OK):
+    """return - Entry of a resource just stored"""
+    return Entry(size, stored, expiry, status, stored, 0)
+
+def key_hash(key_path):
+    """return - int, 64-bit hash of the resource path, the first 8 bytes of its SHA-1"""
+    return _adjust(int.from_bytes(hashlib.sha1(to_bytes(key_path)).digest()[:8], "big"))
+
+def index_key(key_path):
+    """return - (int key hash, int check word), the first and the second 8 bytes of the SHA-1
+    of the resource path
+    """
+    digest = hashlib.sha1(to_bytes(key_path)).digest()
+    return _adjust(int.from_bytes(digest[:8], "big")), int.from_bytes(digest[8:16], "big")
+
+def hex_index_key(hex_digest):
+    """The index key from the hex SHA-1 of the resource path, e.g. a hashed layout file name
+
+    hex_digest - bytes or str
+    return - (int, int), same as index_key() of the resource path
+    """
+    return _adjust(int(hex_digest[:16], 16)), int(hex_digest[16:32], 16)
+
+def _adjust(value):
+    return value if value > _ERASED else value + 2
+
+class CacheIndex:
+    """The mapped index file"""
+
+    def __init__(self, path):
+        """Map an existing index file
+
+        path - str
+        """
+        self._file = open(path, "r+b")
+        self._mm = mmap.mmap(self._file.fileno(), 0)
+        magic, self._slots, _, _, _ = _HEADER.unpack_from(self._mm, 0)
+        if MAGIC != magic:
+            raise ValueError("%s is not a cache index file" % path)
+
+    @staticmethod
+    def create(path, slots):
+        """Create or reset the index file, empty and complete
+
+        path - str
+        slots - int, the number of resources which can be indexed, better with some reserve
+        """
+        with open(path, "wb") as index_file:
+            index_file.truncate(_HEADER_SIZE + slots * _SLOT.size)
+            index_file.write(_HEADER.pack(MAGIC, slots, 1, 0, 0))
+
+    @staticmethod
+    def from_config():
+        """return - CacheIndex configured in proxy.ini or None if disabled"""
+        if "True" != Config.value(Const.CACHE_INDEX_SECTION, "enable"):
+            return None
+        try:
+            return CacheIndex(Config.value(Const.CACHE_INDEX_SECTION, "path"))
+        except (OSError, ValueError) as errv:
+            proc_error("Cache index unavailable: %s" % str(errv))
+            return None
+
+    @staticmethod
+    def create_from_config(storage):
+        """Create the index file configured in proxy.ini, if enabled, and fill it with the
+        resources of the storage. Should be called once before the workers start
+
+        storage - the storage without wrappers
+        """
+        if "True" != Config.value(Const.CACHE_INDEX_SECTION, "enable"):
+            return
+        path = Config.value(Const.CACHE_INDEX_SECTION, "path")
+        CacheIndex.create(path, int(Config.value(Const.CACHE_INDEX_SECTION, "slots")))
+        index = CacheIndex(path)
+        started = time.time()
+        for key, size, stored, expiry in storage.scan():
+            index.put_key(key, new_entry(size, stored, expiry))
+        entries, total_size = index.totals()
+        log("Cache index: %i resources, %i bytes, %s, loaded in %.2f s" % (entries, total_size,
+            "complete" if index.complete else "incomplete", time.time() - started))
+
+    @property
+    def complete(self):
+        """bool, every resource in the storage is in the index"""
+        return bool(_SEQ.unpack_from(self._mm, _COMPLETE)[0])
+
+    def totals(self):
+        """return - (int resource count, int bytes)"""
+        return _TOTALS_DATA.unpack_from(self._mm, _TOTALS)
+
+    def _slot_offset(self, hash_value, probe):
+        return _HEADER_SIZE + ((hash_value + probe) % self._slots) * _SLOT.size
+
+    def lookup(self, key_path, record_access=False):
+        """Find the resource without locking
+
+        key_path - bytes
+        record_access - bool, count the lookup as a resource use for the eviction
+        return - Entry or None if it's not indexed
+        """
+        hash_value, check = index_key(key_path)
+        mm = self._mm
+        for probe in range(PROBE_SLOTS):
+            offset = self._slot_offset(hash_value, probe)
+            for _ in range(_READ_RETRIES):
+                seq, slot_hash, slot_check, *data = _SLOT.unpack_from(mm, offset)
+                if not seq & 1 and seq == _SEQ.unpack_from(mm, offset)[0]:
+                    break
+            else:
+                # the writer must have died in the middle
+                return None
+            if _EMPTY == slot_hash:
+                return None
+            if slot_hash == hash_value and slot_check == check:
+                size, stored, expiry, last_access, hits, status = data
+                if record_access:
+                    _ACCESS_DATA.pack_into(mm, offset + _ACCESS, time.time(), hits + 1)
+                return Entry(size, stored, expiry, status, last_access, hits)
+        return None
+
+    def entries(self):
+        """Walk all the indexed resources without locking, the ones being changed are skipped
+
+        return - iterator of ((int key hash, int check word), Entry)
+        """
+        slots = memoryview(self._mm)[_HEADER_SIZE:_HEADER_SIZE + self._slots * _SLOT.size]
+        for seq, slot_hash, check, size, stored, expiry, last_access, hits, status in \
+                _SLOT.iter_unpack(slots):
+            if slot_hash > _ERASED and not seq & 1:
+                yield (slot_hash, check), Entry(size, stored, expiry, status, last_access, hits)
+
+    def put(self, key_path, entry):
+        """Add or update the resource
+
+        key_path - bytes
+        entry - Entry
+        """
+        self.put_key(index_key(key_path), entry)
+
+    def put_key(self, key, entry):
+        """Same as put() for the index key
+
+        key - (int key hash, int check word), see index_key()
+        """
+        hash_value, check = key
+        mm = self._mm
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        try:
+            free = None
+            for probe in range(PROBE_SLOTS):
+                offset = self._slot_offset(hash_value, probe)
+                slot_hash, slot_check, size = _SLOT_DATA.unpack_from(mm, offset + _SEQ.size)[:3]
+                if slot_hash == hash_value and slot_check == check:
+                    self._add_totals(0, entry.size - size)
+                    # a replaced resource keeps its popularity
+                    hits = _ACCESS_DATA.unpack_from(mm, offset + _ACCESS)[1]
+                    self._write_slot(offset, key, entry._replace(hits=entry.hits + hits))
+                    return
+                if free is None and slot_hash in (_EMPTY, _ERASED):
+                    free = offset
+                if _EMPTY == slot_hash:
+                    break
+            if free is None:
+                if self.complete:
+                    log("Cache index is full, misses are checked in the storage from now on")
+                _SEQ.pack_into(mm, _COMPLETE, 0)
+                return
+            self._add_totals(1, entry.size)
+            self._write_slot(free, key, entry)
+        finally:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+    def erase(self, key_path):
+        """Drop the resource
+
+        key_path - bytes
+        """
+        self.erase_key(index_key(key_path))
+
+    def erase_key(self, key):
+        """Same as erase() for the index key
+
+        key - (int key hash, int check word), see index_key()
+        """
+        hash_value, check = key
+        mm = self._mm
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        try:
+            for probe in range(PROBE_SLOTS):
+                offset = self._slot_offset(hash_value, probe)
+                slot_hash, slot_check, size = _SLOT_DATA.unpack_from(mm, offset + _SEQ.size)[:3]
+                if _EMPTY == slot_hash:
+                    return
+                if slot_hash == hash_value and slot_check == check:
+                    self._add_totals(-1, -size)
+                    # the following slots may continue the probe sequence, keep it going
+                    self._write_slot(offset, (_ERASED, 0), new_entry(0, 0.0, status=0))
+                    return
+        finally:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+    def _add_totals(self, entries, size):
+        """Should be called with the lock held"""
+        total_entries, total_size = _TOTALS_DATA.unpack_from(self._mm, _TOTALS)
+        _TOTALS_DATA.pack_into(self._mm, _TOTALS, total_entries + entries, total_size + size)
+
+    def _write_slot(self, offset, key, entry):
+        """Should be called with the lock held"""
+        seq = _SEQ.unpack_from(self._mm, offset)[0]
+        # odd sequence tells readers the slot is being changed
+        _SEQ.pack_into(self._mm, offset, seq + 1)
+        _SLOT_DATA.pack_into(self._mm, offset + _SEQ.size, key[0], key[1], entry.size,
+                             entry.stored, entry.expiry, entry.last_access, entry.hits,
+                             entry.status)
+        _SEQ.pack_into(self._mm, offset, seq + 2)
+
+class IndexedStorage:
+    """Storage wrapper answering the lookups from CacheIndex and keeping it up to date"""
+
+    def __init__(self, storage, index):
+        """
+        storage - the wrapped storage
+        index - CacheIndex
+        """
+        self._storage = storage
+        self._index = index
+
+    def haskey_time(self, key_path):
+        entry = self._index.lookup(key_path, record_access=True)
+        if entry:
+            return True, entry.stored
+        if self._index.complete:
+            return False, None
+        return self._storage.haskey_time(key_path)
+
+    def cached_times(self, key_path):
+        entry = self._index.lookup(key_path, record_access=True)
+        if entry:
+            return entry.stored, entry.expiry
+        if self._index.complete:
+            return None
+        return self._storage.cached_times(key_path)
+
+    def record_access(self, key_path):
+        """Count a use of the resource served without looking it up here"""
+        self._index.lookup(key_path, record_access=True)
+
+    def fetch(self, key_path):
+        data = self._storage.fetch(key_path)
+        if data is None:
+            # removed from the storage behind the index
+            self._index.erase(key_path)
+        return data
+
+    def save(self, key_path, data, expiry=0.0):
+        if not self._storage.save(key_path, data, expiry):
+            return False
+        self._index.put(key_path, new_entry(len(data), time.time(), expiry))
+        return True
+
+    def save_many(self, items):
+        saved = self._storage.save_many(items)
+        for (key_path, data, expiry), ok in zip(items, saved):
+            if ok:
+                self._index.put(key_path, new_entry(len(data), time.time(), expiry))
+        return saved
+
+    def writer(self, key_path, expiry=0.0):
+        writer = self._storage.writer(key_path, expiry)
+        return _IndexedWriter(writer, self._index, key_path, expiry) if writer else None
+
+    def erase(self, key_path):
+        self._index.erase(key_path)
+        self._storage.erase(key_path)
+
+    def __getattr__(self, name):
+        # the rest of the storage interface goes to the wrapped storage as it is
+        return getattr(self._storage, name)
+
+class _IndexedWriter:
+    """Passes the pieces to the wrapped storage writer, indexing the resource on commit"""
+    def __init__(self, writer, index, key_path, expiry):
+        self._writer = writer
+        self._index = index
+        self._key_path = key_path
+        self._expiry = expiry
+        self._size = 0
+
+    def write(self, data):
+        self._writer.write(data)
+        self._size += len(data)
+
+    def commit(self):
+        if not self._writer.commit():
+            return False
+        self._index.put(self._key_path, new_entry(self._size, time.time(), self._expiry))
+        return True
+
+    def abort(self):
+        self._writer.abort()
@@ -0,0 +1,143 @@
+"""
+Updated: 2017
+Author: Sergei Shliakhtin
+Contact: xxx.serj@gmail.com
+Notes: Background cache eviction
+
+The sweeper process periodically walks the cache index, removing the resources expired for
+longer than keep_stale (they can't be revalidated any more) and,
+when the cache is over its size or resource count budget, the least valuable ones according
+to the eviction policy, until the cache is down to the low watermark. The workers aren't
+blocked: the index is locked for a single erase at a time and the storage is cleaned after
+the resources have left the index.
+"""
+
+import logging
+import math
+import time
+
+from proxy.cache_index import CacheIndex
+from proxy.config import Config
+from proxy.const import Const
+import proxy.logger
+from proxy.logger import log, log_basic_config, proc_error, proc_state
+import proxy.storage
+
+LRU = "lru"
+LFU = "lfu"
+HYBRID = "hybrid"
+
+def _lru_score(entry, now, half_life):
+    return entry.last_access
+
+def _lfu_score(entry, now, half_life):
+    return entry.hits, entry.last_access
+
+def _hybrid_score(entry, now, half_life):
+    # hits decayed by the time since the last use, a popular resource unused for long goes
+    # before a moderately popular recent one
+    return (entry.hits + 1) * math.pow(2.0, -(now - entry.last_access) / half_life)
+
+_SCORES = {LRU: _lru_score, LFU: _lfu_score, HYBRID: _hybrid_score}
+
+class CacheSweeper:
+    """Runs the sweeps in its own process. The lowest scored resources are evicted first"""
+
+    def __init__(self):
+        """Should be called from parent process"""
+        self.is_init = False
+
+    @staticmethod
+    def enabled():
+        """return - bool, the sweeper should be started; it needs the cache index"""
+        return ("True" == Config.value(Const.EVICTION_SECTION, "enable")
+                and "True" == Config.value(Const.CACHE_INDEX_SECTION, "enable")
+                and "True" == Config.value(Const.STORAGE_SECTION, "enable_cache"))
+
+    def _init_this_process(self, log_queue=None):
+        """Should be called in child process
+
+        log_queue - multiprocessing.Queue of the log process or None
+        """
+        assert not self.is_init
+        self.is_init = True
+        log_basic_config(log_queue)
+        self._index = CacheIndex.from_config()
+        self._storage = proxy.storage.get_backend_storage()
+        self._max_size = int(Config.value(Const.EVICTION_SECTION, "max_size"))
+        self._max_objects = int(Config.value(Const.EVICTION_SECTION, "max_objects"))
+        self._low_watermark = float(Config.value(Const.EVICTION_SECTION, "low_watermark"))
+        self._half_life = float(Config.value(Const.EVICTION_SECTION, "hybrid_half_life"))
+        self._interval = float(Config.value(Const.EVICTION_SECTION, "sweep_interval"))
+        self._discard_after = float(Config.value(Const.STORAGE_SECTION, "cache_discard_after"))
+        self._keep_stale = float(Config.value(Const.EVICTION_SECTION, "keep_stale"))
+        policy = Config.value(Const.EVICTION_SECTION, "policy")
+        if policy not in _SCORES:
+            proc_error("Unknown eviction policy %s, using %s" % (policy, LRU))
+            policy = LRU
+        self._score = _SCORES[policy]
+
+    def __call__(self, stdout_lock, log_queue=None):
+        """Sweep every sweep_interval until KeyboardInterrupted
+
+        stdout_lock - limit access to STDOUT
+        log_queue - multiprocessing.Queue of the log process, None to write the log directly
+        """
+        self._init_this_process(log_queue)
+        proxy.logger.init_lock(stdout_lock)
+        if not self._index:
+            return
+        try:
+            while True:
+                time.sleep(self._interval)
+                try:
+                    self.sweep()
+                except OSError as errv:
+                    proc_error("Sweep failed: %s" % str(errv))
+        except KeyboardInterrupt:
+            return
+
+    def _expires(self, entry):
+        """return - float, time the resource is of no use any more, even for revalidation"""
+        return (entry.expiry or entry.stored + self._discard_after) + self._keep_stale
+
+    def _over_budget(self, count, size, fraction):
+        return ((self._max_objects and count > self._max_objects * fraction)
+                or (self._max_size and size > self._max_size * fraction))
+
+    def sweep(self):
+        """Remove the expired resources, then the lowest scored ones while over the budget
+
+        return - (int expired, int evicted)
+        """
+        now = time.time()
+        victims = set()
+        kept = []
+        size = 0
+        for key, entry in self._index.entries():
+            if self._expires(entry) < now:
+                victims.add(key)
+            else:
+                kept.append((key, entry))
+                size += entry.size
+        expired = len(victims)
+        count = len(kept)
+        if self._over_budget(count, size, 1.0):
+            kept.sort(key=lambda item: self._score(item[1], now, self._half_life))
+            for key, entry in kept:
+                if not self._over_budget(count, size, self._low_watermark):
+                    break
+                victims.add(key)
+                count -= 1
+                size -= entry.size
+        if not victims:
+            return 0, 0
+        # out of the index first, so that the workers stop looking for them in the storage
+        for key in victims:
+            self._index.erase_key(key)
+        removed = self._storage.erase_hashes({hash_value for hash_value, check in victims})
+        proc_state("Swept: %i expired, %i evicted, %i removed from storage, %.2f s" % (expired,
+            len(victims) - expired, removed, time.time() - now))
+        log("\nCache sweep: %i expired, %i evicted " % (expired, len(victims) - expired),
+            logging.WARNING)
+        return expired, len(victims) - expired
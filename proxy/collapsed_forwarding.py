@@ -0,0 +1,219 @@
+"""
+Updated: 2017
+Author: Sergei Shliakhtin
+Contact: xxx.serj@gmail.com
+Notes: Collapsed forwarding of concurrent cache misses
+
+Only one worker process requests a missing or stale resource from the origin server, the
+others wait for it to land in the cache. The fetching process holds flock on a lock file named
+by the resource path hash; the file is removed and then unlocked once the response has been
+saved. A process which dies in the middle releases the lock with its descriptors.
+
+A process which has opened the lock file just before it was removed gets the lock of the removed
+file, so the lock is taken only once the locked file is checked to be the one at the path.
+
+A response queued for a write-behind writer process isn't in the cache yet when the leader is
+done. The lock file is marked as handed over to the writer then: the leader leaves it in place,
+and the followers and the processes joining later keep waiting until the writer has saved the
+resource and removed the file.
+"""
+
+import fcntl
+import hashlib
+import os
+import time
+
+from proxy.config import Config
+from proxy.const import Const
+from proxy.encoding import to_bytes
+from proxy.logger import proc_error
+
+# times to reopen the lock file removed by the previous leader while being locked
+_JOIN_RETRIES = 10
+# content of a lock file handed over to a writer process, an empty one isn't
+_HANDED_OVER = b"w"
+
+def _handed_over(lock_file, path):
+    """return - bool, the opened lock file is still at the path and marked as handed over"""
+    try:
+        opened, current = os.fstat(lock_file), os.stat(path)
+    except OSError:
+        return False
+    return ((opened.st_dev, opened.st_ino) == (current.st_dev, current.st_ino)
+            and opened.st_size > 0)
+
+class Flight:
+    """A fetch of one resource from the origin server"""
+
+    def __init__(self, path, lock_file, leader):
+        """
+        path - str, the lock file path
+        lock_file - int, descriptor of the lock file
+        leader - bool, this process is fetching the resource
+        """
+        self._path = path
+        self._fd = lock_file
+        self.leader = leader
+
+    def landed(self):
+        """Followers: check without blocking if the leader is done
+
+        return - bool
+        """
+        if self._fd is None:
+            return True
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        if _handed_over(self._fd, self._path):
+            # waits for a writer process
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            return False
+        self.release()
+        return True
+
+    def wait(self, timeout, poll_interval):
+        """Followers: block until the leader is done or the timeout
+
+        return - bool, False on timeout
+        """
+        deadline = time.time() + timeout
+        while not self.landed():
+            if time.time() > deadline:
+                self.release()
+                return False
+            time.sleep(poll_interval)
+        return True
+
+    def release(self):
+        """Leader: let the followers go on; followers: stop waiting"""
+        if self._fd is None:
+            return
+        if self.leader and not os.fstat(self._fd).st_size:
+            # still locked, a process locking the file from now on finds it removed. One
+            # handed over is removed by the writer process
+            try:
+                os.remove(self._path)
+            except OSError:
+                pass
+        # closing unlocks
+        os.close(self._fd)
+        self._fd = None
+
+class FlightRegistry:
+    """The fetches in progress by all the worker processes"""
+
+    def __init__(self, lock_dir, wait_timeout, poll_interval):
+        """
+        lock_dir - str, created by create_from_config()
+        wait_timeout - float, seconds a follower waits before fetching the resource itself
+        poll_interval - float, seconds between the checks of the leader
+        """
+        self._lock_dir = lock_dir
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+
+    @staticmethod
+    def from_config():
+        """return - FlightRegistry configured in proxy.ini or None if disabled"""
+        if "True" != Config.value(Const.COLLAPSED_FORWARDING_SECTION, "enable"):
+            return None
+        return FlightRegistry(Config.value(Const.COLLAPSED_FORWARDING_SECTION, "lock_dir"),
+                              float(Config.value(Const.COLLAPSED_FORWARDING_SECTION, "wait_timeout")),
+                              float(Config.value(Const.COLLAPSED_FORWARDING_SECTION, "poll_interval")))
+
+    @staticmethod
+    def create_from_config():
+        """Create the lock dir configured in proxy.ini, if enabled. Should be called once before
+        the workers start"""
+        if "True" != Config.value(Const.COLLAPSED_FORWARDING_SECTION, "enable"):
+            return
+        lock_dir = Config.value(Const.COLLAPSED_FORWARDING_SECTION, "lock_dir")
+        os.makedirs(lock_dir, mode=0o777, exist_ok=True)
+        # left handed over by the writers of the previous run
+        for name in os.listdir(lock_dir):
+            try:
+                os.remove(os.path.join(lock_dir, name))
+            except OSError:
+                pass
+
+    def _lock_path(self, key_path):
+        return os.path.join(self._lock_dir, hashlib.sha1(to_bytes(key_path)).hexdigest())
+
+    def join(self, key_path):
+        """Become the leader of the resource fetch if there is none, a follower otherwise
+
+        key_path - bytes
+        return - Flight; a leader should release it once the response is saved. A follower
+            is a leader too if the lock file can't be opened, so that the fetch goes on
+        """
+        path = self._lock_path(key_path)
+        for _ in range(_JOIN_RETRIES):
+            try:
+                lock_file = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+            except OSError as errv:
+                proc_error("Couldn't open lock file %s : %s" % (path, str(errv)))
+                return Flight(path, None, True)
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return Flight(path, lock_file, False)
+            if _handed_over(lock_file, path):
+                # the resource is about to be saved by a writer process
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                return Flight(path, lock_file, False)
+            if self._at_path(lock_file, path):
+                return Flight(path, lock_file, True)
+            # removed by the previous leader, the lock means nothing
+            os.close(lock_file)
+        proc_error("Couldn't lock file %s : it keeps being replaced" % path)
+        return Flight(path, None, True)
+
+    def hand_over(self, key_path):
+        """Mark the fetch of the resource as handed over to a writer process, so that its
+        followers wait until the writer calls landed(). Should be called before the resource
+        is queued for the writer
+
+        key_path - bytes
+        """
+        try:
+            lock_file = os.open(self._lock_path(key_path), os.O_WRONLY)
+        except FileNotFoundError:
+            # no flight
+            return
+        except OSError as errv:
+            proc_error("Couldn't open lock file for %s : %s" % (key_path, str(errv)))
+            return
+        try:
+            os.write(lock_file, _HANDED_OVER)
+        finally:
+            os.close(lock_file)
+
+    def take_back(self, key_path):
+        """Undo hand_over() of a resource which hasn't been queued after all"""
+        try:
+            os.truncate(self._lock_path(key_path), 0)
+        except OSError:
+            pass
+
+    def landed(self, key_path):
+        """Writers: the resource handed over has been saved or given up, let its followers go on
+
+        key_path - bytes
+        """
+        path = self._lock_path(key_path)
+        try:
+            if os.stat(path).st_size:
+                os.remove(path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _at_path(lock_file, path):
+        """return - bool, the opened lock file is still the one found at the path"""
+        try:
+            opened, current = os.fstat(lock_file), os.stat(path)
+        except OSError:
+            return False
+        return (opened.st_dev, opened.st_ino) == (current.st_dev, current.st_ino)
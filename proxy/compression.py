@@ -0,0 +1,285 @@
+"""
+Updated: 2017
+Author: Sergei Shliakhtin
+Contact: xxx.serj@gmail.com
+Notes: Compressed storage of the cached responses
+
+A response of a compressible type which the origin server hasn't encoded is stored gzipped,
+with Content-Encoding: gzip, the Content-Length of the compressed body and Vary:
+Accept-Encoding. A chunked body is joined before. Clients accepting gzip get the stored bytes
+as they are, with sendfile if possible; the others get the body decoded, with the headers
+changed back. The same goes for the responses gzipped by the origin server, chunked ones
+included.
+
+The gzipped body isn't the one the origin server has sent, so its ETag gets
+freshness.GZIP_ETAG_SUFFIX. The suffix is dropped for the revalidation requests and for the
+decoded responses.
+"""
+
+import re
+import zlib
+
+from proxy.config import Config
+from proxy.const import Const
+from proxy import freshness
+from proxy.freshness import cache_control, cached_header, header_value
+from proxy.logger import proc_error
+
+# gzip container for zlib
+_GZIP_WBITS = 31
+# bytes read to find the headers of a response kept in a file
+_PEEK_SIZE = 8192
+# headers replaced when the body encoding changes
+_BODY_HEADERS = re.compile(b"^(content-length|transfer-encoding|content-encoding)$", re.IGNORECASE)
+_ETAG = re.compile(b"^etag:[ \t]*", re.IGNORECASE)
+
+def _split(data):
+    """data - bytes, response without status line
+    return - (list of bytes header lines, bytes body) or None if there is no header end
+    """
+    ends = [(data.find(terminator), terminator) for terminator in (b"\r\n\r\n", b"\n\n")]
+    ends = [(pos, terminator) for pos, terminator in ends if pos >= 0]
+    if not ends:
+        return None
+    header_end, terminator = min(ends)
+    lines = [line.rstrip(b"\r") for line in data[:header_end].split(b"\n")]
+    return lines, data[header_end + len(terminator):]
+
+def _join(lines, body):
+    return b"\r\n".join(lines) + b"\r\n\r\n" + body
+
+def _replace_body_headers(lines, extra):
+    """lines - list of bytes header lines
+    extra - list of bytes header lines to add instead of the body ones
+    return - list of bytes header lines
+    """
+    kept = [line for line in lines if not _BODY_HEADERS.match(line.split(b":", 1)[0].strip())]
+    return kept + extra
+
+def _replace_etag(lines, change):
+    """lines - list of bytes header lines
+    change - function of bytes ETag returning the new one
+    return - list of bytes header lines
+    """
+    changed = []
+    for line in lines:
+        match = _ETAG.match(line)
+        if match:
+            line = b"ETag: " + change(line[match.end():].strip())
+        changed.append(line)
+    return changed
+
+def _gzip_etag(etag):
+    """return - bytes, ETag of the response gzipped by the proxy"""
+    if etag.endswith(b'"') and not etag.endswith(freshness.GZIP_ETAG_SUFFIX + b'"'):
+        return etag[:-1] + freshness.GZIP_ETAG_SUFFIX + b'"'
+    return etag
+
+def dechunk(body):
+    """body - bytes, chunked body
+    return - bytes, the chunks joined, or None if malformed
+    """
+    parts = []
+    pos = 0
+    while True:
+        newline = body.find(b"\n", pos)
+        if newline < 0:
+            return None
+        try:
+            # chunk extensions are ignored
+            size = int(body[pos:newline].split(b";", 1)[0].strip(), 16)
+        except ValueError:
+            return None
+        if not size:
+            # the trailer is dropped
+            return b"".join(parts)
+        start = newline + 1
+        if len(body) < start + size:
+            return None
+        parts.append(body[start:start + size])
+        pos = body.find(b"\n", start + size)
+        if pos < 0:
+            return None
+        pos += 1
+
+def accepts_gzip(request_header):
+    """return - bool, the client has listed gzip or * in Accept-Encoding with nonzero quality"""
+    accepted = header_value(request_header, b"Accept-Encoding")
+    if accepted is None:
+        return False
+    for coding in accepted.lower().split(b","):
+        name, _, params = coding.partition(b";")
+        if name.strip() not in (b"gzip", b"x-gzip", b"*"):
+            continue
+        quality = re.search(b"q=([0-9.]+)", params)
+        try:
+            return not quality or float(quality.group(1)) > 0
+        except ValueError:
+            return False
+    return False
+
+def is_gzip(header):
+    """return - bool, the response body is gzipped"""
+    encoding = header_value(header, b"Content-Encoding")
+    return encoding is not None and encoding.strip().lower() in (b"gzip", b"x-gzip")
+
+def peek_header(opened):
+    """Read the headers of a response kept in a file without moving the file position
+
+    opened - (file object, offset, size) as returned by fetch_file()
+    return - bytes, the headers, or the beginning of them if they're too long
+    """
+    file_, offset, size = opened
+    file_.seek(offset)
+    try:
+        return cached_header(file_.read(min(size, _PEEK_SIZE)))
+    finally:
+        file_.seek(offset)
+
+def decoded(data):
+    """data - bytes, cached response without status line with a gzipped body
+    return - bytes, the same response with the body decoded or None if it's corrupt
+    """
+    parts = _split(data)
+    if not parts:
+        return None
+    lines, body = parts
+    if header_value(b"\n".join(lines), b"Transfer-Encoding") is not None:
+        body = dechunk(body)
+        if body is None:
+            proc_error("Cached response decoding failed: malformed chunks")
+            return None
+    try:
+        body = zlib.decompress(body, _GZIP_WBITS)
+    except zlib.error as errv:
+        proc_error("Cached response decoding failed: %s" % str(errv))
+        return None
+    lines = _replace_etag(lines, freshness.origin_etag)
+    return _join(_replace_body_headers(lines, [b"Content-Length: %i" % len(body)]), body)
+
+class Compressor:
+    """Compresses the responses of the configured types before they're stored"""
+
+    def __init__(self, types, min_size, max_size, level):
+        """
+        types - list of bytes, Content-Type prefixes to compress, e.g. b"text/"
+        min_size - int, bytes, smaller bodies aren't worth it
+        max_size - int, bytes, larger responses are stored as they are; they're kept in
+            memory whole to be compressed
+        level - int, zlib compression level
+        """
+        self._types = types
+        self.min_size = min_size
+        self.max_size = max_size
+        self._level = level
+
+    @staticmethod
+    def from_config():
+        """return - Compressor configured in proxy.ini or None if disabled"""
+        if "True" != Config.value(Const.COMPRESSION_SECTION, "enable"):
+            return None
+        types = Config.value(Const.COMPRESSION_SECTION, "types")
+        return Compressor([item.strip().lower().encode("ascii") for item in types.split(",")
+                           if item.strip()],
+                          int(Config.value(Const.COMPRESSION_SECTION, "min_size")),
+                          int(Config.value(Const.COMPRESSION_SECTION, "max_size")),
+                          int(Config.value(Const.COMPRESSION_SECTION, "level")))
+
+    def compressible(self, header):
+        """header - bytes, response headers
+        return - bool, the response should be stored compressed if it's not too large
+        """
+        if header_value(header, b"Content-Encoding") is not None:
+            return False
+        if b"no-transform" in cache_control(header):
+            return False
+        content_type = header_value(header, b"Content-Type")
+        if not content_type:
+            return False
+        content_type = content_type.split(b";", 1)[0].strip().lower()
+        return any(content_type.startswith(prefix) for prefix in self._types)
+
+    def compress(self, data):
+        """data - bytes, response without status line
+        return - bytes, the response to store: compressed or the same one
+        """
+        if len(data) > self.max_size:
+            return data
+        parts = _split(data)
+        if not parts:
+            return data
+        lines, body = parts
+        header = b"\n".join(lines)
+        if not self.compressible(header):
+            return data
+        if header_value(header, b"Transfer-Encoding") is not None:
+            body = dechunk(body)
+            if body is None:
+                return data
+        if len(body) < self.min_size:
+            return data
+        compressor = zlib.compressobj(self._level, zlib.DEFLATED, _GZIP_WBITS)
+        compressed = compressor.compress(body) + compressor.flush()
+        if len(compressed) >= len(body):
+            return data
+        extra = [b"Content-Encoding: gzip", b"Content-Length: %i" % len(compressed)]
+        vary = header_value(header, b"Vary")
+        if vary is None:
+            extra.append(b"Vary: Accept-Encoding")
+        elif b"accept-encoding" not in vary.lower() and b"*" != vary.strip():
+            lines = [line for line in lines if not line.lower().startswith(b"vary:")]
+            extra.append(b"Vary: " + vary + b", Accept-Encoding")
+        lines = _replace_etag(lines, _gzip_etag)
+        return _join(_replace_body_headers(lines, extra), compressed)
+
+    def writer(self, storage, key_path, expiry):
+        """Start writing a compressible response piece by piece
+
+        return - storage writer
+        """
+        return _CompressingWriter(self, storage, key_path, expiry)
+
+class _CompressingWriter:
+    """Collects the response to compress and save it on commit. Once it's larger than max_size,
+    the pieces go to a storage writer as they are
+    """
+    def __init__(self, compressor, storage, key_path, expiry):
+        self._compressor = compressor
+        self._storage = storage
+        self._key_path = key_path
+        self._expiry = expiry
+        self._parts = []
+        self._size = 0
+        self._writer = None
+        self._failed = False
+
+    def write(self, data):
+        if self._writer:
+            self._writer.write(data)
+            return
+        if self._failed:
+            return
+        self._parts.append(bytes(data))
+        self._size += len(data)
+        if self._size > self._compressor.max_size:
+            self._writer = self._storage.writer(self._key_path, self._expiry)
+            if not self._writer:
+                self._failed = True
+            else:
+                for part in self._parts:
+                    self._writer.write(part)
+            self._parts = []
+
+    def commit(self):
+        """return - bool, True if the response has been saved"""
+        if self._writer:
+            return self._writer.commit()
+        if self._failed:
+            return False
+        data, self._parts = b"".join(self._parts), []
+        return self._storage.save(self._key_path, self._compressor.compress(data), self._expiry)
+
+    def abort(self):
+        if self._writer:
+            self._writer.abort()
+        self._parts = []
@@ -7,20 +7,30 @@ Notes: Main data flow redirection/request handling happens here
 
 import logging 
 import multiprocessing
+import select
 import socket
 import time
 
 from proxy import ProxyException
 from proxy.config import Config
 from proxy.const import Const
+from proxy import compression, freshness
+from proxy.freshness import CachePolicy
 import proxy.http_response as Response
-from proxy.http_response import add_ok_status
-from proxy.logger import log, log_basic_config, logger, proc_state
+from proxy.logger import logger, proc_error, proc_state
+import proxy.logger
 from proxy.message_reader import set_keep_alive
 import proxy.network as net
+from proxy.pipeline import PipelinePrefetcher
+from proxy.request_handling import RequestHandling
+from proxy import request_handling
 from proxy.request_reader import RequestReader
-from proxy.response_reader import ResponseReader
-import proxy.storage
+from proxy.resolver import get_resolver
+from proxy.response_reader import ResponseReader, ResponseRelay
+from proxy import tracing
+from proxy.tracing import RequestTrace
+
+BUF_SIZE = 4096
 
 class ProcData:
     """Data related to a single process. Those not process-safe variables are for parent process
@@ -32,17 +42,20 @@ class ProcData:
         self.process_name = None 
         #shared data
         self.status = multiprocessing.Value("i", ProcData.READY)
-        self.complete_req = multiprocessing.Value("i",0)
-        self.session_req = multiprocessing.Value("i",0)
-        self.failed_read_req = multiprocessing.Value("i",0)
+        #metrics.WorkerMetrics, the slot of the process in the shared metrics block
+        self.metrics = None
+        #client connections owned by an async worker process
+        self.connections = multiprocessing.Value("i",0)
         #the parent process use only variables
         self.process = None
         self.process_name = None
         #parent endpoint for sending data to child processes
         self.ipc_socket_parent = None
         self.client_sock = None
+        #time the process has been told to exit, see autoscaler
+        self.retire_time = None
 
-class ConnectionWorkerProcess:
+class ConnectionWorkerProcess(RequestHandling):
     """Handles one process. Get an IPC socket initially which is then used to retrieve 
     a client socket
     """
@@ -50,23 +63,32 @@ class ConnectionWorkerProcess:
         """Should be called from parent process"""
         self.is_init = False
 
-    def _init_this_process(self):
+    def _init_this_process(self, process_data, write_queue=None, log_queue=None):
         """Initialize process variables and determined storage type configured.
         Should be called in child process
+
+        process_data - ProcessData associated with this process
+        write_queue - multiprocessing.Queue of the cache writer processes or None
+        log_queue - multiprocessing.Queue of the log process or None
         """
         assert not self.is_init
         self.is_init = True
-        log_basic_config()
-        self._use_cache = ("True" == Config.value(Const.STORAGE_SECTION, "enable_cache"))
-        self._storage = None
+        self._init_handling(process_data, write_queue, log_queue)
+        #the resource fetch this process leads, see collapsed_forwarding
+        self._flight = None
+        self._prefetcher = None
+        #the pipelined data left after the request being handled
+        self._pipeline_tail = b""
+        self._pipeline_depth = 0
         self._client_sock = None 
         self._stdout_lock = None
-        self._proc_data = None
 
-        if self._use_cache:
-            self._storage = proxy.storage.get_storage()
+        fetch_ahead = PipelinePrefetcher.max_ahead_from_config()
+        if fetch_ahead:
+            self._prefetcher = PipelinePrefetcher.threaded(fetch_ahead, self._flights)
  
-    def __call__(self, process_data, ipc_socket, stdout_lock):
+    def __call__(self, process_data, ipc_socket, stdout_lock, listen_address=None,
+                 write_queue=None, log_queue=None):
         """Run this process wait loop and perform actual message transmission. Terminate
         on SIGINT. The process will run until application end and handle different client
         sockets when passed from the main process.
@@ -74,15 +96,23 @@ class ConnectionWorkerProcess:
         process_data - ProcessData associated with this process
         ipc_socket - unix socket to suck FDs from
         stdout_lock - limit access to STDOUT
+        listen_address - (ip, port), if given accept clients directly on own SO_REUSEPORT
+            listener instead of waiting for them on ipc_socket
+        write_queue - multiprocessing.Queue to hand the cache saves over to the writer
+            processes, None to save them in this process
+        log_queue - multiprocessing.Queue of the log process, None to write the log directly
         """
-        self._init_this_process()
+        self._init_this_process(process_data, write_queue, log_queue)
         self._stdout_lock = stdout_lock
-        self._proc_data = process_data
         proxy.logger.init_lock(stdout_lock)
 
         try:
-            self._do_work(ipc_socket)
+            if listen_address:
+                self._do_accept_work(listen_address)
+            else:
+                self._do_work(ipc_socket)
         except KeyboardInterrupt:
+            proc_state(get_resolver().summary())
             return
 
     def _do_work(self, ipc_socket):
@@ -93,18 +123,21 @@ class ConnectionWorkerProcess:
         ipc_socket - unix socket to suck FDs from
         """
 
-        proc_name = multiprocessing.current_process().name
-
         # Terminated by parent process on application exit
         while 1:
            proc_state("Wait fd")
            #will block here if no incoming sockets
-           self._client_sock = socket.fromfd(net.fd_from_socket(ipc_socket), socket.AF_INET, socket.SOCK_STREAM)
+           fd = net.fd_from_socket(ipc_socket)
+           if net.RETIRE == fd:
+               #the main process shrinks the pool, this one is idle
+               proc_state("Retired")
+               return
+           if fd is None:
+               continue
+           self._client_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, fileno=fd)
            proc_state("Got fd")
 
-           # recursion depth, shows the number of requests pipelined so far through this socket
-           self._pipeline_depth = 0
-           client_ok = self._handle_next_request()
+           client_ok = self._handle_client()
            established = net.is_connected(self._client_sock)
            self._client_sock.close()
 
@@ -114,51 +147,87 @@ class ConnectionWorkerProcess:
            else:
                # close client socket
                self._proc_data.status.value = ProcData.DONE_CLOSE
+           # wake the main process up, it waits for this on the same IPC socket
+           try:
+               ipc_socket.send(b"D")
+           except OSError as err:
+               proc_error("Done notification failed: %s" % str(err))
 
-    def _try_handle_more(self, pipeline_tail): 
-        """Continue reading pipelined requests if there is pending data being send by client
+    def _do_accept_work(self, listen_address):
+        """Accept client sockets on own listener and serve every one of them until it's closed
+        or stays idle longer than keep_alive_timeout. The main process is not involved.
 
-        pipeline_tail - part of this message already read as a tail of previous message 
-        return - True if socket is valid for further operation
+        listen_address - (ip, port)
         """
-        self._pipeline_depth += 1
-        if pipeline_tail:
-            return self._handle_next_request(pipeline_tail)
-        else:
-        #this function is only called for successful control-branches
-            return True
+        listener = net.bound_socket(*listen_address, reuse_port=True)
+        listener.listen(net.TCP_BACKLOG)
+        #this process has nothing else to do, block in accept()
+        listener.settimeout(None)
+        keep_alive_timeout = float(Config.value(Const.MAIN_SECTION, "keep_alive_timeout"))
 
-    def _log_code(self, code, comment):
-        """Log a message code instead of a full message. Usable to fit many messages in one row
-        Add process name and reucrsion depth if applicable
-        
-        code - text to output
-        comment - not used
+        # Terminated by parent process on application exit
+        while 1:
+            proc_state("Wait accept")
+            self._client_sock, addr = listener.accept()
+            self._proc_data.status.value = ProcData.ACTIVE
+            proc_state("Accepted")
+
+            while 1:
+                client_ok = self._handle_client()
+                if not client_ok or not net.is_connected(self._client_sock):
+                    break
+                #wait for the next keep-alive request
+                readable, _, _ = select.select([self._client_sock], [], [], keep_alive_timeout)
+                if not readable:
+                    break
+
+            net.shutdown(self._client_sock)
+            self._proc_data.status.value = ProcData.READY
+
+    def _handle_client(self):
+        """Handle the requests the client has sent, the pipelined ones one by one in their order
+
+        return - bool, False - done working with this FD, True - wait more data on select
         """
-        proc_name = multiprocessing.current_process().name
-        if 0 != self._pipeline_depth:
-            message_f = "%s:%s " % (proc_name, code)
-        else:
-            message_f = "%s:P%i:%s " % (proc_name, self._pipeline_depth, code)
-        log(message_f)
+        # shows the number of requests pipelined so far through this socket
+        self._pipeline_depth = 0
+        self._pipeline_tail = b""
+        try:
+            client_ok = self._handle_next_request()
+            while client_ok and self._pipeline_tail:
+                self._pipeline_depth += 1
+                pipeline_tail, self._pipeline_tail = self._pipeline_tail, b""
+                client_ok = self._handle_next_request(pipeline_tail)
+            return client_ok
+        finally:
+            self._pipeline_tail = b""
+            self._land_flight()
+            if self._prefetcher:
+                self._prefetcher.clear()
+
+    def _log_tag(self):
+        """Add pipeline depth if applicable"""
+        return "" if 0 == self._pipeline_depth else "P%i:" % self._pipeline_depth
 
     def _handle_next_request(self, pipeline_tail=b""):
-        """Support GET and CONNECT methods. Call the same method recursively to read more data
-        on the same client socket, until it stops sending or error occurs.
+        """Support GET and CONNECT methods. Read one request from the client socket and handle
+        it; the pipelined data read after it is left for the next call in _pipeline_tail.
        
         pipeline_tail - next message head chunk; when reading the current message,
             the next message data can be also read partially when pipelining
-        pipeline_depth - recursion depth for this pipeline
         return - bool, False - done working with this FD, True - wait more data on select
         """
 
         if not self._client_sock:
-            _log_code("NCS", "No client socket")
+            self._log_code("NCS", "No client socket")
             return False
 
         proc_state("Readclient")
         #get the request from client
+        started = time.monotonic()
         request = RequestReader(self._client_sock, pipeline_tail)                
+        request.trace = RequestTrace(started)
+        request.trace.add(tracing.CLIENT_READ, request.received - started)
 
         if not request.ok: 
             if request.timeout:
@@ -168,143 +237,353 @@ class ConnectionWorkerProcess:
                 net.send_all(self._client_sock, Response.RESPONSE_408)
             else:
                 #failed to read the request completely
-                self._log_code("XX", "Request parse error")
-                with self._proc_data.failed_read_req.get_lock():
-                    self._proc_data.failed_read_req.value += 1
-                with self._proc_data.session_req.get_lock():
-                    self._proc_data.session_req.value  += 1
-                net.send_all(self._client_sock, Response.RESPONSE_400)
+                net.send_all(self._client_sock, self._bad_request())
             return False
-        with self._proc_data.session_req.get_lock():
-            self._proc_data.session_req.value  += 1
+        self._metrics.count("requests")
 
         if RequestReader.OTHER == request.method:
             self._do_OTHER(request)
             return False
         elif RequestReader.CONNECT == request.method:
-            self._do_CONNECT()
+            self._do_CONNECT(request)
             return False
         elif RequestReader.GET == request.method:
-            return self._do_GET(request, pipeline_tail)
+            prefetched, flight = None, None
+            if self._prefetcher:
+                prefetched, flight = self._prefetcher.take(request)
+                self._fetch_ahead(request)
+            client_ok = self._do_GET(request, pipeline_tail, prefetched, flight)
+            #the response has been saved by now
+            self._land_flight()
+            if client_ok:
+                #partially read next message -> continue reading this socket
+                self._pipeline_tail = request.tail
+            self._finish_trace(request)
+            return client_ok
+
+    def _fetch_ahead(self, request):
+        """Read what else the client has pipelined after the request and start fetching the
+        complete requests which aren't cached
+
+        request - RequestReader, its tail gets the data read
+        """
+        for ahead in self._pipelined(self._client_sock, request):
+            if (self._use_cache and self._storage
+                    and CachePolicy.MISS != self._policy.lookup(ahead.cache_location, ahead.header)):
+                continue
+            self._prefetcher.start(ahead)
 
-    def _do_GET(self, request, pipeline_tail):            
+    def _do_GET(self, request, pipeline_tail, prefetched=None, flight=None):            
         """Get a request from client, pass to orig server then in case of success
         pass response back to client and cache the response, if needed. Inform client
         on errors.
 
         request - RequestReader
         pipeline_tail - data already read, to be joined with newly read data
+        prefetched - future of the origin response fetched ahead or None, see pipeline
+        flight - Flight led since the fetch ahead or None
         """
-        _log_code = self._log_code
-        #supporting persistent connection with the client but the server connection is single-use
-        #so change keep-alive to close
-        # Don't pass client "Connection" to origin server, according to HTTP Spec 14.10 (Header Field Definitions: Connection)
-        request_message = set_keep_alive(request.message, len(request.header), keep_alive=False)
+        request_message = self._origin_request(request)
 
         cache_location = request.cache_location
+        trace = request.trace
+        #landed by the caller
+        self._flight = flight
         if self._use_cache and self._storage:
-            haskey, time_loaded = self._storage.haskey_time(cache_location)
-            if haskey:
-                loaded_ago = time.time() - time_loaded
-                if loaded_ago > float(Config.value(Const.STORAGE_SECTION, "cache_discard_after")):
-                    self._storage.erase(cache_location)
-                else:
-                    outputData = self._storage.fetch(cache_location)
-                    if not outputData:
-                        #data is being written by another process or read error
-                        net.send_all(self._client_sock, Response.RESPONSE_500)
-                        return False
-
-                    if net.send_all(self._client_sock, add_ok_status(outputData)):
-                        _log_code("C", "Sent from cache")
-                        with self._proc_data.complete_req.get_lock():
-                            self._proc_data.complete_req.value += 1
-                        #successful reply from cache -> continue with the same socket
-                        return self._try_handle_more(request.tail)
-                    else:
-                        #failed to send cache reply
-                        _log_code("CX", "Fail to send from cache")
-                        return False
+            with trace.phase(tracing.CACHE_LOOKUP):
+                state = self._policy.lookup(cache_location, request.header)
+            if self._needs_flight(state, self._flight):
+                state = self._join_flight(cache_location, request.header)
+            cached = None
+            if CachePolicy.STALE_REVALIDATE == state:
+                #serve the stale copy at once, the origin server is asked meanwhile
+                with trace.phase(tracing.CACHE_LOOKUP):
+                    cached = self._storage.fetch(cache_location)
+                if self._refresh_behind(request, cached):
+                    state = CachePolicy.FRESH
+            if CachePolicy.FRESH == state:
+                sent = self._send_cached(request, cached)
+                if sent is None:
+                    #removed meanwhile or read error, get it from the origin server
+                    self._log_code("CE", "Cached resource unavailable")
+                    return self._forward(request, request_message, prefetched=prefetched)
+                #successful reply from cache -> continue with the same socket
+                return self._cache_sent(request, sent, "C" if cached is None else "CW",
+                                        "Sent from cache")
+            elif state in (CachePolicy.STALE_IF_ERROR, CachePolicy.STALE):
+                with trace.phase(tracing.CACHE_LOOKUP):
+                    cached = self._storage.fetch(cache_location)
+                revalidation = self._revalidation(request_message, cached, state)
+                if revalidation:
+                    conditional, stale_if_error = revalidation
+                    return self._forward(request, conditional, cached=cached,
+                                         stale_if_error=stale_if_error)
 
         #file not found in cache  -sending request to the destination server
-        host = request.hostname
+        return self._forward(request, request_message, prefetched=prefetched)
+
+    def _join_flight(self, cache_location, request_header):
+        """Lead the fetch of the resource or wait for the process which leads it
+
+        return - CachePolicy state of the resource after that
+        """
+        flight = self._flights.join(cache_location)
+        if not flight.leader:
+            proc_state("Waitflight")
+            if not flight.wait(self._flights.wait_timeout, self._flights.poll_interval):
+                #fetch it independently
+                self._log_code("FW", "Collapsed forwarding wait timeout")
+            return self._policy.lookup(cache_location, request_header)
+        state = self._policy.lookup(cache_location, request_header)
+        self._flight = self._lead_flight(flight, state)
+        return state
+
+    def _land_flight(self):
+        """Let the processes waiting for the resource fetched by this one go on"""
+        if self._flight:
+            self._flight.release()
+            self._flight = None
+
+    def _send_cached(self, request, cached=None):
+        """Send the cached resource to client, with sendfile if the storage keeps it in a file
+
+        request - RequestReader
+        cached - bytes, the resource if it has been fetched already
+        return - bool, True if sent; None if the resource can't be read
+        """
+        trace = request.trace
+        if cached is None:
+            opened = None
+            if not freshness.is_conditional(request.header):
+                with trace.phase(tracing.CACHE_LOOKUP):
+                    opened = self._open_cached(request.cache_location,
+                                               not compression.accepts_gzip(request.header))
+            if opened:
+                trace.status = Const.HTTP_OK
+                with trace.phase(tracing.CLIENT_SEND):
+                    return self._count_sent(request, net.send_file(self._client_sock, Response.STATUS_200,
+                                                          opened),
+                                            len(Response.STATUS_200) + opened[2])
+            with trace.phase(tracing.CACHE_LOOKUP):
+                cached = self._storage.fetch(request.cache_location)
+            if not cached:
+                return None
+        response = self._cached_response(request, cached)
+        if response is None:
+            return None
+        with trace.phase(tracing.CLIENT_SEND):
+            return self._count_sent(request, net.send_all(self._client_sock, response), len(response))
+
+    def _send_to_origin(self, host, request_message, reuse):
+        """Send the request over a pooled connection to the origin server or a new one
+
+        host - bytes, "host[:port]"
+        request_message - bytes
+        reuse - bool, try a pooled connection first
+        return - (socket or None on failure, bool - the connection is a pooled one)
+        """
+        if self._pool and reuse:
+            origin_srv = self._pool.get(host)
+            if origin_srv:
+                if net.send_all(origin_srv, request_message):
+                    return origin_srv, True
+                self._pool.put(host, origin_srv, False)
+
         origin_srv = net.connected_socket(host, timeout=20)
+        if not origin_srv:
+            return None, False
+        if self._pool:
+            self._pool.opened(host)
+        if not net.send_all(origin_srv, request_message):
+            self._release_origin(host, origin_srv, False)
+            return None, False
+        return origin_srv, False
+
+    def _forward(self, request, request_message, reuse=True, cached=None, stale_if_error=False,
+                 prefetched=None):
+        """Pass the request to the origin server and the response back to client. Cache it, if needed
+
+        request - RequestReader
+        request_message - bytes, the request to send
+        reuse - bool, allow a pooled origin connection
+        cached - bytes, the stale cached resource request_message revalidates; it's served if
+            the origin server replies 304 Not Modified
+        stale_if_error - bool, serve cached if the origin server fails or replies 5xx
+        prefetched - future of the origin response fetched ahead or None; the request is sent
+            again if that has failed
+        """
+        host = request.hostname
+        trace = request.trace
         proc_state("Recsrv")
-        if not origin_srv or not net.send_all(origin_srv, request_message):
+        with trace.phase(tracing.ORIGIN_READ):
+            response = prefetched.result() if prefetched else None
+        reused = False
+        if response and response.ok:
+            self._log_code("A", "Fetched ahead")
+        else:
+            response = None
+            with trace.phase(tracing.ORIGIN_CONNECT):
+                origin_srv, reused = self._send_to_origin(host, request_message, reuse)
             if origin_srv:
-                origin_srv.close()
-            #origin server request sending failed
-            _log_code("RX", "Origin server communication failed")
-            net.send_all(self._client_sock, Response.RESPONSE_502)
-            return self._try_handle_more(request.tail)
-        response = ResponseReader(origin_srv)
+                if self._stream_responses and cached is None:
+                    return self._relay_response(origin_srv, request, request_message, reused)
+                with trace.phase(tracing.ORIGIN_READ):
+                    response = ResponseReader(origin_srv)
+                self._release_origin(host, origin_srv, response.reusable)
 
         proc_state("Readsrv")
+        outcome = self._origin_outcome(response, reused, cached, stale_if_error)
+        if request_handling.RETRY == outcome:
+            return self._forward(request, request_message, reuse=False, cached=cached,
+                                 stale_if_error=stale_if_error)
+        if request_handling.STALE == outcome:
+            return self._serve_stale(request, cached)
+        if request_handling.REVALIDATED == outcome:
+            return self._serve_revalidated(request, response, cached)
+        if request_handling.SEND != outcome:
+            return self._send_error(request, outcome)
+
         #we expect client to keep sending pipelined requests
         response_message = set_keep_alive(response.message, len(response.header), keep_alive=True)
-        response_message_cache = set_keep_alive(response.response_data, len(response.header), keep_alive=True)
+        proc_state("Sendclient")                
+        with trace.phase(tracing.CLIENT_SEND):
+            sent = net.send_all(self._client_sock, response_message)
+        if not self._origin_sent(request, sent, response.response_status, len(response_message)):
+            return False
 
-        net.shutdown(origin_srv)
+        if self._cacheable(response.response_status):
+            response_message_cache = set_keep_alive(response.response_data, len(response.header),
+                                                    keep_alive=True)
+            with trace.phase(tracing.CACHE_WRITE):
+                saved = self._policy.save(request.cache_location, response.header,
+                                          response_message_cache)
+            if not saved:
+                #cache write fail                           
+                self._log_code("CSX", "Cache write fail")
+        return True
+
+    def _send_error(self, request, outcome):
+        """Tell client the origin server has failed
+
+        outcome - request_handling.BAD_GATEWAY or GATEWAY_TIMEOUT
+        return - bool, True if the client connection can be used further
+        """
+        if not net.send_all(self._client_sock, self._gateway_error(request, outcome)):
+            #failed to deliver error response to client
+            self._log_code("RRX", "Client err response send failed")
+            return False
+        return request_handling.BAD_GATEWAY == outcome
 
-        if not response.ok:
-           if response.timeout:
-               #empty response connection is shutdown
-               _log_code("RX", "Origin response time out")
-           else:
-               #server stopped transferring in the middle
-               _log_code("RXX", "Origin truncated response")
-           if not net.send_all(self._client_sock, Response.RESPONSE_504):
-               #failed to deliver error response to client
-               _log_code("RRX", "Client err response send failed")
-           return False
+    def _serve_revalidated(self, request, response, cached):
+        """The origin server has replied 304 Not Modified to the revalidation request: refresh
+        the cached copy and serve it
 
-        proc_state("Sendclient")                
-        if not net.send_all(self._client_sock, response_message):
-            #failed sending to client
-            _log_code("TX", "Client ok response send failed")
-            return False
-        #successful response delivery
-        _log_code("T", "Client response send success")
-        with self._proc_data.complete_req.get_lock():
-            self._proc_data.complete_req.value  += 1
+        request - RequestReader
+        response - ResponseReader, the 304 response
+        cached - bytes, the cached resource
+        """
+        with request.trace.phase(tracing.CACHE_WRITE):
+            self._policy.refresh(request.cache_location, cached, response.header)
+        return self._cache_sent(request, self._send_cached(request, cached), "CV",
+                                "Revalidated, sent from cache")
 
-        if self._use_cache and self._storage:
-            if Const.HTTP_OK == response.response_status:
-                    haskey, ts = self._storage.haskey_time(cache_location)
-                    if not haskey:
-                       if not self._storage.save(cache_location, response_message_cache): 
-                           #cache write fail                           
-                           _log_code("CSX", "Cache write fail")
-            else:
-                #not saving non-success response                
-                _log_code("S+" + str(response.response_status), "Non-ok from origin")
-        
-        #partially read next message -> continue reading this socket
-        return self._try_handle_more(request.tail)
+    def _serve_stale(self, request, cached):
+        """The origin server has failed to revalidate the cached resource, serve it as it is
 
-    def _do_OTHER(self, request):            
-        """Handle unsupported method/protocol
-        
         request - RequestReader
+        cached - bytes, the cached resource
         """
-        self._log_code("XXX {}".format(request.method_str), "Unsupported method")
-        net.send_all(self._client_sock, Response.RESPONSE_501)
-        proc_name = multiprocessing.current_process().name
-        with self._proc_data.failed_read_req.get_lock():
-            self._proc_data.failed_read_req.value += 1
-           
-    def _do_CONNECT(self):
-        """Open tunnel from one socket to another. Dispose sockets after done"""
-        orig_sock = net.connected_socket(request.hostname)
-        if orig_sock:
-            net.send_all(self._client_sock, Response.RESPONSE_200)
-            net.tunnel(orig_sock, self._client_sock)                
-        else:
-            net.send_all(self._client_sock, Response.RESPONSE_502)
+        return self._cache_sent(request, self._send_cached(request, cached), "CS",
+                                "Origin failed, stale sent from cache")
 
-            net.shutdown(orig_sock)
+    def _relay_response(self, origin_srv, request, request_message, reused):
+        """Pass the origin response to client as soon as it arrives, writing it into the cache
+        at the same time. The cached copy is committed only if the whole response has come.
 
+        origin_srv - socket the request has been sent to
+        request - RequestReader
+        request_message - bytes, the request sent, to repeat it if a pooled connection is dead
+        reused - bool, origin_srv is a pooled connection
+        """
+        host = request.hostname
+        relay = ResponseRelay(self._relay_writer(request))
 
+        proc_state("Readsrv")
+        trace = request.trace
+        buf = bytearray(BUF_SIZE)
+        view = memoryview(buf)
+        received = 0
+        while not relay.done and not relay.error:
+            started = time.monotonic()
+            try:
+                size = origin_srv.recv_into(view)
+            except OSError as errv:
+                proc_error("Origin read failed %s " % str(errv))
+                break
+            read = time.monotonic()
+            trace.add(tracing.ORIGIN_READ, read - started)
+            if not size:
+                break
+            received += size
+            #the piece is written into the cache while fed
+            data = relay.feed(view[:size])
+            fed = time.monotonic()
+            trace.add(tracing.CACHE_WRITE, fed - read)
+            sent = not data or net.send_all(self._client_sock, data)
+            trace.add(tracing.CLIENT_SEND, time.monotonic() - fed)
+            if not sent:
+                self._metrics.count("bytes_in", received)
+                self._origin_sent(request, False, relay.response_status)
+                relay.finish()
+                self._release_origin(host, origin_srv, False)
+                return False
+            if data:
+                self._count_out(request, len(data))
+        self._release_origin(host, origin_srv, relay.reusable)
+
+        outcome = self._relay_outcome(relay, received, reused)
+        if request_handling.SEND != outcome:
+            relay.finish()
+            if request_handling.RETRY == outcome:
+                return self._forward(request, request_message, reuse=False)
+            if request_handling.TRUNCATED == outcome:
+                return False
+            self._send_error(request, outcome)
+            return False
 
+        self._origin_sent(request, True, relay.response_status)
+        if self._cacheable(relay.response_status) and relay.caching:
+            with trace.phase(tracing.CACHE_WRITE):
+                saved = relay.finish()
+            if not saved:
+                self._log_code("CSX", "Cache write fail")
+        return True
 
+    def _do_OTHER(self, request):            
+        """Handle unsupported method/protocol
+        
+        request - RequestReader
+        """
+        net.send_all(self._client_sock, self._unsupported(request))
+           
+    def _do_CONNECT(self, request):
+        """Open tunnel from client to the origin server and pipe data both ways until done.
+        Dispose the origin socket after done
 
+        request - RequestReader
+        """
+        orig_sock = net.connected_socket(request.hostname, timeout=20)
+        get_resolver().publish(self._metrics)
+        if not orig_sock:
+            net.send_all(self._client_sock, self._tunnel_failed())
+            return
+        try:
+            if not net.send_all(self._client_sock, Response.CONNECTION_ESTABLISHED):
+                return
+            #the client may have sent the tunnel data without waiting for the reply
+            if request.tail and not net.send_all(orig_sock, request.tail):
+                return
+            self._log_code("JS", "Tunnel start")
+            self._tunnel_done(*net.tunnel(self._client_sock, orig_sock, self._tunnel_idle_timeout))
+        finally:
+            orig_sock.close()
@@ -9,6 +9,21 @@ Notes:
 class Const:
     STORAGE_SECTION = "Storage"
     MAIN_SECTION = "General"
+    UPSTREAM_SECTION = "Upstream"
+    RESOLVER_SECTION = "Resolver"
+    HOT_CACHE_SECTION = "HotCache"
+    CACHE_INDEX_SECTION = "CacheIndex"
+    EVICTION_SECTION = "Eviction"
+    COLLAPSED_FORWARDING_SECTION = "CollapsedForwarding"
+    WRITE_BEHIND_SECTION = "WriteBehind"
+    COMPRESSION_SECTION = "Compression"
+    AUTOSCALE_SECTION = "Autoscale"
+    METRICS_SECTION = "Metrics"
+    LOGGING_SECTION = "Logging"
     CONSOLE_LOGGER = "console"
     HTTP_OK = 200
+    HTTP_NOT_MODIFIED = 304
+    HTTP_SERVER_ERROR = 500
+    HTTP_BAD_GATEWAY = 502
+    HTTP_GATEWAY_TIMEOUT = 504
 
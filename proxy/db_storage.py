@@ -1,128 +1,618 @@
-""" 
-Updated: 2016
+"""
+Updated: 2017
 Author: Sergei Shliakhtin
 Contact: xxx.serj@gmail.com
 Notes: Database storage for cached data
-"""
 
+The resources are kept in one table with the stored and expiry times as epoch seconds and the
+key hash (see cache_index.key_hash()) indexed for the sweeper. All the statements are prepared
+once per connection and run in autocommit mode. A lookup returns the times and the content at
+once, the content is kept for the fetch which follows it.
 
-from logging import WARNING
-from psycopg2 import connect, Binary, DatabaseError, ProgrammingError, IntegrityError, OperationalError
-from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+The content is split into db_chunk_size chunks: the first one is kept in the resource row, the
+rest in resource_chunks, so that neither a worker nor the database client holds a large
+resource whole. They're stored as they come from the origin server and sent to client one by
+one. Every write of a resource is a new generation of its chunks; the resource row upsert
+on commit switches the readers over to it and removes the chunks of the older generations. The
+upsert is skipped if a later generation is current already or the chunks of the write have
+been removed meanwhile, by a later commit or an erase; such a write is given up.
+
+The connections of a worker process, its background refresh threads included, are taken from
+one pool of at most db_pool_size connections, so the database sees at most that many per
+worker. Put a pooler like pgbouncer in front of it for more.
+
+The driver is any DB-API module with psycopg2 connect() arguments and format parameters,
+psycopg2 by default; a stand-in can be passed for testing.
+"""
+
+import io
+import threading
 import time
 
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+from logging import WARNING
+from proxy import ProxyException
 from proxy import encoding
+from proxy.cache_index import index_key, key_hash
 from proxy.logger import proc_error, log
 from proxy.config import Config
 from proxy.const import Const
 
-def _connect(db_name):
-        return connect("host=%s port=%s dbname=%s user=%s password=%s" % 
-            (Config.value(Const.STORAGE_SECTION, "host"),
-             Config.value(Const.STORAGE_SECTION, "port"),
-             db_name,
-             Config.value(Const.STORAGE_SECTION, "user"),
-             Config.value(Const.STORAGE_SECTION, "password")))
+DB_NAME = "proxy_cache"
+# (name, argument types, statement)
+_STATEMENTS = (
+    ("rarog_lookup", "(text)", "SELECT stored, expiry, content, size, chunk_size, generation "
+     "FROM resources WHERE url = $1"),
+    ("rarog_chunk", "(text, bigint, integer)", "SELECT data FROM resource_chunks "
+     "WHERE url = $1 AND generation = $2 AND seq = $3"),
+    ("rarog_chunks", "(text, bigint)", "SELECT data FROM resource_chunks "
+     "WHERE url = $1 AND generation = $2 ORDER BY seq"),
+    ("rarog_put_chunk", "(text, bigint, integer, bytea)", "INSERT INTO resource_chunks "
+     "(url, generation, seq, data) VALUES ($1, $2, $3, $4)"),
+    # $9 is the number of the chunks of the write in resource_chunks
+    ("rarog_save", "(text, bigint, double precision, double precision, bigint, integer, bigint, "
+     "bytea, integer)", "INSERT INTO resources (url, key_hash, stored, expiry, size, chunk_size, "
+     "generation, content) SELECT $1, $2, $3, $4, $5, $6, $7, $8 WHERE (SELECT count(*) "
+     "FROM resource_chunks WHERE url = $1 AND generation = $7) = $9 ON CONFLICT (url) DO UPDATE "
+     "SET key_hash = EXCLUDED.key_hash, stored = EXCLUDED.stored, expiry = EXCLUDED.expiry, "
+     "size = EXCLUDED.size, chunk_size = EXCLUDED.chunk_size, "
+     "generation = EXCLUDED.generation, content = EXCLUDED.content "
+     "WHERE resources.generation < EXCLUDED.generation"),
+    # the chunks of the replaced copy and of the writes started before, which can't be
+    # committed any more
+    ("rarog_drop_old_chunks", "(text, bigint)", "DELETE FROM resource_chunks "
+     "WHERE url = $1 AND generation < $2"),
+    ("rarog_drop_chunks", "(text, bigint)", "DELETE FROM resource_chunks "
+     "WHERE url = $1 AND generation = $2"),
+    ("rarog_erase", "(text)", "WITH gone AS (DELETE FROM resources WHERE url = $1 RETURNING url) "
+     "DELETE FROM resource_chunks WHERE url IN (SELECT url FROM gone)"),
+    ("rarog_erase_hashes", "(bigint[])", "WITH gone AS (DELETE FROM resources "
+     "WHERE key_hash = ANY($1) RETURNING url), chunks AS (DELETE FROM resource_chunks "
+     "WHERE url IN (SELECT url FROM gone)) SELECT count(*) FROM gone"),
+)
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS resources (url TEXT PRIMARY KEY, key_hash BIGINT NOT NULL, "
+    "stored DOUBLE PRECISION NOT NULL, expiry DOUBLE PRECISION NOT NULL DEFAULT 0, "
+    "content BYTEA NOT NULL)",
+    # the first chunk is kept in content, the rest in resource_chunks
+    "ALTER TABLE resources ADD COLUMN IF NOT EXISTS size BIGINT NOT NULL DEFAULT 0",
+    "ALTER TABLE resources ADD COLUMN IF NOT EXISTS chunk_size INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE resources ADD COLUMN IF NOT EXISTS generation BIGINT NOT NULL DEFAULT 0",
+    "CREATE INDEX IF NOT EXISTS resources_key_hash ON resources (key_hash)",
+    "CREATE INDEX IF NOT EXISTS resources_expiry ON resources (expiry)",
+    "CREATE TABLE IF NOT EXISTS resource_chunks (url TEXT NOT NULL, generation BIGINT NOT NULL, "
+    "seq INTEGER NOT NULL, data BYTEA NOT NULL, PRIMARY KEY (url, generation, seq))",
+)
+# chunks left by the writers which have died in the middle
+_ORPHAN_CHUNKS = ("DELETE FROM resource_chunks c WHERE NOT EXISTS (SELECT 1 FROM resources r "
+                  "WHERE r.url = c.url AND r.generation = c.generation)")
+# the table of the previous format, with text timestamps
+_OLD_TABLE = "files"
 
-class DBStorage:
-    TIME_FORMAT = "%H:%M:%S %b %d %Y"
-    DB_NAME = "proxy_cache"
+def _driver(driver):
+    """return - the DB-API module to use"""
+    driver = driver or psycopg2
+    if driver is None:
+        raise ProxyException("DB storage needs psycopg2")
+    return driver
+
+def _connect(driver, db_name):
+    return driver.connect(host=Config.value(Const.STORAGE_SECTION, "host"),
+                          port=Config.value(Const.STORAGE_SECTION, "port"),
+                          dbname=db_name,
+                          user=Config.value(Const.STORAGE_SECTION, "user"),
+                          password=Config.value(Const.STORAGE_SECTION, "password"))
+
+def _signed(hash_value):
+    """Key hash as BIGINT"""
+    return hash_value - (1 << 64) if hash_value >= (1 << 63) else hash_value
 
-    def __init__(self):
-        self._conn = _connect(DBStorage.DB_NAME)
+def _run(cur, statement, args):
+    """Execute a prepared statement
 
-    def __del__(self):
-        if hasattr(self, '_conn'):
-            self._conn.close()
+    statement - str, name from _STATEMENTS
+    args - tuple of the arguments
+    """
+    cur.execute("EXECUTE %s (%s)" % (statement, ", ".join(["%s"] * len(args))), args)
+
+class ConnectionPool:
+    """Database connections of one process, at most size of them open at a time. A connection
+    is taken out of the pool for a statement and put back after it
+    """
+
+    def __init__(self, driver, size):
+        """
+        driver - DB-API module
+        size - int, connections open at most, a thread waits for one beyond that
+        """
+        self._driver = driver
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Check out an idle connection or open a new one, waiting if the limit is reached
+
+        return - connection with the statements prepared; put() it back in any case
+        """
+        self._slots.acquire()
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is not None:
+            return conn
+        try:
+            conn = _connect(self._driver, DB_NAME)
+        except BaseException:
+            self._slots.release()
+            raise
+        try:
+            conn.autocommit = True
+            cur = conn.cursor()
+            try:
+                for name, types, statement in _STATEMENTS:
+                    cur.execute("PREPARE %s %s AS %s" % (name, types, statement))
+            finally:
+                cur.close()
+        except BaseException:
+            self.put(conn, False)
+            raise
+        return conn
+
+    def put(self, conn, reusable):
+        """Return a connection after use
+
+        reusable - bool, False if it has failed and should be closed
+        """
+        if reusable:
+            with self._lock:
+                self._idle.append(conn)
+        else:
+            try:
+                conn.close()
+            except self._driver.Error:
+                pass
+        self._slots.release()
+
+__pools = {}
+__pools_lock = threading.Lock()
+
+def get_pool(driver):
+    """return - the ConnectionPool of this process for the driver"""
+    with __pools_lock:
+        pool = __pools.get(driver)
+        if pool is None:
+            pool = ConnectionPool(driver, int(Config.value(Const.STORAGE_SECTION, "db_pool_size")))
+            __pools[driver] = pool
+        return pool
+
+class DBStorage:
+
+    def __init__(self, driver=None):
+        """driver - DB-API module, psycopg2 if None"""
+        self._driver = _driver(driver)
+        self._pool = get_pool(self._driver)
+        self._chunk_size = int(Config.value(Const.STORAGE_SECTION, "db_chunk_size"))
+        # (key, (stored, expiry, content)) of the last lookup, for the fetch which follows
+        self._last_key = None
+        self._last = None
 
     @staticmethod
-    def check_init_db():
-        """Checks if can connect to proxy_cache and creates the DB and the files table"""
+    def check_init_db(driver=None):
+        """Checks if can connect to proxy_cache and creates the DB and the resources table"""
+        driver = _driver(driver)
+        try:
+            conn = _connect(driver, DB_NAME)
+        except driver.OperationalError as errv:
+            log("Cannot connect to the database. Trying to create the database\n ", WARNING)
+            DBStorage._init_db(driver)
+            conn = _connect(driver, DB_NAME)
         try:
-            conn = _connect(DBStorage.DB_NAME)
-        except OperationalError as errv:
-            log("Cannot connect to the database. Trying to create the database\n ", WARNING) 
-            DBStorage._init_db()
+            DBStorage._init_schema(driver, conn)
         finally:
-            if 'conn' in locals(): 
-                conn.close()
+            conn.close()
 
-    def _init_db():
-        conn = DBStorage._connect("postgres")
-        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+    @staticmethod
+    def _init_db(driver):
+        conn = _connect(driver, "postgres")
+        conn.autocommit = True
         cur = conn.cursor()
-        query = "CREATE DATABASE " + DBStorage.DB_NAME # no quotes for this command
-        cur.execute(query)
-        conn.commit()
-        cur.close()
-        conn.close()
+        try:
+            cur.execute("CREATE DATABASE " + DB_NAME) # no quotes for this command
+        finally:
+            cur.close()
+            conn.close()
+        log("Initialized new database\n ", WARNING)
 
-        conn = DBStorage._connect(DBStorage.DB_NAME)
+    @staticmethod
+    def _init_schema(driver, conn):
+        conn.autocommit = True
         cur = conn.cursor()
         try:
-            cur.execute("CREATE TABLE files (url TEXT PRIMARY KEY, timestamp TEXT, content BYTEA) ; ")
-        except DatabaseError as errv:
+            cur.execute("SELECT to_regclass(%s)", (_OLD_TABLE,))
+            if cur.fetchone()[0] is not None:
+                # cached copies only, they're fetched again on demand
+                log("Dropping the cache table of the previous format\n ", WARNING)
+                cur.execute("DROP TABLE " + _OLD_TABLE)
+            for statement in _SCHEMA:
+                cur.execute(statement)
+        except driver.DatabaseError as errv:
             proc_error("DB create table failed: %s" % str(errv))
+        finally:
+            cur.close()
 
-        conn.commit()
-        cur.close()
-        conn.close()
-        log("Initialized new database\n ", WARNING) 
+    def migrate(self):
+        """Remove the chunks of the writes which haven't finished. Should be called before
+        the workers start"""
+        conn = self._pool.get()
+        try:
+            cur = conn.cursor()
+            try:
+                cur.execute(_ORPHAN_CHUNKS)
+                if cur.rowcount:
+                    log("Removed %i chunks of unfinished writes" % cur.rowcount)
+            finally:
+                cur.close()
+        except self._driver.DatabaseError as errv:
+            proc_error("DB cleanup failed: %s" % str(errv))
+        finally:
+            self._pool.put(conn, True)
+
+    def _execute(self, statement, args, fetch=None):
+        """Run a prepared statement on a pooled connection
+
+        statement - str, name from _STATEMENTS
+        args - tuple of the arguments
+        fetch - None, "fetchone" or "fetchall", the cursor method to get the result with
+        return - the fetched result; int row count if fetch is None
+        raises driver.DatabaseError
+        """
+        conn = self._pool.get()
+        reusable = False
+        try:
+            cur = conn.cursor()
+            try:
+                _run(cur, statement, args)
+                result = getattr(cur, fetch)() if fetch else cur.rowcount
+            finally:
+                cur.close()
+            reusable = True
+            return result
+        except self._driver.DatabaseError as errv:
+            # the connection may be broken
+            reusable = not isinstance(errv, self._driver.OperationalError)
+            raise
+        finally:
+            self._pool.put(conn, reusable)
+
+    def _lookup(self, key_path):
+        """Find the resource, it's kept for the fetch which follows
 
-    def save(self, key_path, data):
-        cur = self._conn.cursor()
+        return - (float stored time, float expiry time, first chunk, int size, int chunk size,
+            int generation) or None if not found
+        """
+        self._last_key, self._last = None, None
         try:
-            timestamp = time.strftime(DBStorage.TIME_FORMAT)
-            spath = encoding.to_str(key_path)
-            cur.execute("INSERT INTO files (url, timestamp, content) VALUES (%s, %s, %s);",
-               (spath, timestamp, Binary(data)))
+            row = self._execute("rarog_lookup", (encoding.to_str(key_path),), "fetchone")
+        except self._driver.DatabaseError as errv:
+            proc_error("DB read failed: %s" % str(errv))
+            return None
+        if row:
+            self._last_key, self._last = key_path, row
+        return row
+
+    def _found(self, key_path):
+        """return - _lookup() result, the kept one if it's for the same resource"""
+        return self._last if key_path == self._last_key else self._lookup(key_path)
+
+    def read_chunk(self, url, generation, number):
+        """url - str
+        generation - int, the write the chunk belongs to
+        number - int, 1 and on, the first one is kept with the resource
+        return - bytes or None if it's missing
+        """
+        try:
+            row = self._execute("rarog_chunk", (url, generation, number), "fetchone")
+        except self._driver.DatabaseError as errv:
+            proc_error("DB read failed: %s" % str(errv))
+            return None
+        return bytes(row[0]) if row else None
+
+    def put_chunk(self, url, generation, number, data):
+        """return - bool, True if stored"""
+        try:
+            self._execute("rarog_put_chunk", (url, generation, number, self._driver.Binary(data)))
             return True
-        except IntegrityError as errv: #key already exists
-            pass 
-        except DatabaseError as errv:
+        except self._driver.DatabaseError as errv:
             proc_error("DB write failed: %s" % str(errv))
             return False
-        finally:
-            self._conn.commit()
-            cur.close()
 
-    def _fetch_col(self, column, key_path):
-        cur = self._conn.cursor()
-        try:
-            str_path = encoding.to_str(key_path)
-            #insert col name without quotes
-            query = "SELECT %s FROM files WHERE url = " % (column,)
-            query += "%s ;"
-            #insert url value with quotes 
-            cur.execute(query, (str_path,))
-            vals = cur.fetchone()
-            if None == vals:
-                return None
-            return vals[0]
-        except DatabaseError as errv:
-            proc_error("DB read failed: %s" % str(errv))
+    def drop_chunks(self, url, generation):
+        """Remove the chunks of a write given up"""
+        try:
+            self._execute("rarog_drop_chunks", (url, generation))
+        except self._driver.DatabaseError as errv:
+            proc_error("DB delete failed: %s" % str(errv))
+
+    def commit_chunks(self, url, generation, expiry, size, chunk_size, head, chunks):
+        """Store the resource row making the chunks of the write current
+
+        head - bytes, the first chunk
+        chunks - int, the number of the chunks stored by put_chunk()
+        return - bool, True if stored; False if a later write has been committed or the chunks
+            are gone, they're removed then
+        """
+        self._last_key, self._last = None, None
+        try:
+            #a stale copy is replaced
+            saved = self._execute("rarog_save", (url, _signed(key_hash(url)), time.time(),
+                float(expiry), size, chunk_size, generation, self._driver.Binary(head), chunks))
+        except self._driver.DatabaseError as errv:
+            proc_error("DB write failed: %s" % str(errv))
+            return False
+        if not saved:
+            if chunks:
+                self.drop_chunks(url, generation)
+            return False
+        try:
+            self._execute("rarog_drop_old_chunks", (url, generation))
+        except self._driver.DatabaseError as errv:
+            # left for the next start
+            proc_error("DB delete failed: %s" % str(errv))
+        return True
+
+    def save(self, key_path, data, expiry=0.0):
+        """expiry - float, time the resource goes stale, 0 if the default age limit applies"""
+        writer = self.writer(key_path, expiry)
+        writer.write(data)
+        return writer.commit()
+
+    def save_many(self, items):
+        """Save several resources in one transaction
+
+        items - list of (key_path, data, expiry)
+        return - list of bool, True for the resources saved
+        """
+        conn = self._pool.get()
+        reusable = False
+        try:
+            conn.autocommit = False
+            cur = conn.cursor()
+            saved = []
+            try:
+                for key_path, data, expiry in items:
+                    url = encoding.to_str(key_path)
+                    generation = time.time_ns()
+                    size = self._chunk_size
+                    chunks = 0
+                    for chunks, pos in enumerate(range(size, len(data), size), 1):
+                        _run(cur, "rarog_put_chunk", (url, generation, chunks,
+                                                      self._driver.Binary(data[pos:pos + size])))
+                    _run(cur, "rarog_save", (url, _signed(key_hash(url)), time.time(),
+                        float(expiry), len(data), size, generation,
+                        self._driver.Binary(data[:size]), chunks))
+                    saved.append(bool(cur.rowcount))
+                    if saved[-1]:
+                        _run(cur, "rarog_drop_old_chunks", (url, generation))
+                    elif chunks:
+                        _run(cur, "rarog_drop_chunks", (url, generation))
+            finally:
+                cur.close()
+            conn.commit()
+            conn.autocommit = True
+            reusable = True
+            return saved
+        except self._driver.DatabaseError as errv:
+            proc_error("DB write failed: %s" % str(errv))
+            # the connection may be broken
+            reusable = not isinstance(errv, self._driver.OperationalError)
+            if reusable:
+                try:
+                    conn.rollback()
+                    conn.autocommit = True
+                except self._driver.DatabaseError:
+                    reusable = False
+            return [False] * len(items)
         finally:
-            cur.close()
-        return None
+            self._pool.put(conn, reusable)
+
+    def writer(self, key_path, expiry=0.0):
+        """Start writing a resource piece by piece, the chunks are stored as they're complete"""
+        return _ChunkWriter(self, encoding.to_str(key_path), expiry, self._chunk_size)
 
     def fetch(self, key_path):
-        return self._fetch_col("content", key_path)
+        row = self._found(key_path)
+        self._last_key, self._last = None, None
+        if not row:
+            return None
+        stored, expiry, head, size, chunk_size, generation = row
+        head = bytes(head)
+        if size <= len(head):
+            return head
+        try:
+            rows = self._execute("rarog_chunks", (encoding.to_str(key_path), generation),
+                                 "fetchall")
+        except self._driver.DatabaseError as errv:
+            proc_error("DB read failed: %s" % str(errv))
+            return None
+        data = head + b"".join(bytes(chunk) for chunk, in rows)
+        if len(data) != size:
+            # replaced meanwhile
+            proc_error("DB resource %s is incomplete" % encoding.to_str(key_path))
+            return None
+        return data
+
+    def fetch_file(self, key_path):
+        """A resource of several chunks is read chunk by chunk while it's being sent. A resource
+        of one chunk has been read already: use fetch
+
+        return - (file object, 0, int size) or None
+        """
+        row = self._found(key_path)
+        if not row:
+            return None
+        stored, expiry, head, size, chunk_size, generation = row
+        if size <= len(head):
+            return None
+        self._last_key, self._last = None, None
+        return _ChunkReader(self, encoding.to_str(key_path), generation, bytes(head), size,
+                            chunk_size), 0, size
+
+    def haskey_time(self, key_path):
+        row = self._lookup(key_path)
+        return (True, row[0]) if row else (False, None)
+
+    def cached_times(self, key_path):
+        """return - (float stored time, float expiry time or 0) or None if not found"""
+        row = self._lookup(key_path)
+        return (row[0], row[1]) if row else None
+
+    def scan(self):
+        """Walk all the resources
 
-    def haskey_time(self, key_path): 
-        time_str = self._fetch_col("timestamp", key_path)
-        return (True, time.mktime(time.strptime(time_str, DBStorage.TIME_FORMAT))) if time_str else (False, None)
+        return - iterator of ((int, int) index key, int size, float stored time,
+            float expiry time), see cache_index.index_key()
+        """
+        conn = self._pool.get()
+        reusable = False
+        try:
+            # named cursor fetches the rows by portions instead of all at once, it needs
+            # a transaction
+            conn.autocommit = False
+            cur = conn.cursor("scan")
+            try:
+                # the check word isn't kept in the table, it's hashed from the url
+                cur.execute("SELECT url, size, stored, expiry FROM resources")
+                for url, size, stored, expiry in cur:
+                    yield index_key(url), size, stored, expiry
+            finally:
+                cur.close()
+            conn.commit()
+            conn.autocommit = True
+            reusable = True
+        except self._driver.DatabaseError as errv:
+            proc_error("DB scan failed: %s" % str(errv))
+        finally:
+            self._pool.put(conn, reusable)
+
+    def erase_hashes(self, hash_values):
+        """Remove the resources by their key hashes, see cache_index.key_hash()
 
+        hash_values - set of int
+        return - int, the number of resources removed
+        """
+        if not hash_values:
+            return 0
+        try:
+            return self._execute("rarog_erase_hashes",
+                ([_signed(value) for value in hash_values],), "fetchone")[0]
+        except self._driver.DatabaseError as errv:
+            proc_error("DB delete failed: %s" % str(errv))
+            return 0
 
     def erase(self, key_path):
-        cur = self._conn.cursor()
+        if key_path == self._last_key:
+            self._last_key, self._last = None, None
         try:
-            str_path = encoding.to_str(key_path)
-            cur.execute("DELETE FROM files WHERE url = %s ;", (str_path,))
-            self._conn.commit()
-        except DatabaseError as errv:
+            self._execute("rarog_erase", (encoding.to_str(key_path),))
+        except self._driver.DatabaseError as errv:
             proc_error("DB delete failed: %s" % str(errv))
-        finally:
-            cur.close()
-        
 
+class _ChunkWriter:
+    """Stores the resource chunk by chunk as it's being written, so that only one chunk is in
+    memory. The chunks belong to a new generation of the resource, invisible to the readers
+    until the first chunk is stored with the resource row on commit
+    """
+    def __init__(self, storage, url, expiry, chunk_size):
+        self._storage = storage
+        self._url = url
+        self._expiry = expiry
+        self._chunk_size = chunk_size
+        # a later write has a greater generation
+        self._generation = time.time_ns()
+        self._buffer = bytearray()
+        self._head = None
+        self._chunks = 0
+        self._size = 0
+        self._failed = False
+
+    def write(self, data):
+        self._buffer += data
+        self._size += len(data)
+        while len(self._buffer) >= self._chunk_size:
+            self._put(bytes(self._buffer[:self._chunk_size]))
+            del self._buffer[:self._chunk_size]
+
+    def _put(self, chunk):
+        if self._head is None:
+            self._head = chunk
+        elif not self._failed:
+            self._failed = not self._storage.put_chunk(self._url, self._generation, self._chunks,
+                                                       chunk)
+        self._chunks += 1
+
+    def commit(self):
+        """return - bool, True if the resource has been saved"""
+        if self._buffer or self._head is None:
+            self._put(bytes(self._buffer))
+            self._buffer = bytearray()
+        if self._failed:
+            self.abort()
+            return False
+        return self._storage.commit_chunks(self._url, self._generation, self._expiry, self._size,
+                                           self._chunk_size, self._head, self._chunks - 1)
+
+    def abort(self):
+        self._buffer = bytearray()
+        if self._chunks > 1:
+            self._storage.drop_chunks(self._url, self._generation)
+
+class _ChunkReader(io.RawIOBase):
+    """The content of a resource read chunk by chunk. Sockets send it with their sendfile
+    fallback, reading and seeking it like a file
+    """
+    def __init__(self, storage, url, generation, head, size, chunk_size):
+        self._storage = storage
+        self._url = url
+        self._generation = generation
+        self._size = size
+        self._chunk_size = chunk_size
+        self._pos = 0
+        self._number = 0
+        self._chunk = head
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if io.SEEK_CUR == whence:
+            offset += self._pos
+        elif io.SEEK_END == whence:
+            offset += self._size
+        self._pos = max(0, offset)
+        return self._pos
 
+    def readinto(self, buffer):
+        if self._pos >= self._size:
+            return 0
+        number = self._pos // self._chunk_size
+        if number != self._number:
+            chunk = self._storage.read_chunk(self._url, self._generation, number)
+            if chunk is None:
+                # replaced or removed meanwhile, the client gets a truncated response
+                raise OSError("DB resource %s chunk %i is missing" % (self._url, number))
+            self._number, self._chunk = number, chunk
+        start = self._pos - number * self._chunk_size
+        piece = self._chunk[start:start + len(buffer)]
+        buffer[:len(piece)] = piece
+        self._pos += len(piece)
+        return len(piece)
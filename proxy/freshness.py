@@ -0,0 +1,273 @@
+"""
+Updated: 2017
+Author: Sergei Shliakhtin
+Contact: xxx.serj@gmail.com
+Notes: HTTP freshness and validation of cached responses
+
+A response stays fresh for its Cache-Control max-age (s-maxage, as we're a shared cache), or
+until its Expires, or for a part of its age since Last-Modified. A response telling nothing
+about it is kept for cache_discard_after seconds. A stale response with ETag or Last-Modified is
+revalidated with a conditional request, 304 Not Modified makes it fresh again without
+transferring the body.
+
+A response stale for less than stale_while_revalidate seconds is served at once and revalidated
+in the background; one stale for less than stale_if_error seconds is served if the origin
+server fails.
+
+The headers are passed as bytes with or without the status line, the cached responses are
+kept without it.
+"""
+
+import email.utils
+import re
+import time
+
+from proxy.config import Config
+from proxy.const import Const
+
+# part of the time since the last modification a response without explicit freshness is fresh
+HEURISTIC_FRACTION = 0.1
+# seconds, the heuristic freshness limit
+HEURISTIC_MAX = 24 * 3600
+# added to the ETag of a response gzipped by the proxy, the body differs from the origin one;
+# see compression
+GZIP_ETAG_SUFFIX = b"-gzip"
+# the cached headers repeated in a 304 response
+_NOT_MODIFIED_HEADERS = (b"ETag", b"Last-Modified", b"Cache-Control", b"Expires", b"Vary",
+                         b"Content-Location")
+
+def header_value(header, name):
+    """header - bytes
+    name - bytes, header field name
+    return - bytes, the field value or None if absent
+    """
+    match = re.search(b"^" + re.escape(name) + b":[ \t]*(.*?)[ \t\r]*$", header,
+                      re.IGNORECASE | re.MULTILINE)
+    return match.group(1) if match else None
+
+def http_date(value):
+    """value - bytes or None
+    return - float, time from an HTTP date or None if malformed
+    """
+    if not value:
+        return None
+    try:
+        return email.utils.parsedate_to_datetime(value.decode("ascii", "ignore")).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+def cache_control(header):
+    """return - dict lowercase bytes directive -> bytes value or True"""
+    directives = {}
+    for value in re.findall(b"^cache-control:[ \t]*(.*?)[ \t\r]*$", header,
+                            re.IGNORECASE | re.MULTILINE):
+        for directive in value.split(b","):
+            name, sep, argument = directive.strip().partition(b"=")
+            if name:
+                directives[name.lower()] = argument.strip(b'"') if sep else True
+    return directives
+
+def storable(header):
+    """return - bool, the response may be kept by a shared cache"""
+    directives = cache_control(header)
+    return b"no-store" not in directives and b"private" not in directives
+
+def has_freshness(header):
+    """return - bool, the response tells how long it stays fresh"""
+    directives = cache_control(header)
+    return (b"max-age" in directives or b"s-maxage" in directives or b"no-cache" in directives
+            or header_value(header, b"Expires") is not None)
+
+def expiry(header, received, default_ttl):
+    """Find when the response goes stale
+
+    header - bytes, response headers
+    received - float, time the response has been received
+    default_ttl - float, seconds a response telling nothing about its freshness is fresh
+    return - float, expiry time
+    """
+    directives = cache_control(header)
+    if b"no-cache" in directives:
+        # can be stored, but should be revalidated every time
+        return received
+    for directive in (b"s-maxage", b"max-age"):
+        if directive in directives:
+            try:
+                return received + max(0, int(directives[directive]))
+            except ValueError:
+                return received
+    date = http_date(header_value(header, b"Date")) or received
+    expires = header_value(header, b"Expires")
+    if expires is not None:
+        expires = http_date(expires)
+        # malformed Expires means already expired
+        return received + max(0, expires - date) if expires else received
+    last_modified = http_date(header_value(header, b"Last-Modified"))
+    if last_modified:
+        return received + min(HEURISTIC_MAX, max(0, date - last_modified) * HEURISTIC_FRACTION)
+    return received + default_ttl
+
+def cached_header(data):
+    """data - bytes, cached response without status line
+    return - bytes, its headers
+    """
+    ends = [pos for pos in (data.find(b"\r\n\r\n"), data.find(b"\n\n")) if pos >= 0]
+    return data[:min(ends)] if ends else data
+
+def is_conditional(request_header):
+    """return - bool, the client asks for the resource only if it has changed"""
+    return (header_value(request_header, b"If-None-Match") is not None
+            or header_value(request_header, b"If-Modified-Since") is not None)
+
+def no_cache_requested(request_header):
+    """return - bool, the client wants the cached copy revalidated, e.g. on browser reload"""
+    pragma = header_value(request_header, b"Pragma")
+    return (b"no-cache" in cache_control(request_header)
+            or (pragma is not None and b"no-cache" in pragma.lower()))
+
+def _weak(tag):
+    tag = tag.strip()
+    return tag[2:] if tag.startswith(b"W/") else tag
+
+def origin_etag(etag):
+    """etag - bytes, ETag of a cached response
+    return - bytes, the ETag as the origin server has sent it, without GZIP_ETAG_SUFFIX
+    """
+    if etag.endswith(GZIP_ETAG_SUFFIX + b'"'):
+        return etag[:-len(GZIP_ETAG_SUFFIX) - 1] + b'"'
+    return etag
+
+def not_modified(request_header, header):
+    """Evaluate the client conditional request against the cached response
+
+    request_header - bytes
+    header - bytes, cached response headers
+    return - bool, 304 Not Modified should be sent
+    """
+    if_none_match = header_value(request_header, b"If-None-Match")
+    if if_none_match is not None:
+        etag = header_value(header, b"ETag")
+        if b"*" == if_none_match.strip():
+            return True
+        if not etag:
+            return False
+        # the client may have the decoded copy with the origin ETag
+        tags = [_weak(tag) for tag in if_none_match.split(b",")]
+        return _weak(etag) in tags or _weak(origin_etag(etag)) in tags
+    since = http_date(header_value(request_header, b"If-Modified-Since"))
+    last_modified = http_date(header_value(header, b"Last-Modified"))
+    return bool(since and last_modified) and last_modified <= since
+
+def not_modified_response(header):
+    """header - bytes, cached response headers
+    return - bytes, 304 Not Modified response for the cached one
+    """
+    lines = [b"HTTP/1.1 304 Not Modified"]
+    for name in _NOT_MODIFIED_HEADERS:
+        value = header_value(header, name)
+        if value is not None:
+            lines.append(name + b": " + value)
+    return b"\r\n".join(lines) + b"\r\n\r\n"
+
+def conditional_request(request_message, header):
+    """Make the request conditional on the cached response validators. The client's own
+    conditions are dropped: the response should tell about the cached copy
+
+    request_message - bytes
+    header - bytes, cached response headers
+    return - bytes, the request or None if the cached response has no validators
+    """
+    etag = header_value(header, b"ETag")
+    last_modified = header_value(header, b"Last-Modified")
+    if not etag and not last_modified:
+        return None
+    ends = [pos for pos in (request_message.find(b"\r\n\r\n"), request_message.find(b"\n\n"))
+            if pos >= 0]
+    if not ends:
+        return None
+    header_end = min(ends)
+    request_header = re.sub(b"\r?\n(if-none-match|if-modified-since):[^\n]*", b"",
+                            request_message[:header_end], flags=re.IGNORECASE)
+    if etag:
+        request_header += b"\r\nIf-None-Match: " + origin_etag(etag)
+    if last_modified:
+        request_header += b"\r\nIf-Modified-Since: " + last_modified
+    return request_header + request_message[header_end:]
+
+class CachePolicy:
+    """Freshness decisions for the resources of a storage"""
+    # STALE_REVALIDATE - to be served and revalidated in the background
+    # STALE_IF_ERROR - to be revalidated, served if the origin server fails
+    # STALE - to be revalidated
+    MISS, FRESH, STALE_REVALIDATE, STALE_IF_ERROR, STALE = list(range(5))
+
+    def __init__(self, storage, background_refresh=False, compressor=None):
+        """storage - storage with cached_times()
+        background_refresh - bool, the resources can be revalidated while the stale copy is
+            being served; STALE_REVALIDATE is never returned otherwise
+        compressor - compression.Compressor for the responses to be stored compressed or None
+        """
+        self._storage = storage
+        self._compressor = compressor
+        self._background_refresh = background_refresh
+        self._default_ttl = float(Config.value(Const.STORAGE_SECTION, "cache_discard_after"))
+        self._stale_while_revalidate = float(Config.value(Const.STORAGE_SECTION,
+                                                          "stale_while_revalidate"))
+        self._stale_if_error = float(Config.value(Const.STORAGE_SECTION, "stale_if_error"))
+
+    def lookup(self, key_path, request_header):
+        """return - one of MISS, FRESH, STALE_REVALIDATE, STALE_IF_ERROR, STALE"""
+        times = self._storage.cached_times(key_path)
+        if not times:
+            return CachePolicy.MISS
+        stored, expiry_time = times
+        if not expiry_time:
+            expiry_time = stored + self._default_ttl
+        if no_cache_requested(request_header):
+            return CachePolicy.STALE
+        stale_for = time.time() - expiry_time
+        if stale_for < 0:
+            return CachePolicy.FRESH
+        if self._background_refresh and stale_for < self._stale_while_revalidate:
+            return CachePolicy.STALE_REVALIDATE
+        if stale_for < self._stale_if_error:
+            return CachePolicy.STALE_IF_ERROR
+        return CachePolicy.STALE
+
+    def save(self, key_path, header, data):
+        """Save a successful response, if it may be stored
+
+        header - bytes, response headers
+        data - bytes, response without status line
+        return - bool, False if it should have been saved, but hasn't
+        """
+        if not storable(header):
+            return True
+        if self._compressor:
+            data = self._compressor.compress(data)
+        return self._storage.save(key_path, data, expiry(header, time.time(), self._default_ttl))
+
+    def writer(self, key_path, header):
+        """Start saving a successful response piece by piece, if it may be stored
+
+        header - bytes, response headers
+        return - storage writer or None
+        """
+        if not storable(header):
+            return None
+        expiry_time = expiry(header, time.time(), self._default_ttl)
+        if self._compressor and self._compressor.compressible(header):
+            return self._compressor.writer(self._storage, key_path, expiry_time)
+        return self._storage.writer(key_path, expiry_time)
+
+    def refresh(self, key_path, data, response_header):
+        """The origin server has confirmed the cached response with 304 Not Modified: store it
+        again with the new expiry time. The freshness headers of the 304 response override the
+        cached ones
+
+        data - bytes, cached response without status line
+        response_header - bytes, 304 response headers
+        return - bool, True if saved
+        """
+        header = response_header if has_freshness(response_header) else cached_header(data)
+        return self._storage.save(key_path, data, expiry(header, time.time(), self._default_ttl))
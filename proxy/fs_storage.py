@@ -3,15 +3,29 @@ Updated: 2017
 Author: Sergei Shliakhtin
 Contact: xxx.serj@gmail.com
 Notes: Filesystem storage for cached data
+
+Layouts:
+    plain - the resource path is the file path relative to the cache dir, hostname/resource;
+        its expiry time is kept in the sidecar file hostname/resource.meta, none is written
+        if the default age limit applies
+    hashed - the file is named by SHA-1 of the resource path and put into two levels of
+        shard dirs by the first hex digits, cache_dir/ab/cd/abcd...; the file starts with
+        a line holding the resource path and its expiry time
 """
 
 
+import errno
 import fcntl
+import hashlib
 import os
+import re
+import tempfile
 
+from proxy import ProxyException
+from proxy.cache_index import hex_index_key, index_key, key_hash
 from proxy.config import Config
 from proxy.encoding import to_str, to_bytes
-from proxy.logger import proc_error
+from proxy.logger import log, proc_error
 from proxy.const import Const
 
 import multiprocessing
@@ -38,46 +52,228 @@ class LockedFile():
         fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
         self._file.close()
 
+# the process umask, read once: setting it is the only way to read it, which a thread can't do
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+class FSWriter:
+    """Writes a resource into a temporary file which replaces the cached one on commit, so that
+    readers never see a partially written resource. Every writer has its own temporary file,
+    the threads of one process may write the same resource at once"""
+    def __init__(self, key_path, meta=b"", meta_path=None):
+        """
+        key_path - bytes, full path of the resource file
+        meta - bytes, written before the resource, or into meta_path if it's given
+        meta_path - bytes, the sidecar file replaced after the resource on commit, removed
+            if meta is empty
+        """
+        self._path = key_path
+        self._meta_path = meta_path
+        self._meta = meta
+        dir_path, name = os.path.split(key_path)
+        fd, self._tmp_path = tempfile.mkstemp(suffix=b".tmp", prefix=name + b".", dir=dir_path)
+        # the mode open() would create it with
+        os.fchmod(fd, 0o666 & ~_UMASK)
+        self._file = os.fdopen(fd, "wb")
+        if not meta_path:
+            self._file.write(meta)
+
+    def write(self, data):
+        try:
+            self._file.write(data)
+        except OSError as errv:
+            proc_error("Couldn't write to %s : %s" % (self._tmp_path, str(errv)))
+            self.abort()
+
+    def commit(self):
+        """return - bool, True if the resource has been saved"""
+        if self._file.closed:
+            return False
+        try:
+            self._file.close()
+            os.rename(self._tmp_path, self._path)
+        except OSError as errv:
+            proc_error("Couldn't save to %s : %s" % (self._path, str(errv)))
+            self.abort()
+            return False
+        if self._meta_path:
+            # after the resource: a reader finding the new one with the old expiry time at
+            # worst takes it for stale, never an old one for fresh
+            self._replace_meta()
+        return True
+
+    def _replace_meta(self):
+        try:
+            if not self._meta:
+                os.remove(self._meta_path)
+                return
+            if not FSWriter(self._meta_path, self._meta).commit():
+                # the old one doesn't tell about this resource
+                os.remove(self._meta_path)
+        except FileNotFoundError:
+            pass
+        except OSError as errv:
+            proc_error("Couldn't save to %s : %s" % (self._meta_path, str(errv)))
+
+    def abort(self):
+        self._file.close()
+        try:
+            os.remove(self._tmp_path)
+        except OSError:
+            pass
+
+PLAIN_LAYOUT = "plain"
+HASHED_LAYOUT = "hashed"
+# hex digits per shard dir level
+_SHARD_WIDTH = 2
+_SHARD_DIR = re.compile(b"^[0-9a-f]{%i}$" % _SHARD_WIDTH)
+# the plain layout sidecar file holding the expiry time of the resource file it's named after
+META_SUFFIX = b".meta"
+
 class FSStorage:
-    """Allows saving resources to disk by resource path. Resource path reflects actual
-    disk location relative to cache dir.
+    """Allows saving resources to disk by resource path. In the plain layout resource path
+    reflects actual disk location relative to cache dir, in the hashed one it's kept inside
+    the file.
     """
 
-    def __init__(self):
-        self.__cache_dir = to_bytes(Config.value(Const.STORAGE_SECTION, 'cache_path'))
+    def __init__(self, cache_dir=None, layout=None):
+        """
+        cache_dir - str, None to take cache_path from proxy.ini
+        layout - str, PLAIN_LAYOUT or HASHED_LAYOUT, None to take fs_layout from proxy.ini
+        """
+        self.__cache_dir = to_bytes(cache_dir or Config.value(Const.STORAGE_SECTION, 'cache_path'))
         assert self.__cache_dir
+        self._layout = layout or Config.value(Const.STORAGE_SECTION, 'fs_layout')
+        if self._layout not in (PLAIN_LAYOUT, HASHED_LAYOUT):
+            raise ProxyException('Need either plain or hashed fs_layout in proxy.ini')
 
     def _amend_path(self, path):
+        if HASHED_LAYOUT == self._layout:
+            digest = hashlib.sha1(to_bytes(path)).hexdigest().encode("ascii")
+            return os.path.join(self.__cache_dir, digest[:_SHARD_WIDTH],
+                                digest[_SHARD_WIDTH:2 * _SHARD_WIDTH], digest)
         return os.path.join(self.__cache_dir, path)
 
-    def save(self, key_path, data):
+    def save(self, key_path, data, expiry=0.0):
+        writer = self.writer(key_path, expiry)
+        if not writer:
+            return False
+        writer.write(data)
+        return writer.commit()
+
+    def save_many(self, items):
+        """items - list of (key_path, data, expiry)
+        return - list of bool, True for the resources saved
+        """
+        return [self.save(key_path, data, expiry) for key_path, data, expiry in items]
+
+    def writer(self, key_path, expiry=0.0):
+        """Start writing a resource piece by piece
+
+        expiry - float, time the resource goes stale, 0 if the default age limit applies
+        return - FSWriter or None if the resource can't be saved
+        """
+        meta, meta_path = b"", None
+        if HASHED_LAYOUT == self._layout:
+            meta = to_bytes(key_path) + b" %.3f\n" % expiry
         key_path = self._amend_path(key_path)
+        if HASHED_LAYOUT != self._layout:
+            if key_path.endswith(META_SUFFIX):
+                # would be taken for the sidecar of another resource
+                return None
+            meta_path = key_path + META_SUFFIX
+            if expiry:
+                meta = b"%.3f" % expiry
         cacheDir, file = os.path.split(key_path)
         MAX_NAME = 255
-        if len(os.path.basename(key_path)) > MAX_NAME:
-            return False
+        #leave some room for the temporary file suffix, see FSWriter, and the sidecar one
+        if len(os.path.basename(key_path)) > MAX_NAME - 16 - len(META_SUFFIX):
+            return None
         try: 
             if not os.path.exists(cacheDir):
                 os.makedirs(cacheDir, mode=0o777, exist_ok=True)
-
-            with LockedFile(open(key_path, "wb"), fcntl.LOCK_EX | fcntl.LOCK_NB) as cacheFile: 
-                cacheFile.write(data)
-            return True
-        except FileExistsError:
-            return False
+            return FSWriter(key_path, meta, meta_path)
         except OSError as errv:
             proc_error("Couldn't save to %s : %s" % (key_path, str(errv)))
-            return False
+            return None
 
     def fetch(self, key_path):
+        file_path = self._amend_path(key_path)
         try:
-            key_path = self._amend_path(key_path)
-            with LockedFile(open(key_path, "rb"), fcntl.LOCK_SH) as cacheFile:
+            with LockedFile(open(file_path, "rb"), fcntl.LOCK_SH) as cacheFile:
+                if HASHED_LAYOUT == self._layout and self._read_meta(cacheFile, key_path) is None:
+                    return None
                 return cacheFile.read()
         except OSError as errv:
-            log("%s file read error: %s" % (key_path, str(errv)))
+            log("%s file read error: %s" % (file_path, str(errv)))
             return None
 
+    def fetch_file(self, key_path):
+        """Open the resource file to be sent with sendfile, without reading it. No lock is
+        needed: a resource file is replaced by rename, the opened one stays intact
+
+        return - (file object, offset, size) or None; the caller closes the file
+        """
+        file_path = self._amend_path(key_path)
+        try:
+            cache_file = open(file_path, "rb")
+        except OSError as errv:
+            log("%s file open error: %s" % (file_path, str(errv)))
+            return None
+        offset = 0
+        if HASHED_LAYOUT == self._layout:
+            if self._read_meta(cache_file, key_path) is None:
+                cache_file.close()
+                return None
+            offset = cache_file.tell()
+        return cache_file, offset, os.fstat(cache_file.fileno()).st_size - offset
+
+    @staticmethod
+    def _read_meta(cache_file, key_path=None):
+        """Read the resource path line of a hashed layout file
+
+        cache_file - file object positioned at the beginning
+        key_path - bytes, the resource expected, None to take any
+        return - float expiry time or None if the file holds another resource with the same hash
+        """
+        line = cache_file.readline()[:-1]
+        stored_key, sep, expiry = line.rpartition(b" ")
+        try:
+            expiry = float(expiry)
+        except ValueError:
+            sep = None
+        if not sep:
+            # written without the expiry time
+            stored_key, expiry = line, 0.0
+        if key_path is not None and stored_key != to_bytes(key_path):
+            log("%s is stored in place of %s" % (stored_key, key_path))
+            return None
+        return expiry
+
+    @staticmethod
+    def _read_sidecar(file_path):
+        """file_path - bytes, a plain layout resource file
+        return - float, expiry time, 0 if there is no sidecar file
+        """
+        try:
+            with open(file_path + META_SUFFIX, "rb") as meta_file:
+                return float(meta_file.read())
+        except (OSError, ValueError):
+            return 0.0
+
+    def cached_times(self, key_path):
+        """return - (float stored time, float expiry time or 0) or None if not found"""
+        file_path = self._amend_path(key_path)
+        try:
+            if HASHED_LAYOUT != self._layout:
+                return os.path.getmtime(file_path), self._read_sidecar(file_path)
+            with open(file_path, "rb") as cache_file:
+                expiry = self._read_meta(cache_file, key_path)
+                if expiry is None:
+                    return None
+                return os.fstat(cache_file.fileno()).st_mtime, expiry
+        except OSError:
+            return None
 
     def haskey_time(self, key_path): 
         key_path = self._amend_path(key_path)
@@ -93,12 +289,149 @@ class FSStorage:
         except OSError as errv:
             log("Couldn't remove file %s : %s" % (key_path, str(errv)))
             return
+        if HASHED_LAYOUT == self._layout:
+            # the shard dirs are few and will be used again
+            return
+        self._remove_sidecar(key_path)
         try:
             key_path = os.path.dirname(key_path)
             os.removedirs(key_path)
         except OSError as errv:
-            if os.errno.ENOTEMPTY == errv.errno:
+            if errno.ENOTEMPTY == errv.errno:
                 return
             log("Couldn't remove dir %s : %s" % (key_path, str(errv)))
 
+    def scan(self):
+        """Walk all the resources
+
+        return - iterator of ((int, int) index key, int size, float stored time,
+            float expiry time), see cache_index.index_key()
+        """
+        if not os.path.isdir(self.__cache_dir):
+            return
+        for dir_path, dir_names, file_names in os.walk(self.__cache_dir):
+            for file_name in file_names:
+                if file_name.endswith(b".tmp") or file_name.endswith(META_SUFFIX):
+                    continue
+                file_path = os.path.join(dir_path, file_name)
+                expiry = 0.0
+                try:
+                    if HASHED_LAYOUT == self._layout:
+                        key = hex_index_key(file_name)
+                        with open(file_path, "rb") as cache_file:
+                            expiry = self._read_meta(cache_file)
+                            stat = os.fstat(cache_file.fileno())
+                    else:
+                        key = index_key(os.path.relpath(file_path, self.__cache_dir))
+                        stat = os.stat(file_path)
+                        expiry = self._read_sidecar(file_path)
+                except (OSError, ValueError):
+                    continue
+                yield key, stat.st_size, stat.st_mtime, expiry
+
+    def erase_hashes(self, hash_values):
+        """Remove the resources by their key hashes, see cache_index.key_hash()
+
+        hash_values - set of int
+        return - int, the number of resources removed
+        """
+        removed = 0
+        if HASHED_LAYOUT == self._layout:
+            for hash_value in hash_values:
+                prefix = b"%016x" % hash_value
+                shard_dir = os.path.join(self.__cache_dir, prefix[:_SHARD_WIDTH],
+                                         prefix[_SHARD_WIDTH:2 * _SHARD_WIDTH])
+                try:
+                    names = os.listdir(shard_dir)
+                except OSError:
+                    continue
+                for name in names:
+                    if name.startswith(prefix) and not name.endswith(b".tmp"):
+                        removed += self._remove(os.path.join(shard_dir, name))
+            return removed
+        # the plain layout file names tell nothing, all of them are hashed to be found
+        for dir_path, dir_names, file_names in os.walk(self.__cache_dir):
+            for file_name in file_names:
+                if file_name.endswith(META_SUFFIX):
+                    continue
+                file_path = os.path.join(dir_path, file_name)
+                if key_hash(os.path.relpath(file_path, self.__cache_dir)) in hash_values:
+                    removed += self._remove(file_path)
+                    self._remove_sidecar(file_path)
+        return removed
+
+    @staticmethod
+    def _remove(file_path):
+        """return - int, 1 if the file has been removed, 0 otherwise"""
+        try:
+            os.remove(file_path)
+            return 1
+        except OSError as errv:
+            log("Couldn't remove file %s : %s" % (file_path, str(errv)))
+            return 0
 
+    @staticmethod
+    def _remove_sidecar(file_path):
+        """file_path - bytes, a plain layout resource file, removed"""
+        try:
+            os.remove(file_path + META_SUFFIX)
+        except FileNotFoundError:
+            pass
+        except OSError as errv:
+            log("Couldn't remove file %s : %s" % (file_path + META_SUFFIX, str(errv)))
+
+    def migrate(self):
+        """Move the resources saved in the plain layout to the hashed one, keeping their
+        modification time. Should be called by the main process before the workers start
+
+        return - int, the number of resources moved
+        """
+        if HASHED_LAYOUT != self._layout or not os.path.isdir(self.__cache_dir):
+            return 0
+        moved = 0
+        for host_dir in os.listdir(self.__cache_dir):
+            if _SHARD_DIR.match(host_dir):
+                continue
+            host_path = os.path.join(self.__cache_dir, host_dir)
+            for dir_path, dir_names, file_names in os.walk(host_path, topdown=False):
+                for file_name in file_names:
+                    if file_name.endswith(b".tmp"):
+                        # left by a worker which has died while writing
+                        os.remove(os.path.join(dir_path, file_name))
+                        continue
+                    if file_name.endswith(META_SUFFIX):
+                        # moved along with its resource file, unless that one is gone
+                        resource_path = os.path.join(dir_path, file_name[:-len(META_SUFFIX)])
+                        if not os.path.exists(resource_path):
+                            self._remove_sidecar(resource_path)
+                        continue
+                    file_path = os.path.join(dir_path, file_name)
+                    if self._migrate_file(file_path):
+                        moved += 1
+                try:
+                    os.rmdir(dir_path)
+                except OSError as errv:
+                    log("Couldn't remove dir %s : %s" % (dir_path, str(errv)))
+        return moved
+
+    def _migrate_file(self, file_path):
+        """The file is removed only once it's saved in the hashed layout, it's tried again on
+        the next start otherwise
+
+        return - bool, True if the resource has been moved
+        """
+        key_path = os.path.relpath(file_path, self.__cache_dir)
+        try:
+            mtime = os.path.getmtime(file_path)
+            with open(file_path, "rb") as cache_file:
+                data = cache_file.read()
+            if not self.save(key_path, data, self._read_sidecar(file_path)):
+                proc_error("Couldn't migrate %s" % file_path)
+                return False
+            os.utime(self._amend_path(key_path), (mtime, mtime))
+            os.remove(file_path)
+            self._remove_sidecar(file_path)
+        except OSError as errv:
+            proc_error("Couldn't migrate %s : %s" % (file_path, str(errv)))
+            return False
+        return True
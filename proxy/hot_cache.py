@@ -0,0 +1,289 @@
+"""
+Updated: 2017
+Author: Sergei Shliakhtin
+Contact: xxx.serj@gmail.com
+Notes: Shared memory cache of small popular resources in front of the storage
+
+All the worker processes map the same file, preferably on tmpfs (/dev/shm). The resources
+are appended to a ring buffer, the oldest being overwritten (FIFO eviction), and are found
+through a hash index. Writers are serialized with flock; readers take no locks: an index slot
+is protected by a sequence number and a resource is known to be intact if the ring write
+position hasn't gone a full ring past it while it was copied.
+
+Layout: header | index slots | ring
+    header - magic, slot count, ring size, write position
+    slot - sequence, key hash, resource position, resource length
+    resource - key length, data length, stored time, key, data
+"""
+
+import fcntl
+import hashlib
+import mmap
+import struct
+import time
+
+from proxy.config import Config
+from proxy.const import Const
+from proxy.encoding import to_bytes
+from proxy.logger import proc_error
+
+MAGIC = b"RAROGHC1"
+_HEADER = struct.Struct("=8sQQQ")
+_HEADER_SIZE = 64
+# offset of the write position in the header
+_WRITE_POS = 24
+_SLOT = struct.Struct("=QQQQ")
+# slot without the sequence
+_SLOT_DATA = struct.Struct("=QQQ")
+_ENTRY = struct.Struct("=IId")
+_POS = struct.Struct("=Q")
+
+def _key_hash(key):
+    """return - int, nonzero 64-bit hash; zero marks an empty slot"""
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little") or 1
+
+class HotCache:
+    """The mapped cache file"""
+
+    def __init__(self, path, max_object_size):
+        """Map an existing cache file
+
+        path - str
+        max_object_size - int, larger resources are not kept
+        """
+        self._file = open(path, "r+b")
+        self._mm = mmap.mmap(self._file.fileno(), 0)
+        magic, self._slots, self._ring_size, _ = _HEADER.unpack_from(self._mm, 0)
+        if MAGIC != magic:
+            raise ValueError("%s is not a hot cache file" % path)
+        self._ring_start = _HEADER_SIZE + self._slots * _SLOT.size
+        self.max_object_size = max_object_size
+
+    @staticmethod
+    def create(path, size, slots):
+        """Create or reset the cache file. Should be called once before the workers start
+
+        path - str
+        size - int, bytes for the resources
+        slots - int, index size, the number of resources which can be found at once
+        """
+        with open(path, "wb") as cache_file:
+            cache_file.truncate(_HEADER_SIZE + slots * _SLOT.size + size)
+            cache_file.write(_HEADER.pack(MAGIC, slots, size, 0))
+
+    @staticmethod
+    def from_config():
+        """return - HotCache configured in proxy.ini or None if disabled"""
+        if "True" != Config.value(Const.HOT_CACHE_SECTION, "enable"):
+            return None
+        try:
+            return HotCache(Config.value(Const.HOT_CACHE_SECTION, "path"),
+                            int(Config.value(Const.HOT_CACHE_SECTION, "max_object_size")))
+        except (OSError, ValueError) as errv:
+            proc_error("Hot cache unavailable: %s" % str(errv))
+            return None
+
+    @staticmethod
+    def create_from_config():
+        """Create the cache file configured in proxy.ini, if enabled"""
+        if "True" != Config.value(Const.HOT_CACHE_SECTION, "enable"):
+            return
+        HotCache.create(Config.value(Const.HOT_CACHE_SECTION, "path"),
+                        int(Config.value(Const.HOT_CACHE_SECTION, "size")),
+                        int(Config.value(Const.HOT_CACHE_SECTION, "slots")))
+
+    def _slot_offset(self, key_hash):
+        return _HEADER_SIZE + (key_hash % self._slots) * _SLOT.size
+
+    def get(self, key_path):
+        """Look the resource up without locking
+
+        key_path - bytes
+        return - (stored time, data) or None
+        """
+        key = to_bytes(key_path)
+        key_hash = _key_hash(key)
+        offset = self._slot_offset(key_hash)
+        mm = self._mm
+        seq, slot_hash, pos, length = _SLOT.unpack_from(mm, offset)
+        if seq & 1 or slot_hash != key_hash:
+            return None
+        ring_offset = self._ring_start + pos % self._ring_size
+        entry = mm[ring_offset:ring_offset + length]
+        # the slot or the resource have been overwritten while being read
+        if seq != _SLOT.unpack_from(mm, offset)[0]:
+            return None
+        if _POS.unpack_from(mm, _WRITE_POS)[0] > pos + self._ring_size:
+            return None
+        key_len, data_len, stored = _ENTRY.unpack_from(entry, 0)
+        if entry[_ENTRY.size:_ENTRY.size + key_len] != key:
+            return None
+        data_start = _ENTRY.size + key_len
+        return stored, entry[data_start:data_start + data_len]
+
+    def put(self, key_path, data, stored):
+        """Append the resource and point the index to it
+
+        key_path - bytes
+        data - bytes
+        stored - float, time the resource has been received
+        return - bool, False if it's too large to be kept
+        """
+        key = to_bytes(key_path)
+        length = _ENTRY.size + len(key) + len(data)
+        if len(data) > self.max_object_size or length > self._ring_size:
+            return False
+        key_hash = _key_hash(key)
+        mm = self._mm
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        try:
+            pos = _POS.unpack_from(mm, _WRITE_POS)[0]
+            ring_offset = pos % self._ring_size
+            if ring_offset + length > self._ring_size:
+                # resources don't wrap around, start from the ring beginning
+                pos += self._ring_size - ring_offset
+                ring_offset = 0
+            # claim the space first, so that readers of the overwritten resources notice it
+            _POS.pack_into(mm, _WRITE_POS, pos + length)
+            start = self._ring_start + ring_offset
+            _ENTRY.pack_into(mm, start, len(key), len(data), stored)
+            start += _ENTRY.size
+            mm[start:start + len(key)] = key
+            start += len(key)
+            mm[start:start + len(data)] = data
+            self._write_slot(key_hash, key_hash, pos, length)
+        finally:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        return True
+
+    def erase(self, key_path):
+        """Drop the resource from the index
+
+        key_path - bytes
+        """
+        key_hash = _key_hash(to_bytes(key_path))
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        try:
+            if _SLOT.unpack_from(self._mm, self._slot_offset(key_hash))[1] == key_hash:
+                self._write_slot(key_hash, 0, 0, 0)
+        finally:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+    def _write_slot(self, key_hash, slot_hash, pos, length):
+        """Update an index slot, should be called with the lock held"""
+        offset = self._slot_offset(key_hash)
+        seq = _POS.unpack_from(self._mm, offset)[0]
+        # odd sequence tells readers the slot is being changed
+        _POS.pack_into(self._mm, offset, seq + 1)
+        _SLOT_DATA.pack_into(self._mm, offset + _POS.size, slot_hash, pos, length)
+        _POS.pack_into(self._mm, offset, seq + 2)
+
+class HotCacheStorage:
+    """Storage wrapper serving resources from HotCache when possible. The resources read from
+    or written to the wrapped storage are put into the hot cache
+    """
+
+    def __init__(self, storage, hot_cache):
+        """
+        storage - the wrapped storage
+        hot_cache - HotCache
+        """
+        self._storage = storage
+        self._hot = hot_cache
+        # the last resource looked up, the worker fetches it right after the lookup
+        self._last_key = None
+        self._last = None
+        # the wrapped storage may want to know about the resources used, e.g. for eviction
+        self._record_access = getattr(storage, "record_access", None)
+
+    def haskey_time(self, key_path):
+        found = self._hot.get(key_path)
+        if found:
+            self._last_key, self._last = key_path, found
+            if self._record_access:
+                self._record_access(key_path)
+            return True, found[0]
+        haskey, time_loaded = self._storage.haskey_time(key_path)
+        self._last_key, self._last = key_path, ((time_loaded, None) if haskey else None)
+        return haskey, time_loaded
+
+    def fetch(self, key_path):
+        found = self._last if key_path == self._last_key else self._hot.get(key_path)
+        self._last_key, self._last = None, None
+        if found and found[1] is not None:
+            return found[1]
+        data = self._storage.fetch(key_path)
+        if data and found:
+            # popular enough to be asked for again: keep it with its original stored time
+            self._hot.put(key_path, data, found[0])
+        return data
+
+    def fetch_file(self, key_path):
+        found = self._last if key_path == self._last_key else None
+        if found and found[1] is not None:
+            # in memory already
+            return None
+        opened = self._storage.fetch_file(key_path)
+        if opened and opened[2] <= self._hot.max_object_size:
+            # small enough for the hot cache, let fetch() bring it there
+            opened[0].close()
+            return None
+        self._last_key, self._last = None, None
+        return opened
+
+    def cached_times(self, key_path):
+        # the hot cache doesn't know the expiry time, the lookup goes to the wrapped storage
+        times = self._storage.cached_times(key_path)
+        if times:
+            self._last_key, self._last = key_path, self._hot.get(key_path) or (times[0], None)
+        else:
+            self._last_key, self._last = None, None
+        return times
+
+    def save(self, key_path, data, expiry=0.0):
+        if not self._storage.save(key_path, data, expiry):
+            return False
+        self._hot.put(key_path, data, time.time())
+        return True
+
+    def writer(self, key_path, expiry=0.0):
+        writer = self._storage.writer(key_path, expiry)
+        return _HotCacheWriter(writer, self._hot, key_path) if writer else None
+
+    def erase(self, key_path):
+        self._hot.erase(key_path)
+        self._storage.erase(key_path)
+
+    def __getattr__(self, name):
+        # the rest of the storage interface goes to the wrapped storage as it is
+        return getattr(self._storage, name)
+
+class _HotCacheWriter:
+    """Passes the pieces to the wrapped storage writer, collecting them for the hot cache while
+    the size allows
+    """
+    def __init__(self, writer, hot_cache, key_path):
+        self._writer = writer
+        self._hot = hot_cache
+        self._key_path = key_path
+        self._parts = []
+        self._size = 0
+
+    def write(self, data):
+        self._writer.write(data)
+        if self._parts is not None:
+            self._size += len(data)
+            if self._size > self._hot.max_object_size:
+                self._parts = None
+            else:
+                self._parts.append(bytes(data))
+
+    def commit(self):
+        if not self._writer.commit():
+            return False
+        if self._parts is not None:
+            self._hot.put(self._key_path, b"".join(self._parts), time.time())
+        return True
+
+    def abort(self):
+        self._writer.abort()
@@ -0,0 +1,196 @@
+"""
+Updated: 2017
+Author: Sergei Shliakhtin
+Contact: xxx.serj@gmail.com
+Notes: Incremental HTTP message framing
+
+Data is fed as it comes from the socket and every byte is examined once: the header
+terminator search resumes where the previous one stopped and a chunked body is walked
+by the chunk sizes instead of being searched for the last chunk.
+
+Headers, a chunk size line or a trailer line longer than MAX_LINE_SIZE are an error, so that
+a peer never sending the end of them can't make us buffer without limit.
+"""
+
+import re
+
+# bytes, the headers or a line of the chunked encoding can't be longer
+MAX_LINE_SIZE = 65536
+
+class HttpParser:
+    """Finds where a message received piece by piece ends, according to its Content-Length
+    or chunked encoding. A message having neither ends with its headers.
+    """
+    HEADERS, BODY, CHUNK_SIZE, CHUNK_DATA, CHUNK_END, TRAILER, DONE = list(range(7))
+
+    def __init__(self):
+        #the message received so far, and possibly the beginning of the next one
+        self.buffer = bytearray()
+        self.state = HttpParser.HEADERS
+        #where the empty line after the headers starts
+        self.header_end = 0
+        self.body_start = 0
+        #where the message ends, valid when done
+        self.end = 0
+        self.chunked = False
+        self.content_length = None
+        #malformed chunked encoding or oversize
+        self.error = False
+        #the headers or a chunked encoding line are longer than MAX_LINE_SIZE
+        self.oversize = False
+        #parse position in buffer
+        self._pos = 0
+        #bytes left in the current body or chunk
+        self._remaining = 0
+
+    @property
+    def done(self):
+        return HttpParser.DONE == self.state
+
+    @property
+    def delimited(self):
+        """The message end is known from Content-Length or chunked encoding, not connection close"""
+        return self.chunked or self.content_length is not None
+
+    @property
+    def message(self):
+        return bytes(self.buffer[:self.end])
+
+    @property
+    def header(self):
+        return bytes(self.buffer[:self.header_end])
+
+    @property
+    def tail(self):
+        """Bytes received after the end of the message, the next pipelined message head"""
+        return bytes(self.buffer[self.end:])
+
+    def feed(self, data):
+        """Append received data and advance the parse state as far as possible
+
+        data - bytes-like
+        return - bool, True if the message is complete
+        """
+        if not self.buffer and HttpParser.HEADERS == self.state and data and data[0] in b"\r\n":
+            # occasional blank lines in the begginning should be ignored
+            data = bytes(data).lstrip(b"\r\n")
+        self.buffer += data
+        self._parse()
+        return self.done
+
+    def take(self):
+        """Remove and return the bytes parsed so far, up to the end of the message, so that a
+        message can be relayed without keeping all of it. The offsets, message and header refer
+        to the remaining buffer afterwards
+
+        return - bytes, empty while the headers are incomplete
+        """
+        if HttpParser.HEADERS == self.state:
+            return b""
+        size = self.end if self.done else self._pos
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        self._pos -= size
+        self.end = max(0, self.end - size)
+        self.header_end -= size
+        self.body_start -= size
+        return data
+
+    def _parse(self):
+        buf = self.buffer
+        while not self.error:
+            if HttpParser.HEADERS == self.state:
+                if not self._parse_headers():
+                    return
+            elif self.state in (HttpParser.BODY, HttpParser.CHUNK_DATA):
+                taken = min(len(buf) - self._pos, self._remaining)
+                self._pos += taken
+                self._remaining -= taken
+                if self._remaining:
+                    return
+                if HttpParser.BODY == self.state:
+                    self._finish()
+                else:
+                    self.state = HttpParser.CHUNK_END
+            elif HttpParser.DONE == self.state:
+                return
+            else:
+                # the rest of the states are line-based
+                newline = buf.find(b"\n", self._pos)
+                if newline < 0:
+                    if len(buf) - self._pos > MAX_LINE_SIZE:
+                        self._oversize()
+                    return
+                line = bytes(buf[self._pos:newline]).strip()
+                self._pos = newline + 1
+                self._parse_line(line)
+
+    def _parse_headers(self):
+        """return - bool, True if the headers are complete"""
+        buf = self.buffer
+        ends = [(buf.find(terminator, self._pos), terminator) for terminator in (b"\r\n\r\n", b"\n\n")]
+        ends = [(pos, terminator) for pos, terminator in ends if pos >= 0]
+        if not ends:
+            if len(buf) > MAX_LINE_SIZE:
+                self._oversize()
+                return False
+            # the terminator can be split between this data and the next one
+            self._pos = max(0, len(buf) - 3)
+            return False
+        self.header_end, terminator = min(ends)
+        if self.header_end > MAX_LINE_SIZE:
+            self._oversize()
+            return False
+        self.body_start = self._pos = self.header_end + len(terminator)
+
+        header = bytes(buf[:self.header_end])
+        matchContent = re.search(b"^content-length:\\s+(\\d+)", header, re.IGNORECASE | re.MULTILINE)
+        #When using Transfer-Encoding, chunked coding is
+        # and applied the last according to 3.6 Protocol Paramters: Transfer Codings
+        matchTransfer = re.search(b"^transfer-encoding:\\s+", header, re.IGNORECASE | re.MULTILINE)
+        #if present, content-length is ignored
+        if matchTransfer:
+            self.chunked = True
+            self.state = HttpParser.CHUNK_SIZE
+        elif matchContent:
+            self.content_length = int(matchContent.group(1))
+            self._remaining = self.content_length
+            self.state = HttpParser.BODY
+        else:
+            #message without body
+            self._finish()
+        return True
+
+    def _parse_line(self, line):
+        """Handle chunk size line, data terminating line or trailer line
+
+        line - bytes, stripped
+        """
+        if HttpParser.CHUNK_SIZE == self.state:
+            try:
+                # chunk extensions are ignored
+                size = int(line.split(b";", 1)[0], 16)
+            except ValueError:
+                self.error = True
+                return
+            if size:
+                self._remaining = size
+                self.state = HttpParser.CHUNK_DATA
+            else:
+                self.state = HttpParser.TRAILER
+        elif HttpParser.CHUNK_END == self.state:
+            if line:
+                self.error = True
+                return
+            self.state = HttpParser.CHUNK_SIZE
+        elif not line:
+            # empty line ends the trailer
+            self._finish()
+
+    def _oversize(self):
+        self.oversize = True
+        self.error = True
+
+    def _finish(self):
+        self.end = self._pos
+        self.state = HttpParser.DONE
@@ -11,5 +11,9 @@ RESPONSE_504 = _response(b"504 Gateway Timeout")
 RESPONSE_501 = _response(b"501 Not Implemented")
 RESPONSE_200 = _response(b"200 OK")
 
+STATUS_200 = b"HTTP/1.1 200 OK\n"
+# CONNECT reply, the tunnel follows; it has no body length
+CONNECTION_ESTABLISHED = b"HTTP/1.1 200 Connection Established\r\n\r\n"
+
 def add_ok_status(headers_body):
-    return b"HTTP/1.1 200 OK\n" + headers_body
+    return STATUS_200 + headers_body
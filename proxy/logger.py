@@ -1,29 +1,103 @@
-""" 
+"""
 Updated: 2016
 Author: Sergei Shliakhtin
 Contact: xxx.serj@gmail.com
 Notes: Logging helpers
+
+With [Logging] queue enabled the processes don't write the log themselves: the records go
+into a bounded queue, formatted, and the log process writes them to the console and the files.
+A record which doesn't fit in the queue is dropped, so a process is never blocked on the log.
+Whatever is below the level set in loggers.conf is skipped before it's formatted.
+
+Besides the console there are per-process logs "<kind>_<process name>" in log_path: state,
+err and trace, see tracing; and the JSON access log access.log.
 """
 
 
 import logging
 import logging.config
+import logging.handlers
 import multiprocessing
 import os
+import queue
+import signal
 
 from proxy.const import Const
 from proxy.config import Config
 
-def log_basic_config():
-    """Init loggefs from file config. Should be called once only"""
+# per-process loggers are named "<kind>.<process name>", so loggers.conf can set their levels
+STATE_LOGGER = "state"
+ERROR_LOGGER = "err"
+TRACE_LOGGER = "trace"
+ACCESS_LOGGER = "access"
+_FILE_LOGGERS = (STATE_LOGGER, ERROR_LOGGER, TRACE_LOGGER, ACCESS_LOGGER)
+ACCESS_LOG_FILE = "access.log"
+# seconds between the checks the main process is still there
+_PARENT_CHECK = 1
+
+def log_basic_config(log_queue=None):
+    """Init loggefs from file config. Should be called once only
+
+    log_queue - multiprocessing.Queue of the log process or None to write the log directly
+    """
     #logging.basicConfig(format="%(message)s", level=logging.INFO)
     logging.config.fileConfig("loggers.conf")
     console = logger(Const.CONSOLE_LOGGER)
     for handler in console.handlers:
         if isinstance(handler, logging.StreamHandler):
             handler.terminator = ""
+    if log_queue is not None:
+        log_through_queue(log_queue)
+
+def log_queue_enabled():
+    """return - bool, the log process should be started"""
+    return "True" == Config.value(Const.LOGGING_SECTION, "queue")
+
+def create_log_queue(context):
+    """Should be called from parent process
+
+    context - multiprocessing module or context
+    return - the queue for the log process
+    """
+    return context.Queue(int(Config.value(Const.LOGGING_SECTION, "queue_size")))
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Puts the records into the log queue, drops them when it's full"""
+
+    def __init__(self, log_queue):
+        logging.handlers.QueueHandler.__init__(self, log_queue)
+        # a process exits without waiting for its records to be flushed
+        log_queue.cancel_join_thread()
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+def log_through_queue(log_queue):
+    """Send the records of this process to the log process instead of the handlers
+
+    log_queue - multiprocessing.Queue
+    """
+    global __queued
+    for label in (None, Const.CONSOLE_LOGGER):
+        target = logging.getLogger(label)
+        for handler in list(target.handlers):
+            target.removeHandler(handler)
+    logging.getLogger().addHandler(_DroppingQueueHandler(log_queue))
+    __queued = True
+
+def log_directly():
+    """Write the log from this process again, once the log process is gone"""
+    global __queued
+    __queued = False
+    log_basic_config()
 
 __per_process_lock = None
+__queued = False
+#logger names having got a file handler in this process
+__file_handlers = set()
 
 def init_lock(lock):
     global __per_process_lock
@@ -32,9 +106,13 @@ def init_lock(lock):
 def logger(label):
     return logging.getLogger(label)
 
-def log(message, level=logging.INFO, label=None):  
+def enabled(level=logging.INFO, label=None):
+    """return - bool, a record of the level would be logged"""
+    return logger(label or Const.CONSOLE_LOGGER).isEnabledFor(level)
+
+def log(message, level=logging.INFO, label=None):
     if None == label:
-        label = Const.CONSOLE_LOGGER 
+        label = Const.CONSOLE_LOGGER
 
     PROTECTED_STDOUT = False
     global __per_process_lock
@@ -44,28 +122,82 @@ def log(message, level=logging.INFO, label=None):
     else:
         logger(label).log(level, message)
 
+def logf(message, *args, level=logging.INFO, label=None):
+    """Log message % args, nothing is formatted if the level is off
+
+    message - str, format
+    """
+    if enabled(level, label):
+        log(message % args, level, label)
+
 def proc_error(message):
     log(message)
-    log_per_process(message, "err_")
+    log_per_process(message, ERROR_LOGGER)
 
 def proc_state(message):
-    log_per_process(message, "state_")
+    log_per_process(message, STATE_LOGGER)
 
 def proc_debug(message):
-    proc_state(message)    
-
-def log_per_process(message, prefix):
-    logger_name = prefix + multiprocessing.current_process().name
-    if not prefix in proc_state.has_handler:
-        proc_state.has_handler.append(prefix)
-        log_dir = Config.value(Const.MAIN_SECTION, "log_path")
-        if not os.path.exists(log_dir):
-            os.makedirs(log_dir, mode=0o777, exist_ok=True)
-        fhandler = logging.FileHandler(os.path.join(log_dir, logger_name), "w")
+    proc_state(message)
+
+def log_per_process(message, kind):
+    """Log into the file of this process
+
+    kind - str, one of STATE_LOGGER, ERROR_LOGGER, TRACE_LOGGER
+    """
+    logger_name = "%s.%s" % (kind, multiprocessing.current_process().name)
+    target = logger(logger_name)
+    if not target.isEnabledFor(logging.WARNING):
+        return
+    _add_file_handler(logger_name)
+    target.warning(message)
+
+def log_access(message):
+    """Write a record into the access log
+
+    message - str, JSON
+    """
+    _add_file_handler(ACCESS_LOGGER)
+    logger(ACCESS_LOGGER).info(message)
+
+def _add_file_handler(logger_name):
+    """Let the logger write its file, unless the log process does it or it's done already"""
+    if __queued or logger_name in __file_handlers:
+        return
+    __file_handlers.add(logger_name)
+    log_dir = Config.value(Const.MAIN_SECTION, "log_path")
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir, mode=0o777, exist_ok=True)
+    if ACCESS_LOGGER == logger_name:
+        # every process appends to the same file
+        fhandler = logging.FileHandler(os.path.join(log_dir, ACCESS_LOG_FILE), "a")
+        fhandler.setFormatter(logging.Formatter("%(message)s"))
+    else:
+        fhandler = logging.FileHandler(os.path.join(log_dir, logger_name.replace(".", "_", 1)), "w")
         fhandler.setFormatter(logging.Formatter("%(asctime)s %(message)s", "%H:%M:%S"))
-        logger(logger_name).addHandler(fhandler)
-    logger(logger_name).warning(message)
-
-proc_state.has_handler = [] 
-
-
+    logger(logger_name).addHandler(fhandler)
+
+class LogProcess:
+    """Runs in its own process, writing the records the others put into the log queue"""
+
+    def __call__(self, log_queue):
+        """Write until the main process puts None or exits
+
+        log_queue - multiprocessing.Queue of logging.LogRecord
+        """
+        # the main process stops it after the exit statistics are written
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        log_basic_config()
+        parent = os.getppid()
+        while True:
+            try:
+                record = log_queue.get(timeout=_PARENT_CHECK)
+            except queue.Empty:
+                if os.getppid() != parent:
+                    return
+                continue
+            if record is None:
+                return
+            if record.name.split(".", 1)[0] in _FILE_LOGGERS:
+                _add_file_handler(record.name)
+            logger(record.name).handle(record)
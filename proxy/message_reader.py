@@ -10,128 +10,92 @@ library call.
 
 import re
 
+from proxy.http_parser import HttpParser
 from proxy.logger import logger, proc_error, proc_debug
 
+BUF_SIZE = 4096
+
 class MessageReader(object):
     """The base class for reading an HTTP message from a socket. Handles both Content-Length and 
        chunked encoding.
     """
 
-    def __init__(self, stream, pipeline_tail=b""):
+    def __init__(self, stream, pipeline_tail=b"", parser=None):
         """Read message from stream finding its ending according to its Content-Length or chunked encoding, or peer
         shutdown
 
         stream - socket to read from
         pipeline_tail - bytes from this request, already read as the tail of 
             previous message
+        parser - HttpParser which has already got the complete message, nothing is read then
         """
-        self.message = pipeline_tail 
+        self.message = b""
         self.header = b""
         self.ok = False
         self.timeout = False
         self.tail = b""
+        #the message end is known from Content-Length or chunked encoding, not connection close
+        self.delimited = False
+
+        if parser is None:
+            parser = HttpParser()
+            parser.feed(pipeline_tail)
+            if not self._read(stream, parser):
+                return
+
+        if not parser.done or parser.error:
+            self.message = bytes(parser.buffer)
+            self.timeout = not self.message
+            return
+        if b"HTTP" not in parser.header:
+            self.message = parser.message
+            return
+
+        self.message = parser.message
+        self.header = parser.header
+        self.tail = parser.tail
+        self.delimited = parser.delimited
+        self.ok = True
 
-        BUF_SIZE_SMALL = 50 
-        BUF_SIZE = 4096
-        first = True
-        abort = False
-        chunked = False
+    def _read(self, stream, parser):
+        """Receive into a reusable buffer and feed the parser until the message is complete or
+        the peer stops sending
 
-        """Read request/response line and headers"""
-        while 1:
-            proc_debug("Readhdr")
+        return - bool, False on socket error
+        """
+        buf = bytearray(BUF_SIZE)
+        view = memoryview(buf)
+        while not parser.done and not parser.error:
+            proc_debug("Readmsg")
             try:
-                chunk = stream.recv(BUF_SIZE_SMALL)
+                size = stream.recv_into(view)
             except OSError as errv:
-                if 11 == errv.errno and self.message:
-                    self.ok = True
+                if 11 == errv.errno and parser.buffer and HttpParser.HEADERS == parser.state:
                     proc_error("Timeout while reading - OK (0) %s " % str(errv))
-                    self.message += b"\r\n\r\n"
-                    return
+                    parser.feed(b"\r\n\r\n")
+                    continue
+                self.message = bytes(parser.buffer)
                 self.timeout = not self.message
                 proc_error("Message read failed (1) %s " % str(errv))
-                proc_debug(str(errv))
-                return
-            # empty chunk means client shutted down
-            if None == chunk or 0 == len(chunk) :
-                abort = True
+                return False
+            # empty chunk means peer shutted down
+            if not size:
                 break
-            # occasional blank lines in the begginning should be ignored
-            if (first):
-                chunk = chunk.lstrip(b"\r\n")
-                chunk = chunk.lstrip(b"\n")
-                first = False
-            self.message += chunk
-            # empty line at the end means end of the _headers section. We only handle GET, without a body, so stop here
-            match = re.search(b"(\r\n\r\n|\n\n)", self.message);
-            if match:
-                proc_debug("Match")
-                break
-            proc_debug("Notmatch")
+            parser.feed(view[:size])
+        return True
 
-        if abort or b"HTTP" not in self.message:
-            self.ok = False
-            self.timeout = not self.message
-            return
-
-
-        self.header = self.message[:match.start()]
-        bodycount = len(self.message[match.end():])
-        matchContent = re.search(b"^content-length:\s+(\d+)", self.header, re.IGNORECASE | re.MULTILINE)
-        #When using Transfer-Encoding, chunked coding is
-        # and applied the last according to 3.6 Protocol Paramters: Transfer Codings
-        # otherwise, message end is by closing the connection
-        matchTransfer = re.search(b"^transfer-encoding:\s+", self.header, re.IGNORECASE | re.MULTILINE)
-        #if present, content-length is ignored
-        if matchTransfer: 
-            chunked = True
-        elif matchContent:
-            chunked = False
-            contentLength = int(matchContent.group(1))
-        else:
-        #_message without body
-            self.ok = True
-            self.tail = self.message[match.end():]
-            return
+def keeps_alive(header):
+    """Tell if the sender of the message keeps the connection open after it
 
+    header - bytes, message headers starting with request/response line
+    """
+    matchConn = re.search(b"^connection:\s*(\S+)", header, re.IGNORECASE | re.MULTILINE)
+    if matchConn:
+        return b"keep-alive" == matchConn.group(1).lower()
+    # persistent by default since HTTP/1.1
+    first_line = header.split(b"\n", 1)[0]
+    return b"HTTP/1.0" not in first_line
 
-        """Read body"""
-        chunk = b""           
-        try:
-            if chunked:
-                while 1:                        
-                    # Search for 0-chunk and possibly a trailer following a newline
-                    matchTransferEnd = re.search(b"0\r\n(.*\r\n)?\r\n", self.message[len(self.header):])
-                    if matchTransferEnd:
-                        self.ok = True
-                        break
-                    proc_debug("Readbody ch")
-                    chunk = stream.recv(BUF_SIZE)
-                    if not chunk:
-                        self.ok = False
-                        break
-                    self.message += chunk
-            else:
-                while 1:
-                    bodycount += len(chunk)
-                    if bodycount == contentLength:
-                        self.ok = True
-                        break
-                    proc_debug("readbody cl")
-                    if contentLength - bodycount >= BUF_SIZE:
-                        chunk = stream.recv(BUF_SIZE)
-                    else:
-                        chunk = stream.recv(contentLength - bodycount)
-                    if not chunk:
-                        self.ok = False
-                        break
-                    self.message += chunk
-        except OSError as value:
-                proc_error("Message read failed (2) ")
-                proc_error(str(value))
-                self.ok = False
-                self.timeout = not self.message
-                      
 def set_keep_alive(message, size, keep_alive):
     """Insert Connection: keep-alive header into existing message string
 
@@ -0,0 +1,234 @@
+"""
+Updated: 2017
+Author: Sergei Shliakhtin
+Contact: xxx.serj@gmail.com
+Notes: Worker metrics in shared memory and the admin endpoint exposing them
+
+The main process allocates one block of shared memory with a slot for every worker process.
+A worker writes only its own slot: the counters and the latency histogram buckets are plain
+64-bit cells it adds to, no lock is taken on the request path. The main process reads all the
+slots and sums them up; a value may be a request behind, never torn on the 64-bit platforms.
+A slot of a retired worker is given to the next worker started, which goes on adding to the
+same cells, so the totals never go back.
+
+The request phase timings are kept the same way, in a histogram per phase, see tracing.
+
+The main process answers GET /metrics on the admin address in the Prometheus text format.
+"""
+
+import bisect
+import multiprocessing
+
+from proxy import ProxyException
+from proxy.config import Config
+from proxy.const import Const
+from proxy.logger import proc_error
+import proxy.network as net
+from proxy.tracing import PHASES
+
+# name, help; bytes_in are received from the origin servers, bytes_out are sent to clients;
+# the CONNECT tunnels are counted apart, as they aren't parsed
+COUNTERS = (("requests", "Client requests read"),
+            ("complete", "Responses sent to clients completely"),
+            ("failed_reads", "Requests failed to read or unsupported"),
+            ("hits", "Responses sent from cache, revalidated and stale ones included"),
+            ("misses", "Responses sent from the origin servers"),
+            ("errors", "Requests failed on the origin server or the client side"),
+            ("bytes_in", "Bytes received from the origin servers"),
+            ("bytes_out", "Bytes sent to clients"),
+            ("tunnel_bytes_up", "Bytes relayed from clients to the origin servers in tunnels"),
+            ("tunnel_bytes_down", "Bytes relayed from the origin servers to clients in tunnels"),
+            ("dropped_writes", "Cache saves dropped on the full write-behind queue"),
+            ("dns_hits", "Host name lookups answered from the resolver cache"),
+            ("dns_misses", "Host name lookups missing the resolver cache"),
+            ("dns_failures", "Host name lookups failed"))
+# the request latency: from the request read to the response sent
+HISTOGRAMS = ("hit", "miss")
+# seconds, the upper bounds of the histogram buckets; the last one is +Inf
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# the histogram sum is kept in microseconds, the cells are integers
+_SUM_SCALE = 1000000
+# cells of a histogram: the buckets, +Inf and the sum
+_HISTOGRAM_SIZE = len(BUCKETS) + 2
+_COUNTER_INDEX = {name: index for index, (name, _) in enumerate(COUNTERS)}
+_HISTOGRAM_INDEX = {name: len(COUNTERS) + index * _HISTOGRAM_SIZE
+                    for index, name in enumerate(HISTOGRAMS + PHASES)}
+SLOT_SIZE = len(COUNTERS) + len(HISTOGRAMS + PHASES) * _HISTOGRAM_SIZE
+# exported names prefix
+PREFIX = "rarog_"
+# seconds to wait for a scrape request
+ADMIN_TIMEOUT = 1
+# bytes of a scrape request read at most
+_MAX_REQUEST = 8192
+
+class WorkerMetrics:
+    """The slot of one worker process. Only that process writes it, every cell from one thread"""
+
+    def __init__(self, cells, index):
+        """
+        cells - the shared multiprocessing.RawArray
+        index - int, the slot number
+        """
+        self._cells = cells
+        self.index = index
+        self._base = index * SLOT_SIZE
+
+    def count(self, name, value=1):
+        """name - str, one of COUNTERS"""
+        self._cells[self._base + _COUNTER_INDEX[name]] += value
+
+    def observe(self, histogram, seconds):
+        """histogram - str, one of HISTOGRAMS or tracing.PHASES
+        seconds - float, the latency
+        """
+        base = self._base + _HISTOGRAM_INDEX[histogram]
+        self._cells[base + bisect.bisect_left(BUCKETS, seconds)] += 1
+        self._cells[base + len(BUCKETS) + 1] += int(seconds * _SUM_SCALE)
+
+class MetricsRegion:
+    """The shared memory block with the slots of all the workers. Should be created in the
+    main process, which allocates the slots
+    """
+    def __init__(self, slots):
+        """slots - int, worker processes running at the same time at most"""
+        self._cells = multiprocessing.RawArray("Q", slots * SLOT_SIZE)
+        self._free = list(range(slots - 1, -1, -1))
+        self._slots = slots
+
+    def allocate(self):
+        """return - WorkerMetrics of a free slot, for a new worker"""
+        if not self._free:
+            raise ProxyException("No free metrics slot for a worker")
+        return WorkerMetrics(self._cells, self._free.pop())
+
+    def free_slots(self):
+        return len(self._free)
+
+    def release(self, metrics):
+        """The worker is gone, its slot goes to the next one
+
+        metrics - WorkerMetrics
+        """
+        self._free.append(metrics.index)
+
+    def total(self, name):
+        """name - str, one of COUNTERS
+        return - int, the sum of all the slots
+        """
+        index = _COUNTER_INDEX[name]
+        return sum(self._cells[slot * SLOT_SIZE + index] for slot in range(self._slots))
+
+    def histogram(self, name):
+        """name - str, one of HISTOGRAMS or tracing.PHASES
+        return - (list of int cumulative bucket counts, +Inf included, float sum in seconds)
+        """
+        cells = [0] * _HISTOGRAM_SIZE
+        for slot in range(self._slots):
+            base = slot * SLOT_SIZE + _HISTOGRAM_INDEX[name]
+            for index in range(_HISTOGRAM_SIZE):
+                cells[index] += self._cells[base + index]
+        cumulative = []
+        count = 0
+        for value in cells[:-1]:
+            count += value
+            cumulative.append(count)
+        return cumulative, cells[-1] / _SUM_SCALE
+
+    def exposition(self, gauges=()):
+        """The metrics in the Prometheus text format
+
+        gauges - iterable of (str name, str help, number value) of the main process
+        return - str
+        """
+        lines = []
+        for counter, help_text in COUNTERS:
+            name = PREFIX + counter + "_total"
+            lines += ["# HELP %s %s" % (name, help_text), "# TYPE %s counter" % name,
+                      "%s %i" % (name, self.total(counter))]
+        lines += self._histogram_lines("request_duration_seconds",
+                                       "Latency from the request read to the response sent",
+                                       "path", HISTOGRAMS)
+        lines += self._histogram_lines("phase_duration_seconds", "Time a request spends in a phase",
+                                       "phase", PHASES)
+        for name, help_text, value in gauges:
+            name = PREFIX + name
+            lines += ["# HELP %s %s" % (name, help_text), "# TYPE %s gauge" % name,
+                      "%s %s" % (name, value)]
+        return "\n".join(lines) + "\n"
+
+    def _histogram_lines(self, family, help_text, label, histograms):
+        """family - str, the metric name
+        label - str, the label telling the histograms apart
+        histograms - names of the histograms in the family
+        return - list of str
+        """
+        name = PREFIX + family
+        lines = ["# HELP %s %s" % (name, help_text), "# TYPE %s histogram" % name]
+        for histogram in histograms:
+            cumulative, sum_ = self.histogram(histogram)
+            for bound, count in zip(BUCKETS + ("+Inf",), cumulative):
+                lines.append('%s_bucket{%s="%s",le="%s"} %i' % (name, label, histogram, bound, count))
+            lines.append('%s_sum{%s="%s"} %f' % (name, label, histogram, sum_))
+            lines.append('%s_count{%s="%s"} %i' % (name, label, histogram, cumulative[-1]))
+        return lines
+
+class AdminServer:
+    """Answers the scrape requests in the main process. A request is read and answered at
+    once, blocking the main process for ADMIN_TIMEOUT at most, so the address should be a local
+    one
+    """
+    def __init__(self, address, port, region, gauges):
+        """
+        address, port - where to listen
+        region - MetricsRegion
+        gauges - callable returning the gauges for MetricsRegion.exposition
+        """
+        self.socket = net.bound_socket(address, port)
+        self.socket.listen(net.TCP_BACKLOG)
+        self._region = region
+        self._gauges = gauges
+
+    @staticmethod
+    def from_config(region, gauges):
+        """return - AdminServer configured in proxy.ini or None if disabled"""
+        if "True" != Config.value(Const.METRICS_SECTION, "enable"):
+            return None
+        return AdminServer(Config.value(Const.METRICS_SECTION, "admin_address"),
+                           int(Config.value(Const.METRICS_SECTION, "admin_port")),
+                           region, gauges)
+
+    def accept_all(self):
+        """Answer all the pending scrape connections"""
+        while 1:
+            try:
+                connection, addr = self.socket.accept()
+            except BlockingIOError:
+                return
+            try:
+                connection.settimeout(ADMIN_TIMEOUT)
+                self._answer(connection)
+            except OSError as errv:
+                proc_error("Admin request failed: %s" % str(errv))
+            finally:
+                connection.close()
+
+    def _answer(self, connection):
+        """connection - blocking client socket"""
+        data = b""
+        while b"\r\n\r\n" not in data and b"\n\n" not in data and len(data) < _MAX_REQUEST:
+            chunk = connection.recv(_MAX_REQUEST)
+            if not chunk:
+                break
+            data += chunk
+        request_line = data.split(b"\n", 1)[0].split()
+        if len(request_line) < 2 or b"GET" != request_line[0]:
+            connection.sendall(b"HTTP/1.1 405 Method Not Allowed\r\nContent-Length: 0\r\n"
+                               b"Connection: close\r\n\r\n")
+            return
+        if b"/metrics" != request_line[1].split(b"?", 1)[0]:
+            connection.sendall(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n"
+                               b"Connection: close\r\n\r\n")
+            return
+        body = self._region.exposition(self._gauges()).encode("ascii")
+        connection.sendall(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                           b"Content-Length: %i\r\nConnection: close\r\n\r\n" % len(body) + body)
@@ -11,12 +11,15 @@ import array
 import multiprocessing
 import errno
 import os
+import selectors
 import socket
 import struct
 
+from proxy import ProxyException
 from proxy.logger import log
 from proxy.logger import proc_error, proc_state
 from proxy.encoding import to_str
+from proxy.resolver import get_resolver
 
 # Port to connect to if none is given in the URL
 DEFAULT_PORT = 80
@@ -24,6 +27,14 @@ DEFAULT_PORT = 80
 TCP_ESTABLISHED = 1
 # Buffer size of IPC socket
 IPC_BUF = 64 
+# Pending connections queue length of a listening socket
+TCP_BACKLOG = 32
+# IPC message telling a worker process to exit, instead of a descriptor
+RETIRE_MESSAGE = b"Q"
+# fd_from_socket result for RETIRE_MESSAGE
+RETIRE = -1
+# Bytes moved through a tunnel at once
+TUNNEL_CHUNK = 65536
 
 #sends the subject fd through unix ipc_socket
 def fd_through_socket(ipc_socket, subject_fd):
@@ -51,8 +62,23 @@ def fd_from_socket(ipc_socket):
         arr = array.array("I")
         arr.frombytes(data)
         fds.extend(arr)
+    if not fds:
+        return RETIRE if RETIRE_MESSAGE == msg else None
     return fds[0]
 
+def retire_through_socket(ipc_socket):
+    """Tell the worker process to exit once it's done with its clients; fd_from_socket returns
+    RETIRE there
+
+    return - bool, True if sent
+    """
+    try:
+        ipc_socket.send(RETIRE_MESSAGE)
+        return True
+    except OSError as err:
+        proc_error("Retire sending failed: %s" % str(err))
+        return False
+
 def ipc_socket_pair():
     sock0, sock1 = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
     sock0.set_inheritable(1)
@@ -61,9 +87,16 @@ def ipc_socket_pair():
     sock1.setblocking(1)
     return sock0, sock1
 
-def bound_socket(addr, port):
+def bound_socket(addr, port, reuse_port=False):
+    """Non-blocking socket bound to the address
+
+    reuse_port - set SO_REUSEPORT so that several processes can bind the same address and the
+        kernel balances incoming connections between them
+    """
     listener_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     listener_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        listener_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     # non-blocking mode
     listener_socket.settimeout(0)
     try:
@@ -74,19 +107,32 @@ def bound_socket(addr, port):
         raise ProxyException(msg)
     return listener_socket
 
+def host_port(host):
+    """Split "host[:port]" into the address tuple, the port defaults to DEFAULT_PORT
+
+    host - bytes or str
+    return - (str, int)
+    """
+    host = to_str(host)
+    try:
+        host, port = host.split(":")
+        port = int(port)
+    except ValueError:
+        port = DEFAULT_PORT
+    return host, port
+
 def connected_socket(host, *, timeout=0):
+    host, port = host_port(host)
+    address = get_resolver().lookup(host)
+    if address is None:
+        return None
     sender_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sender_socket.settimeout(timeout)
-    host = to_str(host)
     try:
-        try:
-            host, port = host.split(":")
-            port = int(port)
-        except ValueError:
-            port = DEFAULT_PORT
-        sender_socket.connect((host, port))
+        sender_socket.connect((address, port))
     except OSError:
-        proc_error("Failed to connect socket to %s:%i" % (host, DEFAULT_PORT))
+        proc_error("Failed to connect socket to %s:%i" % (host, port))
+        sender_socket.close()
     else:
         return sender_socket
 
@@ -103,6 +149,60 @@ def sock_status(sock):
 def is_connected(fd):
     return TCP_ESTABLISHED == sock_status(fd)
 
+def peer_closed(sock):
+    """Check a readable socket without consuming the data
+
+    return - True if the peer has shut the connection down or it's broken
+    """
+    try:
+        return not sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+    except BlockingIOError:
+        return False
+    except OSError:
+        return True
+
+def idle_alive(sock):
+    """Check an idle keep-alive connection before reusing it
+
+    return - False if the peer has closed it or sent something unexpected
+    """
+    # a socket in timeout mode would wait for data before recv, despite MSG_DONTWAIT
+    timeout = sock.gettimeout()
+    sock.settimeout(0)
+    try:
+        sock.recv(1, socket.MSG_PEEK)
+        return False
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.settimeout(timeout)
+
+def recv_available(sock, limit):
+    """Read what has arrived on the socket without waiting for more
+
+    limit - int, bytes to read at most
+    return - bytes, empty if nothing has arrived or the peer has shut down
+    """
+    # a socket in timeout mode would wait for data before recv, despite MSG_DONTWAIT
+    timeout = sock.gettimeout()
+    sock.settimeout(0)
+    chunks = []
+    try:
+        while limit > 0:
+            chunk = sock.recv(min(limit, TUNNEL_CHUNK))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            limit -= len(chunk)
+    except OSError:
+        # nothing more for now, a failure shows up on the next read
+        pass
+    finally:
+        sock.settimeout(timeout)
+    return b"".join(chunks)
+
 def send_all(socket, data, debug=False):
     try:
         socket.sendall(data)
@@ -113,6 +213,26 @@ def send_all(socket, data, debug=False):
         proc_error("Sending failed: %s" % str(errv))
         return False
 
+def send_file(socket_, head, opened):
+    """Send the head, then the file contents with sendfile, so they aren't copied through the
+    user space
+
+    head - bytes, sent before the file
+    opened - (file object, offset, size), the file is closed afterwards
+    return - bool, True on success
+    """
+    file_, offset, size = opened
+    try:
+        # let the head go in the same segment as the file beginning
+        socket_.sendall(head, socket.MSG_MORE)
+        socket_.sendfile(file_, offset, size)
+        return True
+    except OSError as errv:
+        proc_error("Sending failed: %s" % str(errv))
+        return False
+    finally:
+        file_.close()
+
 def shutdown(socket_):
     try:
         socket_.shutdown(socket.SHUT_WR)
@@ -122,71 +242,141 @@ def shutdown(socket_):
             raise
     socket_.close()
 
-def tunnel(self, sock_orig, sock_client):            
-    """Pipe data between 2 sockets
-
-    This looks awful!
-    TODO: Refactor this with SELECT
-    
-    sock_orig - socket
-    sock_client - socket
+class TunnelDirection:
+    """Moves the data one way between two non-blocking sockets: through a pipe with os.splice
+    on Linux, so it isn't copied to the user space, through a buffer otherwise. A new piece is
+    read only when the previous one is written, which keeps a slow reader from flooding us
     """
-    BUF_SIZE = 4096
-    """This sockets should be in timeout mode for this implementation. They are  
-    supposed to be closed after  tunnel finishes
-    """
-    TIMEOUT = 5 
+    def __init__(self, sock_from, sock_to):
+        self.sock_from = sock_from
+        self.sock_to = sock_to
+        # bytes read and not written yet
+        self.pending = 0
+        # bytes written
+        self.moved = 0
+        # the reading side has shut down
+        self.eof = False
+        # eof and everything written; the writing side has been shut down
+        self.done = False
+        self._buffer = b""
+        self._pipe = None
+        if hasattr(os, "splice"):
+            try:
+                self._pipe = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+            except OSError as errv:
+                proc_error("Tunnel pipe failed, copying: %s" % str(errv))
 
-    def log_code(code, comment, level=logging.DEBUG):
-        proc_name = multiprocessing.current_process().name
-        message_f = "%s:%s " % (proc_name, code)
-        log(message_f, level)
+    def want_read(self):
+        return not self.eof and not self.pending
 
-    def read_all(stream):
-        data = b"" 
-        while 1:
-            try:
-                chunk = stream.recv(BUF_SIZE)
-                data += chunk
-            except socket.error as e:
-                if 11 == e.errno:
-                    log_code("JN ", "No data")
-                    return data, True
-                else:
-                    log_code("JErr0 " + str(e), "unknown error")
-                    return data, False
-            # empty chunk means client shutted down
-            if 0 == len(chunk) :
-                log_code("JF", "Tunnel finish")
-                """SEND undelivered"""
-                return data, False
-
-    sock_orig.settimeout(TIMEOUT)                    
-    sock_client.settimeout(TIMEOUT)                    
-
-    # log_code("JCl", "")
-    log_code("JS", "", level=logging.INFO)
-    while 1:
+    def want_write(self):
+        return bool(self.pending)
+
+    def read(self):
+        """Read the next piece, OSError is raised if the socket fails
+
+        return - bool, False if there is nothing to read yet
+        """
         try:
-            cl_data, status = read_all(sock_client)                    
-            # log_code("JOr " + str(len(cl_data)), "")
-            if cl_data:
-                sock_orig.sendall(cl_data)
-            if not status:
-                log_code("JF", "", level=logging.INFO)
-                return
+            if self._pipe:
+                try:
+                    size = os.splice(self.sock_from.fileno(), self._pipe[1], TUNNEL_CHUNK,
+                                     flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+                except OSError as errv:
+                    if errno.EINVAL != errv.errno:
+                        raise
+                    # this kind of socket can't be spliced
+                    self.close()
+                    return self.read()
+            else:
+                self._buffer = memoryview(self.sock_from.recv(TUNNEL_CHUNK))
+                size = len(self._buffer)
+        except BlockingIOError:
+            return False
+        if size:
+            self.pending = size
+        else:
+            self.eof = True
+            self._finish()
+        return True
 
-            orig_data, status = read_all(sock_orig)
-            # log_code("JCl " + str(len(orig_data)), "")
-            if orig_data:
-                sock_client.sendall(orig_data)
-            if not status:
-                log_code("JF", "", level=logging.INFO)
-                return
+    def write(self):
+        """Write what has been read, OSError is raised if the socket fails
 
-        except OSError as errv:
-            log_code("JErr1 " + str(errv.errno) + str(errv), "Socket err")
-            return
+        return - bool, False if the socket can't take anything yet
+        """
+        try:
+            if self._pipe:
+                size = os.splice(self._pipe[0], self.sock_to.fileno(), self.pending,
+                                 flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            else:
+                size = self.sock_to.send(self._buffer)
+                self._buffer = self._buffer[size:]
+        except BlockingIOError:
+            return False
+        self.pending -= size
+        self.moved += size
+        return True
+
+    def _finish(self):
+        """Pass the half-close on: the other side still can send"""
+        if self.eof and not self.pending and not self.done:
+            self.done = True
+            try:
+                self.sock_to.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
 
+    def close(self):
+        """Release the pipe, the sockets are the caller's"""
+        if self._pipe:
+            for fd in self._pipe:
+                os.close(fd)
+            self._pipe = None
 
+def tunnel(sock_client, sock_orig, idle_timeout):
+    """Pipe data between 2 sockets both ways until both have shut down, one of them fails or
+    nothing is moved for idle_timeout seconds. The sockets are left non-blocking, the caller
+    closes them
 
+    return - (int, int) bytes sent to origin, bytes sent to client
+    """
+    directions = (TunnelDirection(sock_client, sock_orig), TunnelDirection(sock_orig, sock_client))
+    selector = selectors.DefaultSelector()
+    registered = {}
+    try:
+        for sock in (sock_client, sock_orig):
+            sock.setblocking(False)
+        while not all(direction.done for direction in directions):
+            events = {sock_client: 0, sock_orig: 0}
+            for direction in directions:
+                if direction.want_read():
+                    events[direction.sock_from] |= selectors.EVENT_READ
+                if direction.want_write():
+                    events[direction.sock_to] |= selectors.EVENT_WRITE
+            for sock, mask in events.items():
+                if mask == registered.get(sock, 0):
+                    continue
+                if not mask:
+                    selector.unregister(sock)
+                elif registered.get(sock):
+                    selector.modify(sock, mask)
+                else:
+                    selector.register(sock, mask)
+                registered[sock] = mask
+            if not selector.select(idle_timeout):
+                log("Tunnel idle for %i seconds" % idle_timeout)
+                break
+            for direction in directions:
+                # what has been read is likely to be written at once
+                if direction.want_read():
+                    direction.read()
+                while direction.want_write() and direction.write():
+                    pass
+    except OSError as errv:
+        log("Tunnel closed: %s" % str(errv))
+    finally:
+        selector.close()
+        for direction in directions:
+            direction.close()
+    return directions[0].moved, directions[1].moved
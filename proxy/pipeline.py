@@ -0,0 +1,162 @@
+"""
+Updated: 2017
+Author: Sergei Shliakhtin
+Contact: xxx.serj@gmail.com
+Notes: Pipelined requests fetched ahead
+
+When a client pipelines its requests, the worker reads what it has sent so far and parses the
+complete requests following the current one. The ones to be forwarded to the origin server (GET, not in the
+cache) are sent at once over their own connections, while the worker is still busy with the
+previous requests; the responses are read into memory. The worker goes on serving the requests
+one by one in their order, taking the response fetched ahead when the turn of a request comes,
+so the responses are sent back in the request order.
+
+A response fetched ahead isn't used if the resource state has changed meanwhile, e.g. it has
+been cached by another process; it's requested again if the fetch ahead has failed.
+
+With collapsed forwarding a fetch ahead is started only by the leader of the resource fetch, and
+the flight is held until the request's turn comes and its response is saved. A resource being
+fetched by another process isn't fetched ahead, the request waits for it on its turn. Two
+processes leading each other's next requests ahead wait for each other at most wait_timeout.
+"""
+
+import concurrent.futures
+
+from proxy.config import Config
+from proxy.const import Const
+from proxy.http_parser import HttpParser
+from proxy.logger import proc_error
+from proxy.message_reader import set_keep_alive
+import proxy.network as net
+from proxy.request_reader import RequestReader
+from proxy.response_reader import ResponseReader
+
+# Seconds to wait for the origin server to connect and to respond
+ORIGIN_TIMEOUT = 20
+# Bytes of the pipelined requests read ahead from a client
+MAX_READ_AHEAD = 65536
+# Pipelined requests looked at after the current one; they're parsed again on every turn
+LOOK_AHEAD = 16
+
+def complete_requests(data, limit=LOOK_AHEAD):
+    """data - bytes read from client, starting with a request
+    limit - int, requests to parse at most
+    return - list of RequestReader, the complete requests at the beginning of data
+    """
+    requests = []
+    while data and len(requests) < limit:
+        parser = HttpParser()
+        parser.feed(data)
+        if not parser.done or parser.error:
+            break
+        request = RequestReader(None, parser=parser)
+        if not request.ok:
+            break
+        requests.append(request)
+        data = request.tail
+    return requests
+
+def ahead_message(request):
+    """request - RequestReader
+    return - bytes, the request to send over a connection of its own
+    """
+    return set_keep_alive(request.message, len(request.header), keep_alive=False)
+
+def fetch(host, request_message):
+    """Request the resource over a new origin connection. Blocks until done
+
+    host - bytes, "host[:port]"
+    request_message - bytes, with Connection: close if it has Connection
+    return - ResponseReader or None on failure
+    """
+    try:
+        origin_srv = net.connected_socket(host, timeout=ORIGIN_TIMEOUT)
+        if not origin_srv:
+            return None
+        try:
+            if not net.send_all(origin_srv, request_message):
+                return None
+            return ResponseReader(origin_srv)
+        finally:
+            net.shutdown(origin_srv)
+    except OSError as errv:
+        proc_error("Fetch ahead failed: %s" % str(errv))
+        return None
+
+class PipelinePrefetcher:
+    """Origin fetches of the pipelined requests of one client, started before their turn"""
+
+    def __init__(self, spawn, max_ahead, flights=None):
+        """
+        spawn - callable(host, request_message) starting the fetch, returns a
+            concurrent.futures.Future or an asyncio.Future of ResponseReader or None
+        max_ahead - int, fetches started and not taken yet
+        flights - FlightRegistry or None if collapsed forwarding is disabled
+        """
+        self._spawn = spawn
+        self.max_ahead = max_ahead
+        self._flights = flights
+        #cache location -> (request message, future, Flight led or None)
+        self._ahead = {}
+
+    @staticmethod
+    def max_ahead_from_config():
+        """return - int, requests of one client fetched ahead, 0 if disabled"""
+        return int(Config.value(Const.MAIN_SECTION, "pipeline_fetch_ahead"))
+
+    @staticmethod
+    def threaded(threads, flights=None):
+        """For the sync worker: the fetches run in a pool of threads
+
+        threads - int, fetches running at the same time
+        flights - FlightRegistry or None
+        return - PipelinePrefetcher
+        """
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads,
+                                                         thread_name_prefix="ahead")
+        return PipelinePrefetcher(lambda host, message: executor.submit(fetch, host, message),
+                                  threads, flights)
+
+    def start(self, request):
+        """Start fetching the request unless it's being fetched already
+
+        request - RequestReader, GET
+        return - bool, True if started
+        """
+        if request.cache_location in self._ahead or len(self._ahead) >= self.max_ahead:
+            return False
+        flight = None
+        if self._flights:
+            flight = self._flights.join(request.cache_location)
+            if not flight.leader:
+                #fetched by another process, waited for on its turn
+                flight.release()
+                return False
+        self._ahead[request.cache_location] = (request.message,
+                                               self._spawn(request.hostname,
+                                                           ahead_message(request)),
+                                               flight)
+        return True
+
+    def take(self, request):
+        """request - RequestReader, its turn has come
+        return - (future of ResponseReader, Flight or None) if it has been fetched ahead,
+            (None, None) otherwise. The caller leads the flight and releases it once the
+            response is saved
+        """
+        message, future, flight = self._ahead.pop(request.cache_location, (None, None, None))
+        if future is None:
+            return None, None
+        if message != request.message:
+            #another request for the same resource
+            future.cancel()
+            return None, flight
+        return future, flight
+
+    def clear(self):
+        """Forget the fetches nobody is going to take, the client is gone"""
+        for _, future, flight in self._ahead.values():
+            future.cancel()
+            if flight:
+                flight.release()
+        self._ahead.clear()
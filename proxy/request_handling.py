@@ -0,0 +1,401 @@
+"""
+Updated: 2017
+Author: Sergei Shliakhtin
+Contact: xxx.serj@gmail.com
+Notes: Request handling shared by the worker engines
+
+ConnectionWorkerProcess and AsyncWorkerProcess differ in the way they wait for the sockets and
+the storage. Whether a request is served from the cache, revalidated or forwarded, what the
+origin response turns into, what is sent back on failures, counted and logged is decided here;
+the engines do the reads and writes the decisions call for.
+"""
+
+import functools
+import multiprocessing
+import time
+
+from proxy.background_refresh import BackgroundRefresher
+from proxy.collapsed_forwarding import FlightRegistry
+from proxy.compression import Compressor
+from proxy.config import Config
+from proxy.const import Const
+from proxy import compression, freshness, pipeline
+from proxy.freshness import CachePolicy
+import proxy.http_response as Response
+from proxy.http_response import add_ok_status
+from proxy.logger import log_basic_config, logf
+from proxy.message_reader import set_keep_alive
+import proxy.network as net
+from proxy.request_reader import RequestReader
+from proxy.resolver import get_resolver
+import proxy.storage
+from proxy import tracing
+from proxy.tracing import SlowRequestLog
+from proxy.upstream_pool import UpstreamPool
+
+# What to do with the origin response, see RequestHandling._origin_outcome
+SEND, RETRY, REVALIDATED, STALE, BAD_GATEWAY, GATEWAY_TIMEOUT, TRUNCATED = list(range(7))
+
+class RequestHandling:
+    """Base of the worker engines, holds the process wide objects the requests are handled with"""
+
+    def _init_handling(self, process_data, write_queue=None, log_queue=None):
+        """Initialize the variables common to the engines. Should be called in child process
+
+        process_data - ProcessData associated with this process
+        write_queue - multiprocessing.Queue of the cache writer processes or None
+        log_queue - multiprocessing.Queue of the log process or None
+        """
+        log_basic_config(log_queue)
+        self._use_cache = ("True" == Config.value(Const.STORAGE_SECTION, "enable_cache"))
+        self._stream_responses = ("True" == Config.value(Const.MAIN_SECTION, "stream_responses"))
+        self._tunnel_idle_timeout = float(Config.value(Const.MAIN_SECTION, "tunnel_idle_timeout"))
+        self._storage = None
+        self._policy = None
+        self._flights = None
+        self._refresher = None
+        self._pool = UpstreamPool.from_config()
+        self._proc_data = process_data
+        self._metrics = process_data.metrics
+        self._slow_log = SlowRequestLog.from_config()
+
+        if self._use_cache:
+            self._storage = proxy.storage.get_storage(write_queue, self._metrics)
+            self._flights = FlightRegistry.from_config()
+            self._refresher = BackgroundRefresher.from_config(self._flights)
+            self._policy = CachePolicy(self._storage, background_refresh=bool(self._refresher),
+                                       compressor=Compressor.from_config())
+
+    def _log_tag(self):
+        """return - str, put between the process name and the message code"""
+        return ""
+
+    def _log_code(self, code, comment):
+        """Log a message code instead of a full message. Usable to fit many messages in one row
+
+        code - text to output
+        comment - not used
+        """
+        logf("%s:%s%s ", multiprocessing.current_process().name, self._log_tag(), code)
+
+    def _bad_request(self):
+        """Count a request which couldn't be read completely
+
+        return - bytes, the response to client
+        """
+        self._log_code("XX", "Request parse error")
+        self._metrics.count("failed_reads")
+        self._metrics.count("requests")
+        return Response.RESPONSE_400
+
+    def _unsupported(self, request):
+        """Count a request of unsupported method/protocol
+
+        request - RequestReader
+        return - bytes, the response to client
+        """
+        self._log_code("XXX {}".format(request.method_str), "Unsupported method")
+        self._metrics.count("failed_reads")
+        return Response.RESPONSE_501
+
+    def _finish_trace(self, request):
+        """Add the phase timings of the request and the resolver lookups to the metrics, trace
+        the request if it's slow, write its access log record
+
+        request - RequestReader, done with
+        """
+        for phase, seconds in request.trace.phases.items():
+            self._metrics.observe(phase, seconds)
+        if self._slow_log:
+            self._slow_log.check(request)
+        tracing.log_request(request)
+        get_resolver().publish(self._metrics)
+
+    def _pipelined(self, client_sock, request):
+        """Read what else the client has pipelined after the request
+
+        client_sock - socket, read without blocking
+        request - RequestReader, its tail gets the data read
+        return - list of RequestReader, the complete GET requests of other resources after it
+        """
+        request.tail += net.recv_available(client_sock, pipeline.MAX_READ_AHEAD - len(request.tail))
+        return [ahead for ahead in pipeline.complete_requests(request.tail)
+                if RequestReader.GET == ahead.method
+                and ahead.cache_location != request.cache_location]
+
+    def _origin_request(self, request):
+        """Don't pass client "Connection" to origin server, according to HTTP Spec 14.10 (Header
+        Field Definitions: Connection). Ask to keep the server connection open if it's going to
+        be pooled, close otherwise
+
+        request - RequestReader
+        return - bytes, the request to send to the origin server
+        """
+        return set_keep_alive(request.message, len(request.header), keep_alive=bool(self._pool))
+
+    def _needs_flight(self, state, flight):
+        """state - CachePolicy state of the resource
+        flight - Flight led already or None
+        return - bool, the resource is to be fetched under collapsed forwarding
+        """
+        return (state not in (CachePolicy.FRESH, CachePolicy.STALE_REVALIDATE) and self._flights
+                and not flight)
+
+    def _lead_flight(self, flight, state):
+        """The flight of the resource has been joined as its leader
+
+        state - CachePolicy state of the resource looked up again after joining
+        return - Flight to be released once the response is saved or None
+        """
+        if CachePolicy.FRESH == state:
+            #the previous leader has just landed
+            flight.release()
+            return None
+        return flight
+
+    def _refresh_behind(self, request, cached):
+        """Start refreshing the stale copy in the background, it's served meanwhile
+
+        cached - bytes, the cached resource or None if it's gone
+        return - bool, True if it's to be served
+        """
+        if not cached:
+            return False
+        self._refresher.start(request.cache_location, request.hostname,
+            set_keep_alive(request.message, len(request.header), keep_alive=False), cached)
+        return True
+
+    def _revalidation(self, request_message, cached, state):
+        """Ask the origin server if the cached copy is still good
+
+        request_message - bytes, the request to send
+        cached - bytes, the cached resource or None if it's gone
+        state - CachePolicy.STALE or CachePolicy.STALE_IF_ERROR
+        return - (bytes, the request to send; bool, serve cached on origin errors) or None to
+            forward the request as it is
+        """
+        if not cached:
+            return None
+        conditional = freshness.conditional_request(request_message,
+                                                    freshness.cached_header(cached))
+        stale_if_error = CachePolicy.STALE_IF_ERROR == state
+        if conditional or stale_if_error:
+            return conditional or request_message, stale_if_error
+        return None
+
+    def _open_cached(self, cache_location, identity_only):
+        """Open the cached resource file to be sent with sendfile
+
+        identity_only - bool, the client doesn't accept gzip
+        return - (file object, offset, size) as returned by fetch_file() or None if the storage
+            doesn't keep it in a file or it's gzipped for a client not accepting gzip
+        """
+        opened = self._storage.fetch_file(cache_location)
+        if opened and identity_only and compression.is_gzip(compression.peek_header(opened)):
+            # decoded in memory
+            opened[0].close()
+            return None
+        return opened
+
+    def _cached_response(self, request, cached):
+        """A client conditional request is answered with 304 Not Modified if it's satisfied. A
+        gzipped resource is decoded for a client not accepting gzip
+
+        request - RequestReader
+        cached - bytes, the resource
+        return - bytes, the response to client; None if the resource can't be decoded
+        """
+        request_header = request.header
+        header = freshness.cached_header(cached)
+        if freshness.is_conditional(request_header) and freshness.not_modified(request_header, header):
+            request.trace.status = Const.HTTP_NOT_MODIFIED
+            return freshness.not_modified_response(header)
+        if not compression.accepts_gzip(request_header) and compression.is_gzip(header):
+            cached = compression.decoded(cached)
+            if not cached:
+                return None
+        request.trace.status = Const.HTTP_OK
+        return add_ok_status(cached)
+
+    def _cache_sent(self, request, sent, code, comment):
+        """Count a response from cache
+
+        request - RequestReader
+        sent - bool, the send result
+        code, comment - logged on success
+        return - bool, True if the client connection can be used further
+        """
+        if not sent:
+            #failed to send cache reply
+            self._log_code("CX", "Fail to send from cache")
+            self._metrics.count("errors")
+            return False
+        self._log_code(code, comment)
+        self._served(request, "hit")
+        return True
+
+    def _origin_outcome(self, response, reused, cached, stale_if_error):
+        """Decide what to do with the origin response
+
+        response - ResponseReader or None if the request couldn't be sent
+        reused - bool, the request has been sent over a pooled connection
+        cached - bytes, the stale cached resource being revalidated or None
+        stale_if_error - bool, serve cached if the origin server fails or replies 5xx
+        return - SEND, RETRY over a new connection, REVALIDATED, STALE, BAD_GATEWAY or
+            GATEWAY_TIMEOUT
+        """
+        _log_code = self._log_code
+        if response is None:
+            #origin server request sending failed
+            _log_code("RX", "Origin server communication failed")
+            return STALE if stale_if_error else BAD_GATEWAY
+        self._metrics.count("bytes_in", len(response.message))
+        if not response.ok:
+            if response.timeout and reused:
+                #the pooled connection has been closed by the server meanwhile
+                _log_code("RR", "Pooled origin connection closed")
+                return RETRY
+            if response.timeout:
+                #empty response connection is shutdown
+                _log_code("RX", "Origin response time out")
+            else:
+                #server stopped transferring in the middle
+                _log_code("RXX", "Origin truncated response")
+            return STALE if stale_if_error else GATEWAY_TIMEOUT
+        if cached is not None and Const.HTTP_NOT_MODIFIED == response.response_status:
+            return REVALIDATED
+        if stale_if_error and response.response_status >= Const.HTTP_SERVER_ERROR:
+            _log_code("S+" + str(response.response_status), "Non-ok from origin")
+            return STALE
+        return SEND
+
+    def _relay_outcome(self, relay, received, reused):
+        """Decide what to do once the origin response relay stops
+
+        relay - ResponseRelay
+        received - int, bytes read from the origin server
+        reused - bool, the request has been sent over a pooled connection
+        return - SEND, RETRY over a new connection, GATEWAY_TIMEOUT if nothing has been sent to
+            client yet or TRUNCATED if client has got a part already
+        """
+        self._metrics.count("bytes_in", received)
+        if relay.header is None:
+            if reused and not received:
+                #the pooled connection has been closed by the server meanwhile
+                self._log_code("RR", "Pooled origin connection closed")
+                return RETRY
+            self._log_code("RX", "Origin response time out")
+            return GATEWAY_TIMEOUT
+        if not relay.done or relay.error:
+            #server stopped transferring in the middle
+            self._log_code("RXX", "Origin truncated response")
+            self._metrics.count("errors")
+            return TRUNCATED
+        return SEND
+
+    def _gateway_error(self, request, outcome):
+        """Count the origin failure
+
+        outcome - BAD_GATEWAY or GATEWAY_TIMEOUT
+        return - bytes, the response to client
+        """
+        self._metrics.count("errors")
+        if BAD_GATEWAY == outcome:
+            request.trace.status = Const.HTTP_BAD_GATEWAY
+            return Response.RESPONSE_502
+        request.trace.status = Const.HTTP_GATEWAY_TIMEOUT
+        return Response.RESPONSE_504
+
+    def _origin_sent(self, request, sent, status, size=0):
+        """Count a response from the origin server
+
+        request - RequestReader
+        sent - bool, the send result
+        status - int, the response status
+        size - int, bytes sent, if not counted already
+        return - bool, True if sent
+        """
+        if not sent:
+            #failed sending to client
+            self._log_code("TX", "Client ok response send failed")
+            self._metrics.count("errors")
+            return False
+        #successful response delivery
+        self._log_code("T", "Client response send success")
+        request.trace.status = status
+        if size:
+            self._count_out(request, size)
+        self._served(request, "miss")
+        return True
+
+    def _cacheable(self, status):
+        """status - int, the origin response status
+        return - bool, the response is to be saved
+        """
+        if not (self._use_cache and self._storage):
+            return False
+        if Const.HTTP_OK != status:
+            #not saving non-success response
+            self._log_code("S+" + str(status), "Non-ok from origin")
+            return False
+        return True
+
+    def _relay_writer(self, request):
+        """return - callable opening the cache writer for ResponseRelay or None"""
+        if self._use_cache and self._storage:
+            return functools.partial(self._policy.writer, request.cache_location)
+        return None
+
+    def _release_origin(self, host, origin_srv, reusable):
+        """Done with the origin connection: return it to the pool or close
+
+        reusable - bool, the response has been read completely and the server keeps the connection
+        """
+        if self._pool:
+            self._pool.put(host, origin_srv, reusable)
+        else:
+            net.shutdown(origin_srv)
+
+    def _tunnel_failed(self):
+        """return - bytes, the response to client"""
+        self._log_code("JX", "Tunnel connect failed")
+        self._metrics.count("errors")
+        return Response.RESPONSE_502
+
+    def _tunnel_done(self, sent, received):
+        """sent, received - int, bytes moved from client and to client"""
+        self._log_code("JF %i/%i" % (sent, received), "Tunnel finish")
+        self._metrics.count("tunnel_bytes_up", sent)
+        self._metrics.count("tunnel_bytes_down", received)
+
+    def _count_sent(self, request, sent, size):
+        """Count the bytes sent to client if sent
+
+        request - RequestReader
+        sent - bool, the send result
+        size - int, bytes sent
+        return - sent
+        """
+        if sent:
+            self._count_out(request, size)
+        return sent
+
+    def _count_out(self, request, size):
+        """Count the bytes sent to client
+
+        request - RequestReader
+        size - int, bytes sent
+        """
+        self._metrics.count("bytes_out", size)
+        request.trace.sent += size
+
+    def _served(self, request, path):
+        """Count a response sent to client completely
+
+        request - RequestReader
+        path - str, "hit" - from cache, "miss" - from the origin server
+        """
+        self._metrics.count("complete")
+        self._metrics.count("hits" if "hit" == path else "misses")
+        self._metrics.observe(path, time.monotonic() - request.received)
+        request.trace.outcome = path
@@ -6,6 +6,8 @@ Contact: xxx.serj@gmail.com
 Only GET and CONNECT methods are currently supported
 """
 
+import time
+
 from proxy.message_reader import MessageReader
 
 class RequestReader(MessageReader):
@@ -13,15 +15,20 @@ class RequestReader(MessageReader):
     """
     GET, CONNECT, OTHER = list(range(3))    
     
-    def __init__(self, stream, pipeline_tail=b""):
+    def __init__(self, stream, pipeline_tail=b"", parser=None):
         """ Get incoming bytes, read as long as needed and split into desired fields
 
         stream - open socket to read from
         pipeline_tail - bytes from this request, already read as the tail of 
             previous message
+        parser - HttpParser holding the complete message, if it has been read already
         """
         # read message from stream
-        MessageReader.__init__(self, stream,  pipeline_tail)
+        MessageReader.__init__(self, stream,  pipeline_tail, parser)
+        #time.monotonic() the request has been read, for the latency metrics
+        self.received = time.monotonic()
+        #tracing.RequestTrace of the phase timings, set by the worker
+        self.trace = None
 
         self.cache_location = b""
         self.hostname = b""
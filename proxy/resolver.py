@@ -0,0 +1,149 @@
+"""
+Updated: 2017
+Author: Sergei Shliakhtin
+Contact: xxx.serj@gmail.com
+Notes: Host name resolution cache
+
+The system resolver doesn't tell the record TTL, so cached names live for the configured
+time. Every worker process has its own cache; its hits, misses and failures go to the worker
+metrics.
+"""
+
+import socket
+import time
+
+from proxy.config import Config
+from proxy.const import Const
+from proxy.logger import proc_error
+
+class Resolver:
+    """Resolves host names to IPv4 addresses, remembering both successful and failed lookups"""
+
+    def __init__(self, positive_ttl, negative_ttl, hosts=None):
+        """
+        positive_ttl - float, seconds a resolved address is kept; 0 disables caching
+        negative_ttl - float, seconds a failed lookup is kept; 0 disables caching
+        hosts - dict name -> address, the static table looked up first and never expiring
+        """
+        self._positive_ttl = positive_ttl
+        self._negative_ttl = negative_ttl
+        self._hosts = hosts or {}
+        # name -> (address or None, expiry time)
+        self._cache = {}
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        #(hits, misses, failures) added to the worker metrics already, see publish()
+        self._published = (0, 0, 0)
+
+    @staticmethod
+    def from_config():
+        """return - Resolver configured in proxy.ini"""
+        hosts = {}
+        for entry in Config.value(Const.RESOLVER_SECTION, "hosts").split(","):
+            if "=" in entry:
+                name, address = entry.split("=", 1)
+                hosts[name.strip()] = address.strip()
+        # a disabled cache keeps no failures either, every lookup goes to the system resolver
+        positive_ttl, negative_ttl = 0, 0
+        if "True" == Config.value(Const.RESOLVER_SECTION, "enable_cache"):
+            positive_ttl = float(Config.value(Const.RESOLVER_SECTION, "positive_ttl"))
+            negative_ttl = float(Config.value(Const.RESOLVER_SECTION, "negative_ttl"))
+        return Resolver(positive_ttl, negative_ttl, hosts)
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def summary(self):
+        """return - str, the statistics for logs"""
+        return "DNS hits:%i misses:%i failures:%i hit rate:%.2f" % (self.hits, self.misses,
+            self.failures, self.hit_rate)
+
+    def publish(self, metrics):
+        """Add the lookups counted since the previous call to the worker metrics. Should be
+        called from the worker main thread, the refresh threads only count here
+
+        metrics - WorkerMetrics
+        """
+        counts = (self.hits, self.misses, self.failures)
+        for name, count, published in zip(("dns_hits", "dns_misses", "dns_failures"), counts,
+                                           self._published):
+            if count != published:
+                metrics.count(name, count - published)
+        self._published = counts
+
+    def cached(self, host):
+        """Look the name up without querying the system resolver
+
+        host - str
+        return - (bool found, address or None if the name is known to fail)
+        """
+        if host in self._hosts:
+            return True, self._hosts[host]
+        if _is_address(host):
+            return True, host
+        entry = self._cache.get(host)
+        if entry and entry[1] > time.time():
+            self.hits += 1
+            return True, entry[0]
+        self.misses += 1
+        return False, None
+
+    def store(self, host, address):
+        """Remember the result of a lookup
+
+        host - str
+        address - str, None if the lookup has failed
+        """
+        if address is None:
+            self.failures += 1
+            ttl = self._negative_ttl
+        else:
+            ttl = self._positive_ttl
+        if ttl > 0:
+            self._cache[host] = (address, time.time() + ttl)
+        elif host in self._cache:
+            del self._cache[host]
+
+    def lookup(self, host):
+        """Resolve the name, blocking on the system resolver if it's not cached
+
+        host - str
+        return - str address or None if it can't be resolved
+        """
+        found, address = self.cached(host)
+        if found:
+            return address
+        address = _resolve(host)
+        self.store(host, address)
+        return address
+
+def _is_address(host):
+    try:
+        socket.inet_aton(host)
+        return True
+    except OSError:
+        return False
+
+def _resolve(host):
+    """Query the system resolver
+
+    return - str, the first IPv4 address or None
+    """
+    try:
+        infos = socket.getaddrinfo(host, None, socket.AF_INET, socket.SOCK_STREAM)
+    except OSError as errv:
+        proc_error("Failed to resolve %s : %s" % (host, str(errv)))
+        return None
+    return infos[0][4][0] if infos else None
+
+__resolver = None
+
+def get_resolver():
+    """return - the Resolver of this process"""
+    global __resolver
+    if __resolver is None:
+        __resolver = Resolver.from_config()
+    return __resolver
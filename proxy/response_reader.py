@@ -8,24 +8,30 @@ Notes:
 
 import re
 
+from proxy.const import Const
+from proxy.http_parser import HttpParser
 from proxy.logger import proc_error
-from proxy.message_reader import MessageReader
+from proxy.message_reader import MessageReader, keeps_alive, set_keep_alive
 
 class ResponseReader(MessageReader):
     """Extracts response's fields of interest
     """
 
-    def __init__(self, stream):
+    def __init__(self, stream, parser=None):
         """Get incoming bytes, read as long as needed and split into desired fields
 
         stream - open socket to read from
+        parser - HttpParser holding the complete message, if it has been read already
         """
-        MessageReader.__init__(self, stream)
+        MessageReader.__init__(self, stream, parser=parser)
         self.response_status = 0 
         self.response_data = b""
+        #the connection can carry the next request
+        self.reusable = False
 
         if not self.ok:
             return
+        self.reusable = self.delimited and keeps_alive(self.header)
 
         match = re.search(b"(\r\n|\n)", self.message)
         if not match:
@@ -39,5 +45,88 @@ class ResponseReader(MessageReader):
             self.response_status = int(statusParts[1])
         except IndexError:
             proc_error("Bad response (2)")
-            
 
+
+def status_code(header):
+    """header - bytes, starting with the status line
+    return - int, 0 if malformed
+    """
+    try:
+        return int(header.split(None, 2)[1])
+    except (IndexError, ValueError):
+        proc_error("Bad response (2)")
+        return 0
+
+class ResponseRelay:
+    """Passes a response through piece by piece as it arrives from the origin server and tees
+    a successful one into a cache writer, committed only when the response is complete
+    """
+
+    def __init__(self, open_writer=None):
+        """open_writer - callable(header) returning the storage writer for a successful
+            response without status line or None if it's not to be cached; None to skip caching
+        """
+        self._parser = HttpParser()
+        self._open_writer = open_writer
+        self._writer = None
+        self.response_status = 0
+        #headers with the status line, when received
+        self.header = None
+
+    @property
+    def done(self):
+        return self._parser.done
+
+    @property
+    def error(self):
+        return self._parser.error
+
+    @property
+    def caching(self):
+        """The response is being written into the cache"""
+        return self._writer is not None
+
+    @property
+    def reusable(self):
+        """The response is complete and the connection can carry the next request"""
+        return (self.done and not self.error and self._parser.delimited
+                and keeps_alive(self.header))
+
+    def feed(self, data):
+        """Handle data received from the origin server
+
+        data - bytes-like
+        return - bytes to pass to the client now
+        """
+        self._parser.feed(data)
+        if self.header is None:
+            if HttpParser.HEADERS == self._parser.state:
+                return b""
+            self.header = self._parser.header
+            self.response_status = status_code(self.header)
+            header_size = len(self.header)
+            #we expect client to keep sending pipelined requests
+            out = set_keep_alive(self._parser.take(), header_size, keep_alive=True)
+            if self._open_writer and Const.HTTP_OK == self.response_status:
+                self._writer = self._open_writer(self.header)
+            if self._writer:
+                status_end = out.find(b"\n") + 1
+                self._writer.write(out[status_end:])
+            return out
+        out = self._parser.take()
+        if self._writer and out:
+            self._writer.write(out)
+        return out
+
+    def finish(self):
+        """Commit the cached copy if the response is complete, drop it otherwise
+
+        return - bool, True if the response has been saved
+        """
+        if not self._writer:
+            return False
+        writer, self._writer = self._writer, None
+        if self.done and not self.error:
+            return writer.commit()
+        writer.abort()
+        return False
@@ -10,19 +10,52 @@ from proxy import ProxyException
 from proxy.config import Config
 from proxy.const import Const 
 
-def get_storage():
-    """
-    
-    return - Storage object of certain type depending on config setting
-    """
-
+def get_backend_storage():
+    """return - the storage of the type set in proxy.ini, without wrappers"""
     storage_type = Config.value(Const.STORAGE_SECTION, "storage")
     if "DB" == storage_type:
         from proxy.db_storage import DBStorage
         DBStorage.check_init_db()
-        return DBStorage()
+        storage = DBStorage()
     elif "FS" == storage_type:
         from proxy.fs_storage import FSStorage
-        return FSStorage()
+        storage = FSStorage()
     else:
         raise ProxyException('Need either DB or FS storage type in proxy.ini')
+    return storage
+
+def get_storage(write_queue=None, metrics=None):
+    """
+    write_queue - multiprocessing.Queue of the writer processes, the saves are queued there
+        instead of being written at once, see write_behind
+    metrics - WorkerMetrics, counts the saves dropped on a full write_queue
+    return - Storage object of certain type depending on config setting
+    """
+    storage = get_backend_storage()
+    from proxy.cache_index import CacheIndex, IndexedStorage
+    index = CacheIndex.from_config()
+    if index:
+        storage = IndexedStorage(storage, index)
+
+    if write_queue is not None:
+        # above the index, a queued resource is indexed by the writer once it's saved
+        from proxy.write_behind import WriteBehindStorage
+        storage = WriteBehindStorage.from_config(storage, write_queue, metrics)
+
+    from proxy.hot_cache import HotCache, HotCacheStorage
+    hot_cache = HotCache.from_config()
+    if hot_cache:
+        storage = HotCacheStorage(storage, hot_cache)
+    return storage
+
+def init_shared():
+    """Create the storage data shared by the worker processes. Should be called by the main
+    process before the workers start"""
+    backend = get_backend_storage()
+    backend.migrate()
+    from proxy.cache_index import CacheIndex
+    CacheIndex.create_from_config(backend)
+    from proxy.hot_cache import HotCache
+    HotCache.create_from_config()
+    from proxy.collapsed_forwarding import FlightRegistry
+    FlightRegistry.create_from_config()
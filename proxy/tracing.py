@@ -0,0 +1,125 @@
+"""
+Updated: 2017
+Author: Sergei Shliakhtin
+Contact: xxx.serj@gmail.com
+Notes: Request phase timing and slow request traces
+
+A worker times the phases of every GET request it serves: reading the request from the
+client, looking the resource up and reading it from the cache, connecting to the origin
+server (the name resolution and the request sending included), reading the origin response,
+sending the response to the client and writing it into the cache. A phase entered several
+times, e.g. reading and sending a streamed response piece by piece, adds up. The timings go
+into the phase histograms of the worker metrics slot.
+
+A request taking longer than slow_request seconds, from its first byte read to its end, is
+written to the trace_<process> file in log_path as a JSON record with the phase timings, so it
+can be told whether the storage, the origin server or the client has been slow.
+
+Every GET request gets a JSON record in the access log as well, unless the access logger is
+off in loggers.conf.
+"""
+
+import json
+import logging
+import multiprocessing
+import time
+
+from proxy.config import Config
+from proxy.const import Const
+from proxy.logger import ACCESS_LOGGER, enabled, log_access, log_per_process, TRACE_LOGGER
+
+CLIENT_READ = "client_read"
+CACHE_LOOKUP = "cache_lookup"
+ORIGIN_CONNECT = "origin_connect"
+ORIGIN_READ = "origin_read"
+CLIENT_SEND = "client_send"
+CACHE_WRITE = "cache_write"
+PHASES = (CLIENT_READ, CACHE_LOOKUP, ORIGIN_CONNECT, ORIGIN_READ, CLIENT_SEND, CACHE_WRITE)
+
+class RequestTrace:
+    """The phase timings of one request"""
+
+    def __init__(self, arrival):
+        """arrival - float, time.monotonic() the first byte of the request has been read at"""
+        self.arrival = arrival
+        #phase -> seconds
+        self.phases = {}
+        #"hit" or "miss" once the response has been sent completely
+        self.outcome = None
+        #int, the status of the response sent to client
+        self.status = None
+        #bytes sent to client
+        self.sent = 0
+
+    def add(self, phase, seconds):
+        """phase - str, one of PHASES"""
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def phase(self, phase):
+        """return - context manager timing the phase"""
+        return _PhaseTimer(self, phase)
+
+class _PhaseTimer:
+    def __init__(self, trace, phase):
+        self._trace = trace
+        self._phase = phase
+        self._started = None
+
+    def __enter__(self):
+        self._started = time.monotonic()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._trace.add(self._phase, time.monotonic() - self._started)
+
+class SlowRequestLog:
+    """Writes the traces of the requests slower than the threshold"""
+
+    def __init__(self, threshold):
+        """threshold - float, seconds"""
+        self.threshold = threshold
+
+    @staticmethod
+    def from_config():
+        """return - SlowRequestLog configured in proxy.ini or None if disabled"""
+        threshold = float(Config.value(Const.METRICS_SECTION, "slow_request"))
+        if threshold <= 0:
+            return None
+        return SlowRequestLog(threshold)
+
+    def check(self, request):
+        """Trace the request if it has been slow
+
+        request - RequestReader, done with; its trace is a RequestTrace
+        return - bool, True if traced
+        """
+        trace = request.trace
+        total = time.monotonic() - trace.arrival
+        if total < self.threshold:
+            return False
+        record = _record(request, total)
+        record["phases"] = {phase: round(seconds, 6) for phase, seconds in trace.phases.items()}
+        log_per_process(json.dumps(record), TRACE_LOGGER)
+        return True
+
+def log_request(request):
+    """Write the access log record of the request
+
+    request - RequestReader, done with; its trace is a RequestTrace
+    """
+    if enabled(logging.INFO, ACCESS_LOGGER):
+        log_access(json.dumps(_record(request, time.monotonic() - request.trace.arrival)))
+
+def _record(request, total):
+    """request - RequestReader
+    total - float, seconds the request has taken
+    return - dict, the JSON record fields
+    """
+    trace = request.trace
+    return {"time": round(time.time(), 3),
+            "process": multiprocessing.current_process().name,
+            "method": request.method_str.decode("latin-1"),
+            "resource": request.cache_location.decode("latin-1"),
+            "status": trace.status,
+            "outcome": trace.outcome,
+            "bytes": trace.sent,
+            "total": round(total, 6)}
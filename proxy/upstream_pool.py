@@ -0,0 +1,102 @@
+"""
+Updated: 2017
+Author: Sergei Shliakhtin
+Contact: xxx.serj@gmail.com
+Notes: Keep-alive origin server connections
+
+Every worker process keeps its own pool, sockets can't be shared between processes
+without passing them around.
+"""
+
+import collections
+import time
+
+from proxy.config import Config
+from proxy.const import Const
+import proxy.network as net
+
+class UpstreamPool:
+    """Idle keep-alive connections to origin servers keyed by (host, port). A connection is
+    taken out of the pool while a request is being sent over it and put back after the response
+    has been read completely
+    """
+
+    def __init__(self, max_idle, max_per_host, idle_timeout):
+        """
+        max_idle - int, idle connections kept for all the hosts together
+        max_per_host - int, connections kept to one host, idle and in use together
+        idle_timeout - float, seconds an idle connection is kept. Should be less than origin
+            servers' keep-alive timeout
+        """
+        self._max_idle = max_idle
+        self._max_per_host = max_per_host
+        self._idle_timeout = idle_timeout
+        # (host, port) -> list of (socket, time put back), the most recent is the last
+        self._idle = collections.defaultdict(list)
+        self._idle_count = 0
+        # (host, port) -> connections in use
+        self._busy = collections.Counter()
+
+    @staticmethod
+    def from_config():
+        """return - UpstreamPool configured in proxy.ini or None if disabled"""
+        if "True" != Config.value(Const.UPSTREAM_SECTION, "enable_pool"):
+            return None
+        return UpstreamPool(int(Config.value(Const.UPSTREAM_SECTION, "max_idle")),
+                            int(Config.value(Const.UPSTREAM_SECTION, "max_per_host")),
+                            float(Config.value(Const.UPSTREAM_SECTION, "idle_timeout")))
+
+    def get(self, host):
+        """Check out an idle connection which is still alive
+
+        host - bytes, "host[:port]"
+        return - socket or None if there is none; the caller should open a new one then and
+            report it with opened()
+        """
+        key = net.host_port(host)
+        idle = self._idle[key]
+        now = time.time()
+        while idle:
+            sock, since = idle.pop()
+            self._idle_count -= 1
+            if now - since <= self._idle_timeout and net.idle_alive(sock):
+                self._busy[key] += 1
+                return sock
+            sock.close()
+        return None
+
+    def opened(self, host):
+        """Count a new connection to the host as being in use
+
+        host - bytes, "host[:port]"
+        """
+        self._busy[net.host_port(host)] += 1
+
+    def put(self, host, sock, reusable):
+        """Return a connection after use. It's closed if the origin server won't keep it or
+        the limits are reached
+
+        host - bytes, "host[:port]"
+        sock - socket
+        reusable - bool, the response has been read completely and the server keeps the
+            connection open
+        """
+        key = net.host_port(host)
+        self._busy[key] -= 1
+        self._expire()
+        idle = self._idle[key]
+        if (reusable and self._idle_count < self._max_idle
+                and len(idle) + self._busy[key] < self._max_per_host):
+            idle.append((sock, time.time()))
+            self._idle_count += 1
+        else:
+            net.shutdown(sock)
+
+    def _expire(self):
+        """Close the connections idle for longer than idle_timeout"""
+        deadline = time.time() - self._idle_timeout
+        for key, idle in self._idle.items():
+            while idle and idle[0][1] < deadline:
+                sock, since = idle.pop(0)
+                self._idle_count -= 1
+                sock.close()
@@ -0,0 +1,207 @@
+"""
+Updated: 2017
+Author: Sergei Shliakhtin
+Contact: xxx.serj@gmail.com
+Notes: Write-behind of the cached resources
+
+The workers don't wait for the storage to write a response: WriteBehindStorage puts it into a
+bounded queue shared with the writer processes and returns. The writers take the resources
+from the queue by batches and save each batch at once, in one transaction for the DB storage.
+When the queue is full the resource isn't cached, the worker counts it as a dropped write.
+
+WriteBehindStorage wraps the cache index wrapper of the storage backend, so a queued resource
+is indexed by the writer once it's saved: until then it isn't cached for the lookups, instead
+of being found in the index and missing from the storage. With collapsed forwarding its fetch
+is handed over to the writer, so the processes waiting for it keep waiting until it's saved
+(see collapsed_forwarding). A resource larger than max_object_size is written and indexed by
+the worker as before, the queue would hold it whole.
+"""
+
+import queue
+
+from proxy.cache_index import CacheIndex, IndexedStorage
+from proxy.collapsed_forwarding import FlightRegistry
+from proxy.config import Config
+from proxy.const import Const
+import proxy.logger
+from proxy.logger import log_basic_config, proc_error, proc_state
+import proxy.storage
+
+def enabled():
+    """return - bool, the writer processes should be started"""
+    return ("True" == Config.value(Const.WRITE_BEHIND_SECTION, "enable")
+            and "True" == Config.value(Const.STORAGE_SECTION, "enable_cache"))
+
+def create_queue(context):
+    """Should be called from parent process
+
+    context - multiprocessing module or context
+    return - the queue for the worker and writer processes
+    """
+    return context.Queue(int(Config.value(Const.WRITE_BEHIND_SECTION, "queue_size")))
+
+class WriteBehindStorage:
+    """Storage backend wrapper queueing the saves for the writer processes"""
+
+    def __init__(self, storage, write_queue, metrics, max_object_size, flights=None):
+        """
+        storage - the wrapped storage, the backend or the cache index wrapper of it
+        write_queue - multiprocessing.Queue of (key_path, data, expiry)
+        metrics - WorkerMetrics of the worker, counts the writes dropped on a full queue
+        max_object_size - int, larger resources are saved by the wrapped storage directly
+        flights - FlightRegistry or None if collapsed forwarding is off
+        """
+        self._storage = storage
+        self._queue = write_queue
+        self._metrics = metrics
+        self.max_object_size = max_object_size
+        self._flights = flights
+        # a worker exits without waiting for its queued writes to be flushed
+        write_queue.cancel_join_thread()
+
+    @staticmethod
+    def from_config(storage, write_queue, metrics):
+        """return - WriteBehindStorage configured in proxy.ini"""
+        return WriteBehindStorage(storage, write_queue, metrics,
+                                  int(Config.value(Const.WRITE_BEHIND_SECTION, "max_object_size")),
+                                  FlightRegistry.from_config())
+
+    def save(self, key_path, data, expiry=0.0):
+        """return - bool, True if queued or saved; False if dropped"""
+        if len(data) > self.max_object_size:
+            return self._storage.save(key_path, data, expiry)
+        if self._flights:
+            # before the writer can take it
+            self._flights.hand_over(key_path)
+        try:
+            self._queue.put_nowait((key_path, bytes(data), expiry))
+            return True
+        except queue.Full:
+            if self._flights:
+                self._flights.take_back(key_path)
+            self._metrics.count("dropped_writes")
+            return False
+
+    def writer(self, key_path, expiry=0.0):
+        return _QueuedWriter(self, self._storage, key_path, expiry)
+
+    def __getattr__(self, name):
+        # the rest of the storage interface goes to the wrapped storage as it is
+        return getattr(self._storage, name)
+
+class _QueuedWriter:
+    """Collects the pieces to queue the resource on commit. Once it's larger than
+    max_object_size, they go to a writer of the wrapped storage
+    """
+    def __init__(self, storage, backend, key_path, expiry):
+        """
+        storage - WriteBehindStorage
+        backend - the storage it wraps
+        """
+        self._storage = storage
+        self._backend = backend
+        self._key_path = key_path
+        self._expiry = expiry
+        self._parts = []
+        self._size = 0
+        self._writer = None
+
+    def write(self, data):
+        if self._writer:
+            self._writer.write(data)
+            return
+        self._parts.append(bytes(data))
+        self._size += len(data)
+        if self._size > self._storage.max_object_size:
+            self._writer = self._backend.writer(self._key_path, self._expiry)
+            if not self._writer:
+                # can't be saved, drop the rest
+                self._writer = _NullWriter()
+            for part in self._parts:
+                self._writer.write(part)
+            self._parts = []
+
+    def commit(self):
+        """return - bool, True if queued or saved"""
+        if self._writer:
+            return self._writer.commit()
+        data, self._parts = b"".join(self._parts), []
+        return self._storage.save(self._key_path, data, self._expiry)
+
+    def abort(self):
+        if self._writer:
+            self._writer.abort()
+        self._parts = []
+
+class _NullWriter:
+    """Writer of a resource which can't be saved"""
+    def write(self, data):
+        pass
+
+    def commit(self):
+        return False
+
+    def abort(self):
+        pass
+
+class CacheWriter:
+    """Runs in its own process, saving the queued resources by batches"""
+
+    def __init__(self):
+        """Should be called from parent process"""
+        self.is_init = False
+
+    def _init_this_process(self, log_queue=None):
+        """Should be called in child process
+
+        log_queue - multiprocessing.Queue of the log process or None
+        """
+        assert not self.is_init
+        self.is_init = True
+        log_basic_config(log_queue)
+        self._storage = proxy.storage.get_backend_storage()
+        index = CacheIndex.from_config()
+        if index:
+            self._storage = IndexedStorage(self._storage, index)
+        self._flights = FlightRegistry.from_config()
+        self._batch_size = int(Config.value(Const.WRITE_BEHIND_SECTION, "batch_size"))
+
+    def __call__(self, write_queue, stdout_lock, log_queue=None):
+        """Save the resources from the queue until KeyboardInterrupted
+
+        write_queue - multiprocessing.Queue of (key_path, data, expiry)
+        stdout_lock - limit access to STDOUT
+        log_queue - multiprocessing.Queue of the log process, None to write the log directly
+        """
+        self._init_this_process(log_queue)
+        proxy.logger.init_lock(stdout_lock)
+        try:
+            while True:
+                proc_state("Wait writes")
+                #block until there is something to write, then take what has been queued
+                batch = [write_queue.get()]
+                while len(batch) < self._batch_size:
+                    try:
+                        batch.append(write_queue.get_nowait())
+                    except queue.Empty:
+                        break
+                self._save(batch)
+        except KeyboardInterrupt:
+            return
+
+    def _save(self, batch):
+        """batch - list of (key_path, data, expiry)"""
+        proc_state("Write %i" % len(batch))
+        try:
+            saved = self._storage.save_many(batch)
+        except OSError as errv:
+            proc_error("Cache write failed: %s" % str(errv))
+            return
+        finally:
+            if self._flights:
+                # the waiting ones fetch the resource themselves if it hasn't been saved
+                for key_path, data, expiry in batch:
+                    self._flights.landed(key_path)
+        failed = len(saved) - sum(saved)
+        if failed:
+            proc_error("Cache write failed for %i of %i resources" % (failed, len(batch)))
@@ -1,8 +1,9 @@
-
 import unittest
 
-from tests.functional import RequestsFunctional
-suite = unittest.TestLoader().loadTestsFromTestCase(RequestsFunctional)
+from tests import functional
+loader = unittest.TestLoader()
+# the unit tests first, the functional ones start the servers
+suite = unittest.TestSuite([loader.discover("tests", pattern="test_*.py", top_level_dir="."),
+                            loader.loadTestsFromModule(functional)])
 unittest.TextTestRunner(verbosity=2).run(suite)
 
-
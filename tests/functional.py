@@ -8,22 +8,34 @@ Notes:
 To be run from the same directory where proxy.py resides!
 """
 
+import configparser
 from functools import partial
 from multiprocessing import Process
 import os
 import requests
+import shutil
 import signal
+import socket
 import subprocess as sup
+import tempfile
 from time import sleep
-from unittest import TestCase
+from unittest import TestCase, skipUnless
 
 class RequestsFunctional(TestCase):
+    WORKER_MODE = "sync"
+    # storage and fs_layout of proxy.ini the proxy runs with
+    STORAGE = "FS"
+    FS_LAYOUT = "plain"
+    STREAM_RESPONSES = "False"
+    PIPELINE_FETCH_AHEAD = "0"
 
     def setUp(self):        
         # PORT: 127.0.0.1:8000
         print("Starting servers")
         self.orig_proc = sup.Popen(["python3", "tests/origin_server.py"], stderr=sup.STDOUT)
-        self.proxy_proc = sup.Popen(["python3", "proxy.py", "127.0.0.1", "8008", "5"], stderr=sup.STDOUT)
+        self.run_dir = self._make_run_dir()
+        self.proxy_proc = sup.Popen(["python3", os.path.abspath("proxy.py"), "127.0.0.1", "8008",
+            "5", self.WORKER_MODE], stderr=sup.STDOUT, cwd=self.run_dir.name)
         # Give servers some time to start. Strictly speaking it's unknown how log to wait
         # Better solution would be to anlyse STDOUT for started confirmation
         sleep(0.5)
@@ -34,6 +46,40 @@ class RequestsFunctional(TestCase):
         print("Stropping servers")
         self.proxy_proc.send_signal(signal.SIGINT)
         self.orig_proc.send_signal(signal.SIGINT)
+        try:
+            self.proxy_proc.wait(5)
+        except sup.TimeoutExpired:
+            self.proxy_proc.kill()
+        self.run_dir.cleanup()
+
+    def _make_run_dir(self):
+        """The proxy runs in a temporary dir with its own copy of proxy.ini, keeping the cache
+        and the logs there
+
+        return - tempfile.TemporaryDirectory
+        """
+        run_dir = tempfile.TemporaryDirectory()
+        config = configparser.ConfigParser()
+        config.read("proxy.ini")
+        config.set("Storage", "storage", self.STORAGE)
+        config.set("Storage", "fs_layout", self.FS_LAYOUT)
+        config.set("General", "stream_responses", self.STREAM_RESPONSES)
+        config.set("General", "pipeline_fetch_ahead", self.PIPELINE_FETCH_AHEAD)
+        # a stale response is revalidated while the client waits, test_stale_if_error needs
+        # the stale one served on errors
+        config.set("Storage", "stale_while_revalidate", "0")
+        config.set("Storage", "stale_if_error", "3600")
+        config.set("Storage", "cache_path", os.path.join(run_dir.name, "CACHEDIR"))
+        config.set("General", "log_path", os.path.join(run_dir.name, "LOGS"))
+        # off by default, test_compressed and test_metrics need them
+        config.set("Compression", "enable", "True")
+        config.set("Metrics", "enable", "True")
+        self.metrics_url = "http://%s:%s/metrics" % (config.get("Metrics", "admin_address"),
+                                                     config.get("Metrics", "admin_port"))
+        with open(os.path.join(run_dir.name, "proxy.ini"), "w") as ini_file:
+            config.write(ini_file)
+        shutil.copy("loggers.conf", run_dir.name)
+        return run_dir
 
     @classmethod
     def setUpClass(cls):
@@ -43,6 +89,15 @@ class RequestsFunctional(TestCase):
     def tearDownClass(cls):
         pass
 
+    def origin_counts(self):
+        """return - {(str path, int status): int responses sent}, see origin_server"""
+        r = requests.get("http://localhost:8000/counts")
+        counts = {}
+        for line in r.text.splitlines():
+            path, code, count = line.split()
+            counts[(path, int(code))] = int(count)
+        return counts
+
     def test_ok(self):
         r = requests.get("http://localhost:8000/resource1", proxies=self.proxies)
         self.assertEqual(r.status_code, 200)
@@ -64,8 +119,111 @@ class RequestsFunctional(TestCase):
         self.assertEqual(r.status_code, 501)
         self.assertEqual(r.text, "")
 
+    def test_chunked(self):
+        r = requests.get("http://localhost:8000/chunked", proxies=self.proxies)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.text, "".join("Chunk%i " % i * 100 for i in range(50)))
+
+    def test_compressed(self):
+        body = "".join("Chunk%i " % i * 100 for i in range(50))
+        requests.get("http://localhost:8000/chunked", proxies=self.proxies)
+        r = requests.get("http://localhost:8000/chunked", proxies=self.proxies,
+                         headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(r.headers.get("Content-Encoding"), "gzip")
+        self.assertEqual(r.text, body)
+        r = requests.get("http://localhost:8000/chunked", proxies=self.proxies,
+                         headers={"Accept-Encoding": "identity"})
+        self.assertIsNone(r.headers.get("Content-Encoding"))
+        self.assertEqual(r.headers.get("Content-Length"), str(len(body)))
+        self.assertEqual(r.text, body)
+
+    def test_pipelined(self):
+        request = b"GET http://localhost:8000/%s HTTP/1.1\r\nHost: localhost:8000\r\n\r\n"
+        with socket.create_connection(("127.0.0.1", 8008)) as sock:
+            sock.sendall(request % b"resource1" + request % b"resource2")
+            sock.settimeout(5)
+            data = b""
+            while b"ResponseBody2" not in data:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+        self.assertLess(data.index(b"ResponseBody1"), data.index(b"ResponseBody2"))
+
+    def test_keep_alive(self):
+        with requests.Session() as session:
+            for resource, body in (("resource1", "ResponseBody1"), ("resource2", "ResponseBody2")):
+                r = session.get("http://localhost:8000/" + resource, proxies=self.proxies)
+                self.assertEqual(r.status_code, 200)
+                self.assertEqual(r.text, body)
+
+    def test_metrics(self):
+        for _ in range(2):
+            requests.get("http://localhost:8000/resource1", proxies=self.proxies)
+        r = requests.get(self.metrics_url)
+        self.assertEqual(r.status_code, 200)
+        values = dict(line.rsplit(" ", 1) for line in r.text.splitlines()
+                      if not line.startswith("#"))
+        self.assertGreaterEqual(int(values["rarog_hits_total"]), 1)
+        self.assertEqual(values['rarog_request_duration_seconds_count{path="hit"}'],
+                         values["rarog_hits_total"])
+
+    def test_revalidated(self):
+        url = "http://localhost:8000/validated"
+        r = requests.get(url, proxies=self.proxies)
+        self.assertEqual(r.status_code, 200)
+        # stale by now, the origin server confirms the cached copy with 304
+        sleep(1.5)
+        r = requests.get(url, proxies=self.proxies)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.text, "ValidatedBody")
+        counts = self.origin_counts()
+        self.assertEqual(counts[("/validated", 200)], 1)
+        # the origin server has got If-None-Match
+        self.assertEqual(counts[("/validated", 304)], 1)
+        r = requests.get(url, proxies=self.proxies, headers={"If-None-Match": r.headers["ETag"]})
+        self.assertEqual(r.status_code, 304)
+        # fresh again, answered from the cache
+        self.assertEqual(self.origin_counts()[("/validated", 304)], 1)
+
+    def test_stale_if_error(self):
+        url = "http://localhost:8000/flaky"
+        r = requests.get(url, proxies=self.proxies)
+        self.assertEqual(r.status_code, 200)
+        # stale by now, served from cache instead of 503
+        sleep(1.5)
+        r = requests.get(url, proxies=self.proxies)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.text, "FlakyBody")
+        self.assertEqual(self.origin_counts()[("/flaky", 503)], 1)
+        # and instead of 502
+        self.orig_proc.send_signal(signal.SIGINT)
+        self.orig_proc.wait()
+        r = requests.get(url, proxies=self.proxies)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.text, "FlakyBody")
+
+class AsyncRequestsFunctional(RequestsFunctional):
+    WORKER_MODE = "async"
+
+class HashedRequestsFunctional(RequestsFunctional):
+    FS_LAYOUT = "hashed"
+
+class StreamingRequestsFunctional(RequestsFunctional):
+    STREAM_RESPONSES = "True"
 
+class AsyncStreamingRequestsFunctional(RequestsFunctional):
+    WORKER_MODE = "async"
+    STREAM_RESPONSES = "True"
 
-             
+class FetchAheadRequestsFunctional(RequestsFunctional):
+    PIPELINE_FETCH_AHEAD = "4"
 
+class AsyncFetchAheadRequestsFunctional(RequestsFunctional):
+    WORKER_MODE = "async"
+    PIPELINE_FETCH_AHEAD = "4"
 
+@skipUnless(os.environ.get("RAROG_TEST_DB"), "set RAROG_TEST_DB=1 to test with the database "
+            "of proxy.ini")
+class DBRequestsFunctional(RequestsFunctional):
+    STORAGE = "DB"
@@ -11,6 +11,7 @@ from the command line
 
 from collections import namedtuple
 
+import multiprocessing
 import re
 import time
 import socketserver 
@@ -26,17 +27,46 @@ responses = {
     "/resource2" : Response(200, "ResponseBody2"),
 }
 
+# Body of "/chunked" resource, sent in pieces
+CHUNKED_PARTS = ["Chunk%i " % i * 100 for i in range(50)]
+
+# "/validated" resource is fresh for a second and can be revalidated with its ETag
+VALIDATED_ETAG = '"v1"'
+VALIDATED_BODY = "ValidatedBody"
+
+# "/flaky" resource is fresh for a second, the origin fails with 503 for it from the second
+# request on
+FLAKY_BODY = "FlakyBody"
+
+# responses sent, by path and status; "/counts" lists them. Shared by the forked handlers
+COUNTED = (("/validated", 200), ("/validated", 304), ("/flaky", 200), ("/flaky", 503))
+counts = multiprocessing.RawArray("i", len(COUNTED))
+
 class Server(http.server.SimpleHTTPRequestHandler):
     """Http server sending back predefined responses for certain requests"""
 
     def do_GET(self):
         print("Server: handling path: ", self.path)
+        path = None
         try:
-            """ Since request is sent through proxy, resource is the full URL"""
-            path = re.match(r"http://[^/]+(/.*)", self.path).group(1)
+            """ Since request is sent through proxy, resource is the full URL; "/counts" is
+            requested directly"""
+            path = re.match(r"(?:http://[^/]+)?(/.*)", self.path).group(1)
             resp = responses[path]
         except (KeyError, AttributeError):
             resp = Response(404, "")
+        if "/chunked" == path:
+            self.send_chunked()
+            return
+        if "/validated" == path:
+            self.send_validated()
+            return
+        if "/flaky" == path:
+            self.send_flaky()
+            return
+        if "/counts" == path:
+            self.send_counts()
+            return
         self.send_response(resp.code)
         self.send_header('Content-type','text/html')
         body = resp.body.encode("ascii", errors="ignore")
@@ -45,6 +75,59 @@ class Server(http.server.SimpleHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(body)
 
+    def send_chunked(self):
+        """Send CHUNKED_PARTS with chunked transfer encoding"""
+        self.send_response(200)
+        self.send_header('Content-type','text/html')
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for part in CHUNKED_PARTS:
+            body = part.encode("ascii")
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(body), body))
+        self.wfile.write(b"0\r\n\r\n")
+
+    def send_validated(self):
+        """Send VALIDATED_BODY or 304 if the request has the matching ETag"""
+        not_modified = VALIDATED_ETAG == self.headers.get("If-None-Match")
+        self.count("/validated", 304 if not_modified else 200)
+        self.send_response(304 if not_modified else 200)
+        self.send_header("ETag", VALIDATED_ETAG)
+        self.send_header("Cache-Control", "max-age=1")
+        if not_modified:
+            self.end_headers()
+            return
+        body = VALIDATED_BODY.encode("ascii")
+        self.send_header('Content-type','text/html')
+        self.send_header("Content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_flaky(self):
+        """Send FLAKY_BODY the first time, 503 afterwards"""
+        code = 503 if counts[COUNTED.index(("/flaky", 200))] else 200
+        self.count("/flaky", code)
+        body = FLAKY_BODY.encode("ascii") if 200 == code else b""
+        self.send_response(code)
+        self.send_header("Cache-Control", "max-age=1")
+        self.send_header('Content-type','text/html')
+        self.send_header("Content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_counts(self):
+        """Send "path status count" lines of COUNTED"""
+        body = "".join("%s %i %i\n" % (path, code, counts[index])
+                       for index, (path, code) in enumerate(COUNTED)).encode("ascii")
+        self.send_response(200)
+        self.send_header('Content-type','text/plain')
+        self.send_header("Content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    @staticmethod
+    def count(path, code):
+        counts[COUNTED.index((path, code))] += 1
+
 def run():
     socketserver.ForkingTCPServer.allow_reuse_address = True
     httpd = socketserver.ForkingTCPServer(('', PORT), Server)
@@ -0,0 +1,120 @@
+"""
+Updated: 2017
+Author: Sergei Shliakhtin
+Contact: xxx.serj@gmail.com
+Parser: Python 3
+Notes: Autoscaler unit tests, the samples are taken at made up times
+
+To be run from the same directory where proxy.py resides!
+"""
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from proxy import ProxyException
+from proxy.autoscaler import Autoscaler
+from proxy.const import Const
+
+# seconds
+WINDOW, COOLDOWN = 10, 5
+
+class AutoscalerTest(TestCase):
+
+    def setUp(self):
+        self.scaler = Autoscaler(2, 8, 0.8, 0.5, WINDOW, COOLDOWN)
+        self.now = 1000.0
+
+    def run_for(self, seconds, busy, waiting, workers):
+        """Sample the same occupancy every second
+
+        return - list of int, the steps asked for
+        """
+        steps = []
+        for _ in range(seconds):
+            steps.append(self.scaler.sample(busy, waiting, workers, self.now))
+            self.now += 1
+        return steps
+
+    def test_grow_on_waiting_clients(self):
+        # half busy, but clients keep waiting
+        steps = self.run_for(WINDOW + 1, 2, 3, 4)
+        self.assertEqual(steps[:WINDOW], [0] * WINDOW)
+        # enough for the waiting ones below grow_at: (2 + 3) / 0.8 -> 7
+        self.assertEqual(steps[WINDOW], 3)
+
+    def test_grow_on_busy(self):
+        steps = self.run_for(WINDOW + 1, 4, 0, 4)
+        self.assertEqual(steps[WINDOW], 1)
+
+    def test_grow_clamped(self):
+        steps = self.run_for(WINDOW + 1, 8, 40, 6)
+        self.assertEqual(steps[WINDOW], 2)
+        # at max_workers already
+        self.scaler = Autoscaler(2, 8, 0.8, 0.5, WINDOW, COOLDOWN)
+        self.assertEqual(self.run_for(3 * WINDOW, 8, 40, 8), [0] * 3 * WINDOW)
+
+    def test_short_burst(self):
+        # the window average stays low
+        steps = self.run_for(WINDOW - 2, 1, 0, 4)
+        steps += self.run_for(2, 4, 5, 4)
+        steps += self.run_for(WINDOW, 1, 0, 4)
+        self.assertNotIn(3, steps)
+        self.assertTrue(all(step <= 0 for step in steps))
+
+    def test_no_flapping(self):
+        self.assertEqual(self.run_for(WINDOW + 1, 4, 0, 4)[-1], 1)
+        # a new window of samples is needed after the change, however low the load is
+        self.assertEqual(self.run_for(WINDOW, 0, 0, 5), [0] * (WINDOW - 1) + [-1])
+
+    def test_cooldown_longer_than_window(self):
+        self.scaler = Autoscaler(2, 8, 0.8, 0.5, 2, 6)
+        steps = self.run_for(7, 4, 0, 4)
+        self.assertEqual(steps, [0] * 6 + [1])
+        # counted from the change
+        self.assertEqual(self.run_for(6, 5, 0, 5), [0] * 5 + [2])
+
+    def test_shrink_at_peak(self):
+        # without one worker 0.5 * 3 = 1.5 busy at most
+        steps = self.run_for(WINDOW, 1, 0, 4)
+        steps += self.run_for(1, 1.6, 0, 4)
+        self.assertEqual(steps, [0] * (WINDOW + 1))
+        # until the peak is out of the window
+        steps = self.run_for(WINDOW + 1, 1.5, 0, 4)
+        self.assertEqual(steps, [0] * WINDOW + [-1])
+
+    def test_no_shrink_with_waiting_clients(self):
+        steps = self.run_for(WINDOW - 1, 0, 0, 4)
+        steps += self.run_for(1, 0, 1, 4)
+        steps += self.run_for(WINDOW - 1, 0, 0, 4)
+        self.assertNotIn(-1, steps)
+
+    def test_shrink_clamped(self):
+        self.assertEqual(self.run_for(3 * WINDOW, 0, 0, 2), [0] * 3 * WINDOW)
+
+    def test_hysteresis(self):
+        # between shrink_at and grow_at nothing changes
+        self.assertEqual(self.run_for(3 * WINDOW, 2.6, 0, 4), [0] * 3 * WINDOW)
+
+    def test_clamp(self):
+        self.assertEqual(self.scaler.clamp(1), 2)
+        self.assertEqual(self.scaler.clamp(5), 5)
+        self.assertEqual(self.scaler.clamp(20), 8)
+
+    def test_validation(self):
+        for args in ((0, 8, 0.8, 0.5), (4, 2, 0.8, 0.5), (2, 8, 0.5, 0.5), (2, 8, 0.8, 0.9),
+                     (2, 8, 0.8, 0)):
+            with self.assertRaises(ProxyException, msg=str(args)):
+                Autoscaler(*args, window=WINDOW, cooldown=COOLDOWN)
+        Autoscaler(1, 1, 0.8, 0.5, WINDOW, COOLDOWN)
+
+    def test_from_config(self):
+        values = {"enable": "True", "min_workers": "2", "max_workers": "32", "grow_at": "0.8",
+                  "shrink_at": "0.5", "window": "10", "cooldown": "5"}
+        def config_value(section, key):
+            assert Const.AUTOSCALE_SECTION == section
+            return values[key]
+        with patch("proxy.autoscaler.Config.value", side_effect=config_value):
+            scaler = Autoscaler.from_config()
+            self.assertEqual((scaler.min_workers, scaler.max_workers), (2, 32))
+            values["enable"] = "False"
+            self.assertIsNone(Autoscaler.from_config())
@@ -0,0 +1,189 @@
+"""
+Updated: 2017
+Author: Sergei Shliakhtin
+Contact: xxx.serj@gmail.com
+Parser: Python 3
+Notes: Background refresh unit tests. The origin server is the other end of a socket pair,
+    the flights are taken on a temporary lock dir
+
+To be run from the same directory where proxy.py resides!
+"""
+
+import socket
+import tempfile
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from proxy import background_refresh
+from proxy.background_refresh import BackgroundRefresher
+from proxy.collapsed_forwarding import FlightRegistry
+from proxy.const import Const
+
+REQUEST = b"GET http://localhost/a HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n"
+CACHED = b"ETag: \"v1\"\r\nContent-Length: 5\r\n\r\nHello"
+
+def leads(registry, key_path):
+    """return - bool, a new flight of the resource is its leader"""
+    flight = registry.join(key_path)
+    flight.release()
+    return flight.leader
+
+class RefreshTest(TestCase):
+    """refresh() against a canned origin response"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.registry = FlightRegistry(self.tmp_dir.name, 0.05, 0.01)
+        self.policy = Mock()
+
+    def refresh(self, response):
+        """return - (refresh() result, bytes the origin server has got)"""
+        proxy_end, origin_end = socket.socketpair()
+        self.addCleanup(origin_end.close)
+        origin_end.sendall(response)
+        flight = self.registry.join(b"localhost/a")
+        with patch("proxy.background_refresh.net.connected_socket", return_value=proxy_end):
+            result = background_refresh.refresh(self.policy, b"localhost/a", b"localhost",
+                                                REQUEST, CACHED, flight)
+        # released when done
+        self.assertTrue(leads(self.registry, b"localhost/a"))
+        return result, origin_end.recv(65536)
+
+    def test_not_modified(self):
+        self.policy.refresh.return_value = True
+        response = b"HTTP/1.1 304 Not Modified\r\nCache-Control: max-age=60\r\n\r\n"
+        result, request = self.refresh(response)
+        self.assertTrue(result)
+        self.assertIn(b"\r\nIf-None-Match: \"v1\"\r\n", request)
+        self.policy.refresh.assert_called_once_with(b"localhost/a", CACHED,
+                                                    response[:-4])
+        self.policy.save.assert_not_called()
+
+    def test_modified(self):
+        self.policy.save.return_value = True
+        result, _ = self.refresh(b"HTTP/1.1 200 OK\r\nContent-Length: 3\r\n\r\nNew")
+        self.assertTrue(result)
+        key_path, header, data = self.policy.save.call_args[0]
+        self.assertEqual(key_path, b"localhost/a")
+        self.assertTrue(data.endswith(b"\r\n\r\nNew"))
+
+    def test_origin_error(self):
+        # the stale copy stays
+        result, _ = self.refresh(b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\n\r\n")
+        self.assertFalse(result)
+        self.policy.save.assert_not_called()
+        self.policy.refresh.assert_not_called()
+
+class BackgroundRefresherTest(TestCase):
+    """Queueing of the refreshes, refresh() itself is replaced"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.registry = FlightRegistry(self.tmp_dir.name, 0.05, 0.01)
+        # the refreshes wait for it
+        self.go = threading.Event()
+        self.addCleanup(self.go.set)
+        self.refreshed = []
+        for target, replacement in (("proxy.background_refresh.refresh", self.fake_refresh),
+                                    ("proxy.background_refresh.BackgroundRefresher._init_thread",
+                                     lambda refresher: setattr(refresher._local, "policy",
+                                                               None))):
+            patcher = patch(target, replacement)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def fake_refresh(self, policy, key_path, host, request_message, cached, flight=None):
+        self.go.wait(5)
+        self.refreshed.append(key_path)
+        if flight:
+            flight.release()
+        if b"localhost/fails" == key_path:
+            raise OSError("Connection reset")
+        return True
+
+    def refresher(self, flights=None, threads=2):
+        refresher = BackgroundRefresher(flights, threads)
+        self.addCleanup(refresher._executor.shutdown)
+        return refresher
+
+    def drain(self, refresher):
+        self.go.set()
+        refresher._executor.shutdown(wait=True)
+
+    def test_deduplicated(self):
+        refresher = self.refresher()
+        self.assertTrue(refresher.start(b"localhost/a", b"localhost", REQUEST, CACHED))
+        # already queued
+        self.assertFalse(refresher.start(b"localhost/a", b"localhost", REQUEST, CACHED))
+        self.assertTrue(refresher.start(b"localhost/b", b"localhost", REQUEST, CACHED))
+        self.drain(refresher)
+        self.assertEqual(sorted(self.refreshed), [b"localhost/a", b"localhost/b"])
+        self.assertEqual(refresher._pending, set())
+
+    def test_queued_beyond_threads(self):
+        refresher = self.refresher(threads=1)
+        for name in (b"a", b"b", b"c"):
+            self.assertTrue(refresher.start(b"localhost/" + name, b"localhost", REQUEST, CACHED))
+        self.assertEqual(len(refresher._pending), 3)
+        self.drain(refresher)
+        self.assertEqual(self.refreshed, [b"localhost/a", b"localhost/b", b"localhost/c"])
+
+    def test_again_when_done(self):
+        refresher = self.refresher()
+        self.go.set()
+        refresher.start(b"localhost/a", b"localhost", REQUEST, CACHED)
+        refresher._executor.submit(lambda: None).result(5)
+        for _ in range(100):
+            if not refresher._pending:
+                break
+            time.sleep(0.01)
+        self.assertTrue(refresher.start(b"localhost/a", b"localhost", REQUEST, CACHED))
+
+    def test_other_process_refreshing(self):
+        refresher = self.refresher(self.registry)
+        other = self.registry.join(b"localhost/a")
+        self.addCleanup(other.release)
+        self.assertFalse(refresher.start(b"localhost/a", b"localhost", REQUEST, CACHED))
+        self.assertEqual(refresher._pending, set())
+        self.drain(refresher)
+        self.assertEqual(self.refreshed, [])
+
+    def test_flight_held(self):
+        refresher = self.refresher(self.registry)
+        self.assertTrue(refresher.start(b"localhost/a", b"localhost", REQUEST, CACHED))
+        # the other processes serve the stale copy meanwhile
+        follower = self.registry.join(b"localhost/a")
+        self.addCleanup(follower.release)
+        self.assertFalse(follower.leader)
+        self.drain(refresher)
+        self.assertEqual(self.refreshed, [b"localhost/a"])
+        self.assertTrue(follower.landed())
+
+    def test_failed(self):
+        refresher = self.refresher(self.registry)
+        with patch("proxy.background_refresh.proc_error") as proc_error:
+            self.assertTrue(refresher.start(b"localhost/fails", b"localhost", REQUEST, CACHED))
+            self.drain(refresher)
+        proc_error.assert_called_once()
+        self.assertEqual(self.refreshed, [b"localhost/fails"])
+        self.assertEqual(refresher._pending, set())
+        self.assertTrue(leads(self.registry, b"localhost/fails"))
+
+    def test_from_config(self):
+        values = {"refresh_threads": "2", "stale_while_revalidate": "30"}
+        def config_value(section, key):
+            assert Const.STORAGE_SECTION == section
+            return values[key]
+        with patch("proxy.background_refresh.Config.value", side_effect=config_value):
+            refresher = BackgroundRefresher.from_config(None)
+            self.addCleanup(refresher._executor.shutdown)
+            self.assertIsNotNone(refresher)
+            for key in values:
+                off = dict(values)
+                values[key] = "0"
+                self.assertIsNone(BackgroundRefresher.from_config(None), key)
+                values.update(off)
@@ -0,0 +1,110 @@
+"""
+Updated: 2017
+Author: Sergei Shliakhtin
+Contact: xxx.serj@gmail.com
+Parser: Python 3
+Notes: CacheIndex unit tests, on a temporary file
+
+To be run from the same directory where proxy.py resides!
+"""
+
+import hashlib
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from proxy import cache_index
+from proxy.cache_index import CacheIndex, new_entry
+
+# index keys chosen to collide: a and b have the same key hash, c is placed where b is probed to
+KEYS = {b"localhost/a": (2, 10), b"localhost/b": (2, 11), b"localhost/c": (3, 12)}
+
+class CacheIndexTest(TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+
+    def open(self, slots):
+        CacheIndex.create(self.path, slots)
+        return CacheIndex(self.path)
+
+    def collide(self):
+        """Make index_key() return KEYS for the rest of the test"""
+        keys = patch("proxy.cache_index.index_key", side_effect=KEYS.get)
+        keys.start()
+        self.addCleanup(keys.stop)
+
+    def test_put_lookup(self):
+        index = self.open(64)
+        index.put(b"localhost/a", new_entry(10, 100.0, 200.0))
+        entry = index.lookup(b"localhost/a")
+        self.assertEqual((entry.size, entry.stored, entry.expiry), (10, 100.0, 200.0))
+        self.assertIsNone(index.lookup(b"localhost/b"))
+        self.assertEqual(index.totals(), (1, 10))
+        self.assertTrue(index.complete)
+
+    def test_hex_index_key(self):
+        key = cache_index.index_key(b"localhost/a")
+        self.assertEqual(cache_index.hex_index_key(hashlib.sha1(b"localhost/a").hexdigest()), key)
+        self.assertEqual(key[0], cache_index.key_hash(b"localhost/a"))
+
+    def test_same_key_hash(self):
+        self.collide()
+        index = self.open(8)
+        index.put(b"localhost/a", new_entry(10, 100.0))
+        self.assertIsNone(index.lookup(b"localhost/b"))
+        index.put(b"localhost/b", new_entry(20, 100.0))
+        self.assertEqual(index.lookup(b"localhost/a").size, 10)
+        self.assertEqual(index.lookup(b"localhost/b").size, 20)
+        self.assertEqual(index.totals(), (2, 30))
+        index.erase(b"localhost/b")
+        self.assertEqual(index.lookup(b"localhost/a").size, 10)
+        self.assertIsNone(index.lookup(b"localhost/b"))
+
+    def test_probe_past_erased(self):
+        self.collide()
+        index = self.open(8)
+        for size, key_path in enumerate(KEYS, 1):
+            index.put(key_path, new_entry(size, 100.0))
+        # c has been probed past a and b, it's found past the erased slots of both
+        index.erase(b"localhost/a")
+        index.erase(b"localhost/b")
+        self.assertEqual(index.lookup(b"localhost/c").size, 3)
+        self.assertEqual(index.totals(), (1, 3))
+        # an erased slot is reused, c isn't duplicated when updated
+        index.put(b"localhost/b", new_entry(20, 100.0))
+        index.put(b"localhost/c", new_entry(30, 100.0))
+        self.assertEqual(index.lookup(b"localhost/b").size, 20)
+        self.assertEqual(index.lookup(b"localhost/c").size, 30)
+        self.assertEqual(index.totals(), (2, 50))
+        self.assertEqual(sorted(key for key, entry in index.entries()), [(2, 11), (3, 12)])
+
+    def test_full(self):
+        index = self.open(4)
+        for number in range(4):
+            index.put(b"localhost/%i" % number, new_entry(1, 100.0))
+        self.assertTrue(index.complete)
+        # updates still fit
+        index.put(b"localhost/0", new_entry(2, 100.0))
+        self.assertTrue(index.complete)
+        index.put(b"localhost/4", new_entry(1, 100.0))
+        self.assertFalse(index.complete)
+        self.assertIsNone(index.lookup(b"localhost/4"))
+        self.assertEqual(index.totals(), (4, 5))
+        # the flag isn't restored by freeing a slot, the missing resource may be stored anyway
+        index.erase(b"localhost/0")
+        self.assertFalse(index.complete)
+
+    def test_access_statistics(self):
+        index = self.open(64)
+        index.put(b"localhost/a", new_entry(10, 100.0))
+        index.lookup(b"localhost/a", record_access=True)
+        index.lookup(b"localhost/a", record_access=True)
+        self.assertEqual(index.lookup(b"localhost/a").hits, 2)
+        # a replaced resource keeps its hits
+        index.put(b"localhost/a", new_entry(20, 200.0))
+        entry = index.lookup(b"localhost/a")
+        self.assertEqual((entry.size, entry.hits), (20, 2))
@@ -0,0 +1,120 @@
+"""
+Updated: 2017
+Author: Sergei Shliakhtin
+Contact: xxx.serj@gmail.com
+Parser: Python 3
+Notes: CacheSweeper unit tests, on a temporary index file and a fake storage
+
+To be run from the same directory where proxy.py resides!
+"""
+
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from proxy.cache_index import CacheIndex, Entry
+from proxy.cache_sweeper import CacheSweeper
+
+NOW = 1000000.0
+
+class FakeStorage:
+    """Records the erased key hashes"""
+
+    def __init__(self):
+        self.erased = set()
+
+    def erase_hashes(self, hash_values):
+        self.erased |= hash_values
+        return len(hash_values)
+
+class CacheSweeperTest(TestCase):
+
+    def setUp(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        CacheIndex.create(path, 256)
+        self.index = CacheIndex(path)
+        self.storage = FakeStorage()
+        self.settings = {"max_size": "0", "max_objects": "0", "low_watermark": "0.5",
+                         "hybrid_half_life": "100", "sweep_interval": "30",
+                         "cache_discard_after": "3600", "keep_stale": "3600", "policy": "lru"}
+        for target, value in (("proxy.cache_sweeper.CacheIndex.from_config", self.index),
+                              ("proxy.storage.get_backend_storage", self.storage),
+                              ("proxy.cache_sweeper.log_basic_config", None),
+                              ("proxy.cache_sweeper.log", None),
+                              ("proxy.cache_sweeper.proc_state", None)):
+            patcher = patch(target, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        for target, side_effect in (("proxy.cache_sweeper.Config.value",
+                                     lambda section, key: self.settings[key]),
+                                    ("proxy.cache_sweeper.time.time", lambda: NOW)):
+            patcher = patch(target, side_effect=side_effect)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def put(self, number, size=1, last_access=NOW, hits=0, stored=NOW):
+        """Index resource number, its key hash is number + 2"""
+        self.index.put_key((number + 2, number), Entry(size, stored, 0.0, 200, last_access, hits))
+
+    def sweep(self, **settings):
+        """return - (int expired, int evicted), list of the numbers of the resources removed"""
+        self.settings.update(settings)
+        sweeper = CacheSweeper()
+        sweeper._init_this_process()
+        result = sweeper.sweep()
+        return result, sorted(hash_value - 2 for hash_value in self.storage.erased)
+
+    def test_lru(self):
+        for number in range(12):
+            # put in a shuffled order, the index order doesn't matter
+            self.put((number * 5) % 12, last_access=NOW - 100 + (number * 5) % 12, hits=12 - number)
+        result, removed = self.sweep(max_objects="10", policy="lru")
+        # down to 0.5 of the budget
+        self.assertEqual(result, (0, 7))
+        self.assertEqual(removed, list(range(7)))
+        self.assertEqual(self.index.totals(), (5, 5))
+        self.assertEqual(sorted(key[1] for key, entry in self.index.entries()), list(range(7, 12)))
+
+    def test_lfu(self):
+        for number in range(12):
+            # the recent ones are the least popular, the ties are broken by the last access
+            self.put(number, last_access=NOW - number, hits=number // 2)
+        result, removed = self.sweep(max_objects="10", policy="lfu")
+        self.assertEqual(result, (0, 7))
+        self.assertEqual(removed, [0, 1, 2, 3, 4, 5, 7])
+
+    def test_hybrid(self):
+        # the hits are halved every 100 s since the last use
+        self.put(0, last_access=NOW - 400, hits=31)
+        self.put(1, last_access=NOW, hits=3)
+        self.put(2, last_access=NOW - 100, hits=3)
+        self.put(3, last_access=NOW - 100, hits=9)
+        result, removed = self.sweep(max_objects="3", low_watermark="0.67", policy="hybrid")
+        # scores: 2, 4, 2, 5; down to 2 resources
+        self.assertEqual(result, (0, 2))
+        self.assertEqual(removed, [0, 2])
+
+    def test_size_budget(self):
+        for number in range(4):
+            self.put(number, size=300, last_access=NOW - 4 + number)
+        result, removed = self.sweep(max_size="1000")
+        self.assertEqual(result, (0, 3))
+        self.assertEqual(removed, [0, 1, 2])
+        self.assertEqual(self.index.totals(), (1, 300))
+
+    def test_within_budget(self):
+        for number in range(10):
+            self.put(number)
+        self.assertEqual(self.sweep(max_objects="10"), ((0, 0), []))
+        self.assertEqual(self.index.totals(), (10, 10))
+
+    def test_expired(self):
+        # stale for longer than keep_stale
+        self.put(0, stored=NOW - 7201)
+        self.put(1, stored=NOW - 7199)
+        self.put(2)
+        self.assertEqual(self.sweep(max_objects="10"), ((1, 0), [0]))
+        self.assertEqual(self.index.totals(), (2, 2))
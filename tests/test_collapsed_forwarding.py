@@ -0,0 +1,62 @@
+"""
+Updated: 2017
+Author: Sergei Shliakhtin
+Contact: xxx.serj@gmail.com
+Parser: Python 3
+Notes: FlightRegistry unit tests, on a temporary lock dir. flock locks of separately opened
+    files exclude each other within a process too, so one process plays all the workers
+
+To be run from the same directory where proxy.py resides!
+"""
+
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from proxy.collapsed_forwarding import FlightRegistry
+
+class FlightRegistryTest(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.registry = FlightRegistry(self.tmp_dir.name, 0.05, 0.01)
+
+    def join(self, key_path=b"localhost/a"):
+        flight = self.registry.join(key_path)
+        self.addCleanup(flight.release)
+        return flight
+
+    def test_leader_and_follower(self):
+        leader = self.join()
+        follower = self.join()
+        self.assertTrue(leader.leader)
+        self.assertFalse(follower.leader)
+        self.assertTrue(self.join(b"localhost/b").leader)
+        self.assertFalse(follower.landed())
+        leader.release()
+        self.assertTrue(follower.landed())
+        self.assertFalse(os.path.exists(leader._path))
+
+    def test_wait_timeout(self):
+        self.join()
+        follower = self.join()
+        self.assertFalse(follower.wait(0.05, 0.01))
+        # stops waiting, the leader keeps its lock
+        self.assertFalse(self.join().leader)
+
+    def test_removed_lock_file(self):
+        leader = self.join()
+        # opened by another process just before the leader removes it
+        stale = os.open(leader._path, os.O_RDWR)
+        leader.release()
+        real_open = os.open
+        opened = [stale]
+        with patch("proxy.collapsed_forwarding.os.open",
+                   side_effect=lambda *args: opened.pop() if opened else real_open(*args)):
+            # locks the removed file first, then the one at the path
+            second = self.join()
+        self.assertTrue(second.leader)
+        self.assertTrue(os.path.exists(second._path))
+        self.assertFalse(self.join().leader)
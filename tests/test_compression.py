@@ -0,0 +1,74 @@
+"""
+Updated: 2017
+Author: Sergei Shliakhtin
+Contact: xxx.serj@gmail.com
+Parser: Python 3
+Notes: Compression unit tests
+
+To be run from the same directory where proxy.py resides!
+"""
+
+import gzip
+from unittest import TestCase
+
+from proxy import compression, freshness
+from proxy.compression import Compressor
+
+BODY = b"Chunk " * 100
+
+def response(body, *headers):
+    """return - bytes, response without status line"""
+    return b"\r\n".join((b"Content-Type: text/html",) + headers) + b"\r\n\r\n" + body
+
+class CompressionTest(TestCase):
+
+    def setUp(self):
+        self.compressor = Compressor([b"text/"], 16, 65536, 6)
+
+    def test_compress_decode(self):
+        data = response(BODY, b"Content-Length: %i" % len(BODY))
+        stored = self.compressor.compress(data)
+        header = freshness.cached_header(stored)
+        self.assertTrue(compression.is_gzip(header))
+        self.assertEqual(freshness.header_value(header, b"Vary"), b"Accept-Encoding")
+        decoded = compression.decoded(stored)
+        self.assertEqual(freshness.header_value(decoded, b"Content-Length"), b"%i" % len(BODY))
+        self.assertTrue(decoded.endswith(b"\r\n\r\n" + BODY))
+
+    def test_chunked_compressed(self):
+        chunked = b"%x\r\n%s\r\n0\r\n\r\n" % (len(BODY), BODY)
+        stored = self.compressor.compress(response(chunked, b"Transfer-Encoding: chunked"))
+        self.assertIsNone(freshness.header_value(stored, b"Transfer-Encoding"))
+        self.assertTrue(compression.decoded(stored).endswith(b"\r\n\r\n" + BODY))
+
+    def test_etag_suffix(self):
+        for etag, stored_etag in ((b'"v1"', b'"v1-gzip"'), (b'W/"v1"', b'W/"v1-gzip"')):
+            stored = self.compressor.compress(response(BODY, b"ETag: " + etag))
+            header = freshness.cached_header(stored)
+            self.assertEqual(freshness.header_value(header, b"ETag"), stored_etag)
+            # the origin server is asked about its own one
+            request = freshness.conditional_request(b"GET / HTTP/1.1\r\nHost: a\r\n\r\n", header)
+            self.assertIn(b"If-None-Match: " + etag + b"\r\n", request)
+            # the decoded copy is the origin one
+            self.assertEqual(freshness.header_value(compression.decoded(stored), b"ETag"), etag)
+            for client_etag in (stored_etag, etag):
+                self.assertTrue(freshness.not_modified(b"If-None-Match: " + client_etag, header))
+            self.assertFalse(freshness.not_modified(b'If-None-Match: "v2"', header))
+
+    def test_origin_gzip_chunked(self):
+        gzipped = gzip.compress(BODY)
+        chunked = b"%x\r\n%s\r\n%x\r\n%s\r\n0\r\n\r\n" % (10, gzipped[:10], len(gzipped) - 10,
+                                                          gzipped[10:])
+        data = response(chunked, b"Content-Encoding: gzip", b"Transfer-Encoding: chunked",
+                        b'ETag: "o1"')
+        # stored as it is
+        self.assertEqual(self.compressor.compress(data), data)
+        decoded = compression.decoded(data)
+        self.assertIsNone(freshness.header_value(decoded, b"Transfer-Encoding"))
+        self.assertEqual(freshness.header_value(decoded, b"ETag"), b'"o1"')
+        self.assertTrue(decoded.endswith(b"\r\n\r\n" + BODY))
+
+    def test_not_compressed(self):
+        for data in (response(b"short"), response(BODY, b"Cache-Control: no-transform"),
+                     response(BODY).replace(b"text/html", b"image/png")):
+            self.assertEqual(self.compressor.compress(data), data)
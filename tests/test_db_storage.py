@@ -0,0 +1,294 @@
+"""
+Updated: 2017
+Author: Sergei Shliakhtin
+Contact: xxx.serj@gmail.com
+Parser: Python 3
+Notes: DBStorage unit tests on a stand-in DB-API driver keeping the tables in memory, the
+    prepared statements are run by their names
+
+To be run from the same directory where proxy.py resides!
+"""
+
+import itertools
+import threading
+from unittest import TestCase
+from unittest.mock import patch
+
+from proxy.config import Config
+from proxy import db_storage
+from proxy.db_storage import ConnectionPool, DBStorage
+
+CHUNK_SIZE = 4
+
+class FakeDriver:
+    """DB-API module stand-in, one per test so that it gets its own connection pool"""
+
+    class Error(Exception):
+        pass
+
+    class DatabaseError(Error):
+        pass
+
+    class OperationalError(DatabaseError):
+        pass
+
+    Binary = bytes
+
+    def __init__(self):
+        # url: (key hash, stored, expiry, size, chunk size, generation, content)
+        self.resources = {}
+        # (url, generation, seq): data
+        self.chunks = {}
+        self.connects = 0
+        self.prepares = 0
+        # the next statement breaks the connection
+        self.fail_next = False
+
+    def connect(self, **kwargs):
+        self.connects += 1
+        return FakeConnection(self)
+
+class FakeConnection:
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.autocommit = False
+        self.prepared = set()
+        self.broken = False
+        self.closed = False
+
+    def cursor(self, name=None):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+class FakeCursor:
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._rows = []
+        self.rowcount = -1
+
+    def execute(self, sql, args=()):
+        conn, driver = self._conn, self._conn.driver
+        if conn.broken or driver.fail_next:
+            driver.fail_next = False
+            conn.broken = True
+            raise driver.OperationalError("server closed the connection unexpectedly")
+        command, name = sql.split()[:2]
+        if "PREPARE" == command:
+            conn.prepared.add(name)
+            driver.prepares += 1
+            return
+        assert "EXECUTE" == command and name in conn.prepared, sql
+        self.rowcount = -1
+        self._rows = getattr(self, name[len("rarog_"):])(driver, *args) or []
+        if self.rowcount < 0:
+            self.rowcount = len(self._rows)
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    def fetchall(self):
+        return self._rows
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def close(self):
+        pass
+
+    def lookup(self, driver, url):
+        row = driver.resources.get(url)
+        if row:
+            key_hash, stored, expiry, size, chunk_size, generation, content = row
+            return [(stored, expiry, content, size, chunk_size, generation)]
+
+    def chunk(self, driver, url, generation, seq):
+        data = driver.chunks.get((url, generation, seq))
+        return [(data,)] if data is not None else []
+
+    def chunks(self, driver, url, generation):
+        return [(driver.chunks[key],) for key in sorted(driver.chunks)
+                if key[:2] == (url, generation)]
+
+    def put_chunk(self, driver, url, generation, seq, data):
+        driver.chunks[url, generation, seq] = data
+        self.rowcount = 1
+
+    def save(self, driver, url, *args):
+        row, chunks = args[:-1], args[-1]
+        generation = row[5]
+        current = driver.resources.get(url)
+        self.rowcount = 0
+        if (chunks == len([key for key in driver.chunks if key[:2] == (url, generation)])
+                and (current is None or current[5] < generation)):
+            driver.resources[url] = row
+            self.rowcount = 1
+
+    def drop_old_chunks(self, driver, url, generation):
+        self._drop(driver, lambda key: key[0] == url and key[1] < generation)
+
+    def drop_chunks(self, driver, url, generation):
+        self._drop(driver, lambda key: key[:2] == (url, generation))
+
+    def erase(self, driver, url):
+        driver.resources.pop(url, None)
+        self._drop(driver, lambda key: key[0] == url)
+
+    def _drop(self, driver, dropped):
+        keys = [key for key in driver.chunks if dropped(key)]
+        for key in keys:
+            del driver.chunks[key]
+        self.rowcount = len(keys)
+
+def config_value(section, key):
+    """proxy.ini with small chunks"""
+    if "db_chunk_size" == key:
+        return str(CHUNK_SIZE)
+    return Config._config.get(section, key)
+
+class DBStorageTest(TestCase):
+
+    def setUp(self):
+        config = patch("proxy.db_storage.Config.value", side_effect=config_value)
+        config.start()
+        self.addCleanup(config.stop)
+        # every write gets a later generation
+        clock = patch("proxy.db_storage.time.time_ns", side_effect=itertools.count(1))
+        clock.start()
+        self.addCleanup(clock.stop)
+        self.driver = FakeDriver()
+        self.storage = DBStorage(self.driver)
+
+    def test_save_fetch(self):
+        for data in (b"", b"abc", b"abcd", b"abcdefghij"):
+            self.assertTrue(self.storage.save(b"localhost/a", data, 100.0))
+            self.assertEqual(self.storage.cached_times(b"localhost/a")[1], 100.0)
+            self.assertEqual(self.storage.fetch(b"localhost/a"), data)
+        # the first chunk is in the row, the replaced copies are gone
+        self.assertEqual(sorted(seq for url, generation, seq in self.driver.chunks), [1, 2])
+        self.assertIsNone(self.storage.fetch(b"localhost/b"))
+
+    def test_fetch_file(self):
+        self.storage.save(b"localhost/a", b"abcdefghij")
+        self.assertTrue(self.storage.haskey_time(b"localhost/a")[0])
+        chunk_file, offset, size = self.storage.fetch_file(b"localhost/a")
+        self.assertEqual(size, 10)
+        chunk_file.seek(offset + 3)
+        self.assertEqual(chunk_file.read(), b"defghij")
+        # one chunk resources are fetched whole
+        self.storage.save(b"localhost/b", b"abc")
+        self.assertIsNone(self.storage.fetch_file(b"localhost/b"))
+
+    def test_save_many(self):
+        saved = self.storage.save_many([(b"localhost/a", b"abcdefghij", 0.0),
+                                        (b"localhost/b", b"xyz", 0.0)])
+        self.assertEqual(saved, [True, True])
+        self.assertEqual(self.storage.fetch(b"localhost/a"), b"abcdefghij")
+        self.assertEqual(self.storage.fetch(b"localhost/b"), b"xyz")
+
+    def test_erase(self):
+        self.storage.save(b"localhost/a", b"abcdefghij")
+        self.storage.erase(b"localhost/a")
+        self.assertIsNone(self.storage.fetch(b"localhost/a"))
+        self.assertEqual(self.driver.chunks, {})
+
+    def test_aborted_write(self):
+        writer = self.storage.writer(b"localhost/a")
+        writer.write(b"abcdefghij")
+        writer.abort()
+        self.assertEqual(self.driver.chunks, {})
+        self.assertIsNone(self.storage.fetch(b"localhost/a"))
+
+    def test_statements_prepared_once(self):
+        for _ in range(3):
+            self.storage.save(b"localhost/a", b"abcdefghij")
+            self.storage.fetch(b"localhost/a")
+        self.assertEqual(self.driver.connects, 1)
+        self.assertEqual(self.driver.prepares, len(db_storage._STATEMENTS))
+
+    def test_connection_lost(self):
+        self.storage.save(b"localhost/a", b"abc")
+        conn = self.storage._pool._idle[0]
+        self.driver.fail_next = True
+        self.assertIsNone(self.storage.cached_times(b"localhost/a"))
+        # the broken connection is closed, the next statement reconnects
+        self.assertTrue(conn.closed)
+        self.assertIsNotNone(self.storage.cached_times(b"localhost/a"))
+        self.assertEqual(self.driver.connects, 2)
+        self.assertEqual(self.driver.prepares, 2 * len(db_storage._STATEMENTS))
+
+    def test_failed_write(self):
+        self.driver.fail_next = True
+        self.assertFalse(self.storage.save(b"localhost/a", b"abcdefghij"))
+        self.assertIsNone(self.storage.fetch(b"localhost/a"))
+
+    def test_later_write_committed_first(self):
+        first = self.storage.writer(b"localhost/a")
+        second = self.storage.writer(b"localhost/a")
+        first.write(b"1111aaaabbbb")
+        second.write(b"2222cccc")
+        self.assertTrue(second.commit())
+        # older than the current copy
+        self.assertFalse(first.commit())
+        self.assertEqual(self.storage.fetch(b"localhost/a"), b"2222cccc")
+        self.assertEqual(list(self.driver.chunks.values()), [b"cccc"])
+
+    def test_earlier_write_committed_first(self):
+        first = self.storage.writer(b"localhost/a")
+        second = self.storage.writer(b"localhost/a")
+        first.write(b"1111aaaa")
+        second.write(b"2222cc")
+        self.assertTrue(first.commit())
+        self.assertEqual(self.storage.fetch(b"localhost/a"), b"1111aaaa")
+        second.write(b"cc")
+        self.assertTrue(second.commit())
+        self.assertEqual(self.storage.fetch(b"localhost/a"), b"2222cccc")
+        self.assertEqual(list(self.driver.chunks.values()), [b"cccc"])
+
+    def test_chunks_removed_meanwhile(self):
+        writer = self.storage.writer(b"localhost/a")
+        writer.write(b"1111aaaa")
+        self.storage.erase(b"localhost/a")
+        writer.write(b"bbbb")
+        self.assertFalse(writer.commit())
+        self.assertIsNone(self.storage.fetch(b"localhost/a"))
+        self.assertEqual(self.driver.chunks, {})
+
+    def test_save_many_later_write(self):
+        writer = self.storage.writer(b"localhost/a")
+        writer.write(b"1111aaaa")
+        self.assertEqual(self.storage.save_many([(b"localhost/a", b"2222cccc", 0.0)]), [True])
+        self.assertFalse(writer.commit())
+        self.assertEqual(self.storage.fetch(b"localhost/a"), b"2222cccc")
+
+class ConnectionPoolTest(TestCase):
+
+    def test_bound(self):
+        driver = FakeDriver()
+        pool = ConnectionPool(driver, 2)
+        first, second = pool.get(), pool.get()
+        taken = []
+        waiting = threading.Thread(target=lambda: taken.append(pool.get()))
+        waiting.start()
+        waiting.join(0.1)
+        # the third one waits for a connection to be put back
+        self.assertTrue(waiting.is_alive())
+        self.assertEqual(driver.connects, 2)
+        pool.put(second, True)
+        waiting.join(1)
+        self.assertEqual(taken, [second])
+        self.assertEqual(driver.connects, 2)
+        # a failed one is closed and replaced by a new connection
+        pool.put(first, False)
+        self.assertTrue(first.closed)
+        self.assertIsNot(pool.get(), first)
+        self.assertEqual(driver.connects, 3)
@@ -0,0 +1,260 @@
+"""
+Updated: 2017
+Author: Sergei Shliakhtin
+Contact: xxx.serj@gmail.com
+Parser: Python 3
+Notes: Freshness and validation helpers unit tests
+
+To be run from the same directory where proxy.py resides!
+"""
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from proxy import freshness
+from proxy.const import Const
+from proxy.freshness import CachePolicy
+
+# Sun, 06 Nov 1994 08:49:37 GMT
+DATE = 784111777.0
+RECEIVED = 1000000000.0
+
+def header(*fields):
+    """return - bytes, response headers with the status line"""
+    return b"\r\n".join((b"HTTP/1.1 200 OK",) + fields)
+
+def expiry(*fields, default_ttl=2):
+    """return - float, seconds the response is fresh for since received"""
+    return freshness.expiry(header(*fields), RECEIVED, default_ttl) - RECEIVED
+
+class HeaderTest(TestCase):
+
+    def test_header_value(self):
+        response = header(b"ETag:  \"v1\" ", b"content-length: 5\r")
+        self.assertEqual(freshness.header_value(response, b"ETag"), b'"v1"')
+        self.assertEqual(freshness.header_value(response, b"Content-Length"), b"5")
+        self.assertIsNone(freshness.header_value(response, b"Expires"))
+        # the name is matched whole at the line start
+        self.assertIsNone(freshness.header_value(header(b"X-ETag: 1"), b"ETag"))
+
+    def test_http_date(self):
+        self.assertEqual(freshness.http_date(b"Sun, 06 Nov 1994 08:49:37 GMT"), DATE)
+        # RFC 850 and asctime formats
+        self.assertEqual(freshness.http_date(b"Sunday, 06-Nov-94 08:49:37 GMT"), DATE)
+        self.assertEqual(freshness.http_date(b"Sun Nov  6 08:49:37 1994"), DATE)
+        for malformed in (None, b"", b"0", b"yesterday", b"Sun, 32 Nov 1994 08:49:37 GMT"):
+            self.assertIsNone(freshness.http_date(malformed), malformed)
+
+    def test_cache_control(self):
+        directives = freshness.cache_control(header(b"Cache-Control: public, Max-Age=60",
+                                                    b"cache-control: s-maxage=\"30\",,no-cache"))
+        self.assertEqual(directives, {b"public": True, b"max-age": b"60", b"s-maxage": b"30",
+                                      b"no-cache": True})
+
+    def test_storable(self):
+        self.assertTrue(freshness.storable(header(b"Cache-Control: public")))
+        self.assertTrue(freshness.storable(header(b"Cache-Control: no-cache")))
+        self.assertFalse(freshness.storable(header(b"Cache-Control: no-store")))
+        self.assertFalse(freshness.storable(header(b"Cache-Control: private, max-age=60")))
+
+    def test_has_freshness(self):
+        self.assertFalse(freshness.has_freshness(header(b"ETag: \"v1\"")))
+        for field in (b"Cache-Control: max-age=0", b"Cache-Control: s-maxage=1",
+                      b"Cache-Control: no-cache", b"Expires: 0"):
+            self.assertTrue(freshness.has_freshness(header(field)), field)
+
+class ExpiryTest(TestCase):
+
+    def test_default_ttl(self):
+        self.assertEqual(expiry(b"Content-Length: 5", default_ttl=7), 7)
+
+    def test_max_age(self):
+        self.assertEqual(expiry(b"Cache-Control: max-age=60"), 60)
+        self.assertEqual(expiry(b"Cache-Control: max-age=-5"), 0)
+        self.assertEqual(expiry(b"Cache-Control: max-age=soon"), 0)
+
+    def test_s_maxage_over_max_age(self):
+        self.assertEqual(expiry(b"Cache-Control: max-age=60, s-maxage=30"), 30)
+        self.assertEqual(expiry(b"Cache-Control: s-maxage=90", b"Cache-Control: max-age=60"), 90)
+
+    def test_max_age_over_expires(self):
+        self.assertEqual(expiry(b"Cache-Control: max-age=60",
+                                b"Date: Sun, 06 Nov 1994 08:49:37 GMT",
+                                b"Expires: Sun, 06 Nov 1994 09:49:37 GMT"), 60)
+
+    def test_no_cache(self):
+        # stored, stale at once
+        self.assertEqual(expiry(b"Cache-Control: no-cache, max-age=60"), 0)
+
+    def test_expires_relative_to_date(self):
+        # the origin clock doesn't matter, only the difference
+        self.assertEqual(expiry(b"Date: Sun, 06 Nov 1994 08:49:37 GMT",
+                                b"Expires: Sun, 06 Nov 1994 08:59:37 GMT"), 600)
+        self.assertEqual(expiry(b"Date: Sun, 06 Nov 1994 08:49:37 GMT",
+                                b"Expires: Sun, 06 Nov 1994 08:39:37 GMT"), 0)
+
+    def test_expires_without_date(self):
+        # against the time received
+        self.assertEqual(expiry(b"Expires: Sun, 06 Nov 1994 08:49:37 GMT"), 0)
+
+    def test_malformed_expires(self):
+        self.assertEqual(expiry(b"Expires: 0"), 0)
+        self.assertEqual(expiry(b"Date: Sun, 06 Nov 1994 08:49:37 GMT", b"Expires: never"), 0)
+
+    def test_last_modified_heuristic(self):
+        # a tenth of the age since the last modification
+        self.assertEqual(expiry(b"Date: Sun, 06 Nov 1994 08:49:37 GMT",
+                                b"Last-Modified: Sun, 06 Nov 1994 07:49:37 GMT"), 360)
+        # modified after Date
+        self.assertEqual(expiry(b"Date: Sun, 06 Nov 1994 08:49:37 GMT",
+                                b"Last-Modified: Sun, 06 Nov 1994 09:49:37 GMT"), 0)
+
+    def test_last_modified_heuristic_cap(self):
+        self.assertEqual(expiry(b"Date: Sun, 06 Nov 1994 08:49:37 GMT",
+                                b"Last-Modified: Sun, 06 Nov 1984 08:49:37 GMT"),
+                         freshness.HEURISTIC_MAX)
+
+    def test_malformed_last_modified(self):
+        self.assertEqual(expiry(b"Last-Modified: long ago", default_ttl=7), 7)
+
+class ValidationTest(TestCase):
+    CACHED = (b"Content-Length: 5\r\nETag: \"v1\"\r\n"
+              b"Last-Modified: Sun, 06 Nov 1994 08:49:37 GMT\r\nCache-Control: max-age=60")
+
+    def test_cached_header(self):
+        self.assertEqual(freshness.cached_header(self.CACHED + b"\r\n\r\nHello"), self.CACHED)
+        self.assertEqual(freshness.cached_header(b"ETag: 1\n\nHello\r\n\r\n"), b"ETag: 1")
+
+    def test_request_conditions(self):
+        self.assertTrue(freshness.is_conditional(b"GET / HTTP/1.1\r\nIf-None-Match: \"v1\""))
+        self.assertTrue(freshness.is_conditional(
+            b"GET / HTTP/1.1\r\nIf-Modified-Since: Sun, 06 Nov 1994 08:49:37 GMT"))
+        self.assertFalse(freshness.is_conditional(b"GET / HTTP/1.1\r\nHost: localhost"))
+        self.assertTrue(freshness.no_cache_requested(b"GET / HTTP/1.1\r\nPragma: No-Cache"))
+        self.assertTrue(freshness.no_cache_requested(
+            b"GET / HTTP/1.1\r\nCache-Control: no-cache"))
+        self.assertFalse(freshness.no_cache_requested(
+            b"GET / HTTP/1.1\r\nCache-Control: max-age=0"))
+
+    def test_not_modified_etag(self):
+        for if_none_match, result in ((b'"v1"', True), (b'W/"v1"', True), (b'"v0", "v1"', True),
+                                      (b"*", True), (b'"v2"', False)):
+            request = b"GET / HTTP/1.1\r\nIf-None-Match: " + if_none_match
+            self.assertEqual(freshness.not_modified(request, self.CACHED), result, if_none_match)
+        # If-None-Match wins over If-Modified-Since
+        request = (b"GET / HTTP/1.1\r\nIf-None-Match: \"v2\"\r\n"
+                   b"If-Modified-Since: Sun, 06 Nov 1994 08:49:37 GMT")
+        self.assertFalse(freshness.not_modified(request, self.CACHED))
+
+    def test_not_modified_gzip_etag(self):
+        cached = b'ETag: "v1' + freshness.GZIP_ETAG_SUFFIX + b'"'
+        for if_none_match in (b'"v1"', b'"v1' + freshness.GZIP_ETAG_SUFFIX + b'"'):
+            request = b"GET / HTTP/1.1\r\nIf-None-Match: " + if_none_match
+            self.assertTrue(freshness.not_modified(request, cached), if_none_match)
+        self.assertEqual(freshness.origin_etag(b'"v1' + freshness.GZIP_ETAG_SUFFIX + b'"'),
+                         b'"v1"')
+        self.assertEqual(freshness.origin_etag(b'"v1"'), b'"v1"')
+
+    def test_not_modified_since(self):
+        for since, result in ((b"Sun, 06 Nov 1994 08:49:37 GMT", True),
+                              (b"Sun, 06 Nov 1994 09:49:37 GMT", True),
+                              (b"Sun, 06 Nov 1994 07:49:37 GMT", False),
+                              (b"whenever", False)):
+            request = b"GET / HTTP/1.1\r\nIf-Modified-Since: " + since
+            self.assertEqual(freshness.not_modified(request, self.CACHED), result, since)
+
+    def test_not_modified_response(self):
+        response = freshness.not_modified_response(self.CACHED)
+        self.assertTrue(response.startswith(b"HTTP/1.1 304 Not Modified\r\n"))
+        self.assertTrue(response.endswith(b"\r\n\r\n"))
+        self.assertIn(b'\r\nETag: "v1"\r\n', response)
+        self.assertIn(b"\r\nCache-Control: max-age=60\r\n", response)
+        self.assertNotIn(b"Content-Length", response)
+
+    def test_conditional_request(self):
+        request = (b"GET http://localhost/a HTTP/1.1\r\nHost: localhost\r\n"
+                   b"If-None-Match: \"client\"\r\n\r\n")
+        conditional = freshness.conditional_request(request, self.CACHED)
+        self.assertEqual(conditional, b"GET http://localhost/a HTTP/1.1\r\nHost: localhost\r\n"
+                         b"If-None-Match: \"v1\"\r\n"
+                         b"If-Modified-Since: Sun, 06 Nov 1994 08:49:37 GMT\r\n\r\n")
+        self.assertIsNone(freshness.conditional_request(request, b"Content-Length: 5"))
+        # the origin ETag of a gzipped copy
+        cached = b'ETag: "v1' + freshness.GZIP_ETAG_SUFFIX + b'"'
+        self.assertIn(b'\r\nIf-None-Match: "v1"\r\n',
+                      freshness.conditional_request(request, cached))
+
+class TimesStorage:
+    """Storage stand-in keeping the cached times only"""
+
+    def __init__(self):
+        self.times = {}
+
+    def cached_times(self, key_path):
+        return self.times.get(key_path)
+
+class CachePolicyTest(TestCase):
+    # seconds
+    DEFAULT_TTL, SWR, SIE = 2, 30, 3600
+    EXPIRY = RECEIVED + 60
+    REQUEST = b"GET http://localhost/a HTTP/1.1\r\nHost: localhost"
+
+    def setUp(self):
+        self.now = RECEIVED
+        self.values = {"cache_discard_after": str(self.DEFAULT_TTL),
+                       "stale_while_revalidate": str(self.SWR), "stale_if_error": str(self.SIE)}
+        def config_value(section, key):
+            assert Const.STORAGE_SECTION == section
+            return self.values[key]
+        for target, side_effect in (("proxy.freshness.Config.value", config_value),
+                                    ("proxy.freshness.time.time", lambda: self.now)):
+            patcher = patch(target, side_effect=side_effect)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.storage = TimesStorage()
+        self.storage.times[b"localhost/a"] = (RECEIVED, self.EXPIRY)
+
+    def lookup(self, now, background_refresh=True, request=REQUEST):
+        self.now = now
+        policy = CachePolicy(self.storage, background_refresh=background_refresh)
+        return policy.lookup(b"localhost/a", request)
+
+    def test_windows(self):
+        for now, state in ((RECEIVED, CachePolicy.FRESH),
+                           (self.EXPIRY - 0.001, CachePolicy.FRESH),
+                           (self.EXPIRY, CachePolicy.STALE_REVALIDATE),
+                           (self.EXPIRY + self.SWR - 0.001, CachePolicy.STALE_REVALIDATE),
+                           (self.EXPIRY + self.SWR, CachePolicy.STALE_IF_ERROR),
+                           (self.EXPIRY + self.SIE - 0.001, CachePolicy.STALE_IF_ERROR),
+                           (self.EXPIRY + self.SIE, CachePolicy.STALE),
+                           (self.EXPIRY + 10 * self.SIE, CachePolicy.STALE)):
+            self.assertEqual(self.lookup(now), state, now - self.EXPIRY)
+
+    def test_windows_without_refresher(self):
+        for now, state in ((self.EXPIRY - 0.001, CachePolicy.FRESH),
+                           (self.EXPIRY, CachePolicy.STALE_IF_ERROR),
+                           (self.EXPIRY + self.SWR, CachePolicy.STALE_IF_ERROR),
+                           (self.EXPIRY + self.SIE, CachePolicy.STALE)):
+            self.assertEqual(self.lookup(now, background_refresh=False), state,
+                             now - self.EXPIRY)
+
+    def test_windows_off(self):
+        self.values.update(stale_while_revalidate="0", stale_if_error="0")
+        for now, state in ((self.EXPIRY - 0.001, CachePolicy.FRESH),
+                           (self.EXPIRY, CachePolicy.STALE)):
+            self.assertEqual(self.lookup(now), state, now - self.EXPIRY)
+
+    def test_default_ttl(self):
+        # stored telling nothing about freshness
+        self.storage.times[b"localhost/a"] = (RECEIVED, 0.0)
+        for now, state in ((RECEIVED + self.DEFAULT_TTL - 0.001, CachePolicy.FRESH),
+                           (RECEIVED + self.DEFAULT_TTL, CachePolicy.STALE_REVALIDATE)):
+            self.assertEqual(self.lookup(now), state, now - RECEIVED)
+
+    def test_no_cache_requested(self):
+        request = self.REQUEST + b"\r\nCache-Control: no-cache"
+        self.assertEqual(self.lookup(RECEIVED, request=request), CachePolicy.STALE)
+
+    def test_miss(self):
+        del self.storage.times[b"localhost/a"]
+        self.assertEqual(self.lookup(RECEIVED), CachePolicy.MISS)
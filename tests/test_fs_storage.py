@@ -0,0 +1,176 @@
+"""
+Updated: 2017
+Author: Sergei Shliakhtin
+Contact: xxx.serj@gmail.com
+Parser: Python 3
+Notes: FSStorage unit tests, on a temporary dir
+
+To be run from the same directory where proxy.py resides!
+"""
+
+import hashlib
+import io
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from proxy.fs_storage import FSStorage, HASHED_LAYOUT, PLAIN_LAYOUT
+
+class FSWriterTest(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.storage = FSStorage(self.tmp_dir.name, HASHED_LAYOUT)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_same_key_at_once(self):
+        first = self.storage.writer(b"localhost/a")
+        second = self.storage.writer(b"localhost/a")
+        first.write(b"first")
+        second.write(b"second")
+        second.abort()
+        self.assertTrue(first.commit())
+        self.assertEqual(self.storage.fetch(b"localhost/a"), b"first")
+
+    def test_commit_order(self):
+        first = self.storage.writer(b"localhost/a")
+        second = self.storage.writer(b"localhost/a")
+        second.write(b"second")
+        first.write(b"first")
+        self.assertTrue(second.commit())
+        self.assertTrue(first.commit())
+        self.assertEqual(self.storage.fetch(b"localhost/a"), b"first")
+
+    def test_no_tmp_left(self):
+        writer = self.storage.writer(b"localhost/a")
+        writer.write(b"data")
+        writer.abort()
+        self.assertIsNone(self.storage.fetch(b"localhost/a"))
+        for dir_path, dir_names, file_names in os.walk(self.tmp_dir.name):
+            self.assertEqual(file_names, [])
+
+class FSStorageTest(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = self.tmp_dir.name.encode()
+        self.storage = FSStorage(self.tmp_dir.name, HASHED_LAYOUT)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def save_plain(self, key_path, data, mtime):
+        """Put a file of the plain layout into the cache dir"""
+        file_path = os.path.join(self.cache_dir, key_path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "wb") as cache_file:
+            cache_file.write(data)
+        os.utime(file_path, (mtime, mtime))
+        return file_path
+
+    def test_hashed_path(self):
+        key_path = b"localhost/a?b=c/d"
+        self.assertTrue(self.storage.save(key_path, b"data", 123.5))
+        digest = hashlib.sha1(key_path).hexdigest().encode()
+        file_path = os.path.join(self.cache_dir, digest[:2], digest[2:4], digest)
+        with open(file_path, "rb") as cache_file:
+            self.assertEqual(cache_file.read(), key_path + b" 123.500\ndata")
+        self.assertEqual(self.storage.fetch(key_path), b"data")
+        self.assertEqual(self.storage.cached_times(key_path)[1], 123.5)
+        cache_file, offset, size = self.storage.fetch_file(key_path)
+        with cache_file:
+            cache_file.seek(offset)
+            self.assertEqual(cache_file.read(size), b"data")
+
+    def test_read_meta(self):
+        read_meta = FSStorage._read_meta
+        self.assertEqual(read_meta(io.BytesIO(b"localhost/a 10.500\ndata"), b"localhost/a"), 10.5)
+        # written without the expiry time, the path may have spaces
+        self.assertEqual(read_meta(io.BytesIO(b"localhost/a b\ndata"), b"localhost/a b"), 0.0)
+        self.assertEqual(read_meta(io.BytesIO(b"localhost/a 1.0\ndata")), 1.0)
+        self.assertIsNone(read_meta(io.BytesIO(b"localhost/b 1.0\ndata"), b"localhost/a"))
+
+    def test_other_key_in_place(self):
+        self.storage.save(b"localhost/a", b"data")
+        # as if localhost/b had the same hash
+        other_path = self.storage._amend_path(b"localhost/b")
+        os.makedirs(os.path.dirname(other_path))
+        os.rename(self.storage._amend_path(b"localhost/a"), other_path)
+        self.assertIsNone(self.storage.fetch(b"localhost/b"))
+        self.assertIsNone(self.storage.fetch_file(b"localhost/b"))
+        self.assertIsNone(self.storage.cached_times(b"localhost/b"))
+
+    def test_migrate(self):
+        self.save_plain(b"localhost/a", b"data a", 1000.0)
+        self.save_plain(b"localhost/dir/b", b"data b", 2000.0)
+        # left by a worker which has died while writing
+        self.save_plain(b"localhost/c.123.tmp", b"partial", 3000.0)
+        self.assertEqual(self.storage.migrate(), 2)
+        self.assertEqual(self.storage.fetch(b"localhost/a"), b"data a")
+        self.assertEqual(self.storage.fetch(b"localhost/dir/b"), b"data b")
+        self.assertEqual(self.storage.cached_times(b"localhost/dir/b")[0], 2000.0)
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, b"localhost")))
+        # nothing is left to move
+        self.assertEqual(self.storage.migrate(), 0)
+
+    def test_migrate_failed_save(self):
+        file_path = self.save_plain(b"localhost/a", b"data a", 1000.0)
+        with patch.object(self.storage, "save", return_value=False):
+            self.assertEqual(self.storage.migrate(), 0)
+        with open(file_path, "rb") as cache_file:
+            self.assertEqual(cache_file.read(), b"data a")
+        # moved on the next start
+        self.assertEqual(self.storage.migrate(), 1)
+        self.assertEqual(self.storage.fetch(b"localhost/a"), b"data a")
+
+    def test_plain_layout_untouched(self):
+        storage = FSStorage(self.tmp_dir.name, PLAIN_LAYOUT)
+        file_path = self.save_plain(b"localhost/a", b"data a", 1000.0)
+        self.assertEqual(storage.migrate(), 0)
+        self.assertEqual(storage.fetch(b"localhost/a"), b"data a")
+        self.assertTrue(os.path.exists(file_path))
+
+class PlainLayoutTest(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.cache_dir = self.tmp_dir.name.encode()
+        self.storage = FSStorage(self.tmp_dir.name, PLAIN_LAYOUT)
+        self.file_path = os.path.join(self.cache_dir, b"localhost/a")
+
+    def test_expiry_kept(self):
+        self.assertTrue(self.storage.save(b"localhost/a", b"data", 123.5))
+        # the resource file holds the resource only
+        with open(self.file_path, "rb") as cache_file:
+            self.assertEqual(cache_file.read(), b"data")
+        self.assertEqual(self.storage.cached_times(b"localhost/a")[1], 123.5)
+        self.assertEqual(list(self.storage.scan())[0][3], 123.5)
+
+    def test_default_age_limit(self):
+        self.storage.save(b"localhost/a", b"data", 123.5)
+        # the next response tells nothing about its freshness
+        self.storage.save(b"localhost/a", b"other")
+        self.assertEqual(self.storage.cached_times(b"localhost/a")[1], 0.0)
+        self.assertFalse(os.path.exists(self.file_path + b".meta"))
+
+    def test_sidecar_name_refused(self):
+        self.assertFalse(self.storage.save(b"localhost/a.meta", b"data", 123.5))
+        self.storage.save(b"localhost/a", b"data", 123.5)
+        self.assertEqual(len(list(self.storage.scan())), 1)
+
+    def test_erase(self):
+        self.storage.save(b"localhost/a", b"data", 123.5)
+        self.storage.erase(b"localhost/a")
+        self.assertIsNone(self.storage.cached_times(b"localhost/a"))
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, b"localhost")))
+
+    def test_migrate_keeps_expiry(self):
+        self.storage.save(b"localhost/a", b"data", 123.5)
+        hashed = FSStorage(self.tmp_dir.name, HASHED_LAYOUT)
+        self.assertEqual(hashed.migrate(), 1)
+        self.assertEqual(hashed.cached_times(b"localhost/a")[1], 123.5)
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, b"localhost")))
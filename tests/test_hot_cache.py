@@ -0,0 +1,87 @@
+"""
+Updated: 2017
+Author: Sergei Shliakhtin
+Contact: xxx.serj@gmail.com
+Parser: Python 3
+Notes: HotCache unit tests, on a temporary file
+
+To be run from the same directory where proxy.py resides!
+"""
+
+import os
+import tempfile
+from unittest import TestCase
+
+from proxy import hot_cache
+from proxy.hot_cache import HotCache
+
+# bytes of a resource in the ring: the entry header, the key and the data
+ENTRY_SIZE = hot_cache._ENTRY.size + len(b"localhost/0") + 20
+
+class HotCacheTest(TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+
+    def open(self, size, slots=64, max_object_size=1024):
+        HotCache.create(self.path, size, slots)
+        return HotCache(self.path, max_object_size)
+
+    def test_put_get(self):
+        cache = self.open(4096)
+        self.assertTrue(cache.put(b"localhost/a", b"data", 100.0))
+        self.assertEqual(cache.get(b"localhost/a"), (100.0, b"data"))
+        self.assertIsNone(cache.get(b"localhost/b"))
+
+    def test_too_large(self):
+        cache = self.open(4096, max_object_size=8)
+        self.assertFalse(cache.put(b"localhost/a", b"123456789", 100.0))
+        cache = self.open(16)
+        self.assertFalse(cache.put(b"localhost/a", b"data", 100.0))
+        self.assertIsNone(cache.get(b"localhost/a"))
+
+    def test_ring_wrap_around(self):
+        # three resources fit, the fourth starts from the ring beginning again
+        cache = self.open(ENTRY_SIZE * 3 + ENTRY_SIZE // 2)
+        for number in range(4):
+            self.assertTrue(cache.put(b"localhost/%i" % number, b"%020i" % number, 100.0))
+        # the first one is overwritten, the rest are intact
+        self.assertIsNone(cache.get(b"localhost/0"))
+        for number in range(1, 4):
+            self.assertEqual(cache.get(b"localhost/%i" % number), (100.0, b"%020i" % number))
+
+    def test_overwritten_later(self):
+        cache = self.open(ENTRY_SIZE * 2)
+        for number in range(5):
+            cache.put(b"localhost/%i" % number, b"%020i" % number, 100.0)
+        # the index still points to the older ones, their space has been reused
+        for number in range(3):
+            self.assertIsNone(cache.get(b"localhost/%i" % number))
+        for number in range(3, 5):
+            self.assertEqual(cache.get(b"localhost/%i" % number)[1], b"%020i" % number)
+
+    def test_same_slot(self):
+        cache = self.open(4096, slots=1)
+        cache.put(b"localhost/a", b"first", 100.0)
+        cache.put(b"localhost/b", b"second", 100.0)
+        # the slot is verified by the key kept in the ring
+        self.assertIsNone(cache.get(b"localhost/a"))
+        self.assertEqual(cache.get(b"localhost/b"), (100.0, b"second"))
+        cache.erase(b"localhost/a")
+        self.assertEqual(cache.get(b"localhost/b"), (100.0, b"second"))
+
+    def test_replace_and_erase(self):
+        cache = self.open(4096)
+        cache.put(b"localhost/a", b"first", 100.0)
+        cache.put(b"localhost/a", b"second", 200.0)
+        self.assertEqual(cache.get(b"localhost/a"), (200.0, b"second"))
+        cache.erase(b"localhost/a")
+        self.assertIsNone(cache.get(b"localhost/a"))
+
+    def test_shared_file(self):
+        cache = self.open(4096)
+        cache.put(b"localhost/a", b"data", 100.0)
+        # another process maps the same file
+        self.assertEqual(HotCache(self.path, 1024).get(b"localhost/a"), (100.0, b"data"))
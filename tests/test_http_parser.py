@@ -0,0 +1,143 @@
+"""
+Updated: 2017
+Author: Sergei Shliakhtin
+Contact: xxx.serj@gmail.com
+Parser: Python 3
+Notes: HttpParser unit tests
+
+To be run from the same directory where proxy.py resides!
+"""
+
+from unittest import TestCase
+
+from proxy import http_parser
+from proxy.http_parser import HttpParser
+
+REQUEST = b"GET http://localhost/a HTTP/1.1\r\nHost: localhost\r\n\r\n"
+RESPONSE = b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nHello"
+CHUNKED = (b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+           b"5;ext=1\r\nHello\r\nb\r\n 0\r\n\r\n end\r\n0\r\nX-Trailer: 1\r\n\r\n")
+
+def feed_pieces(data, size):
+    """return - HttpParser fed with data in pieces of size bytes"""
+    parser = HttpParser()
+    for start in range(0, len(data), size):
+        parser.feed(data[start:start + size])
+    return parser
+
+class HttpParserTest(TestCase):
+
+    def test_no_body(self):
+        parser = HttpParser()
+        self.assertTrue(parser.feed(REQUEST))
+        self.assertEqual(parser.message, REQUEST)
+        self.assertEqual(parser.header, REQUEST[:-4])
+        self.assertFalse(parser.delimited)
+
+    def test_content_length(self):
+        parser = feed_pieces(RESPONSE, 1)
+        self.assertTrue(parser.done)
+        self.assertEqual(parser.message, RESPONSE)
+        self.assertEqual(parser.content_length, 5)
+        self.assertTrue(parser.delimited)
+
+    def test_incomplete_body(self):
+        parser = HttpParser()
+        self.assertFalse(parser.feed(RESPONSE[:-1]))
+        self.assertEqual(HttpParser.BODY, parser.state)
+        self.assertTrue(parser.feed(RESPONSE[-1:]))
+
+    def test_terminator_split(self):
+        for split in range(1, 4):
+            parser = HttpParser()
+            self.assertFalse(parser.feed(REQUEST[:-split]))
+            self.assertTrue(parser.feed(REQUEST[-split:]))
+            self.assertEqual(parser.message, REQUEST)
+
+    def test_bare_newlines(self):
+        request = b"GET / HTTP/1.0\nHost: localhost\n\n"
+        parser = feed_pieces(request, 3)
+        self.assertTrue(parser.done)
+        self.assertEqual(parser.header, request[:-2])
+
+    def test_leading_blank_lines(self):
+        parser = HttpParser()
+        parser.feed(b"\r\n")
+        self.assertTrue(parser.feed(REQUEST))
+        self.assertEqual(parser.message, REQUEST)
+
+    def test_chunked(self):
+        for size in (1, 2, 7, len(CHUNKED)):
+            parser = feed_pieces(CHUNKED, size)
+            self.assertTrue(parser.done, size)
+            self.assertFalse(parser.error)
+            self.assertTrue(parser.chunked)
+            self.assertEqual(parser.message, CHUNKED)
+
+    def test_chunk_data_like_last_chunk(self):
+        # "0\r\n\r\n" inside the chunk data doesn't end the message
+        parser = HttpParser()
+        self.assertFalse(parser.feed(CHUNKED[:CHUNKED.index(b" end")]))
+        self.assertEqual(HttpParser.CHUNK_DATA, parser.state)
+
+    def test_pipelined(self):
+        parser = HttpParser()
+        self.assertTrue(parser.feed(RESPONSE + CHUNKED + REQUEST[:10]))
+        self.assertEqual(parser.message, RESPONSE)
+        self.assertEqual(parser.tail, CHUNKED + REQUEST[:10])
+        parser = HttpParser()
+        self.assertTrue(parser.feed(CHUNKED + RESPONSE))
+        self.assertEqual(parser.tail, RESPONSE)
+
+    def test_take(self):
+        parser = HttpParser()
+        self.assertEqual(parser.take(), b"")
+        taken = b""
+        for start in range(0, len(CHUNKED), 10):
+            parser.feed(CHUNKED[start:start + 10] + (REQUEST if start + 10 >= len(CHUNKED) else b""))
+            taken += parser.take()
+        self.assertTrue(parser.done)
+        self.assertEqual(taken, CHUNKED)
+        self.assertEqual(parser.message, b"")
+        self.assertEqual(parser.tail, REQUEST)
+
+    def test_take_headers_first(self):
+        parser = HttpParser()
+        parser.feed(RESPONSE[:10])
+        self.assertEqual(parser.take(), b"")
+        parser.feed(RESPONSE[10:-2])
+        head = parser.take()
+        self.assertEqual(head, RESPONSE[:-2])
+        parser.feed(RESPONSE[-2:])
+        self.assertEqual(parser.take(), RESPONSE[-2:])
+        self.assertTrue(parser.done)
+
+    def test_bad_chunk_size(self):
+        parser = HttpParser()
+        parser.feed(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\nzz\r\n")
+        self.assertTrue(parser.error)
+        self.assertFalse(parser.done)
+        self.assertFalse(parser.oversize)
+
+    def test_missing_chunk_end(self):
+        parser = HttpParser()
+        parser.feed(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n2\r\nabcd\r\n")
+        self.assertTrue(parser.error)
+
+    def test_oversize_headers(self):
+        parser = HttpParser()
+        parser.feed(b"GET / HTTP/1.1\r\n")
+        parser.feed(b"X-Long: " + b"a" * http_parser.MAX_LINE_SIZE)
+        self.assertTrue(parser.error)
+        self.assertTrue(parser.oversize)
+        # complete at once, but too long anyway
+        parser = HttpParser()
+        parser.feed(b"GET / HTTP/1.1\r\nX-Long: " + b"a" * http_parser.MAX_LINE_SIZE + b"\r\n\r\n")
+        self.assertTrue(parser.oversize)
+
+    def test_oversize_chunk_line(self):
+        parser = HttpParser()
+        parser.feed(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n")
+        parser.feed(b"1" * (http_parser.MAX_LINE_SIZE + 1))
+        self.assertTrue(parser.oversize)
+        self.assertFalse(parser.done)
@@ -0,0 +1,90 @@
+"""
+Updated: 2017
+Author: Sergei Shliakhtin
+Contact: xxx.serj@gmail.com
+Parser: Python 3
+Notes: MetricsRegion unit tests, the exposition is parsed back as a scraper would
+
+To be run from the same directory where proxy.py resides!
+"""
+
+import re
+from unittest import TestCase
+
+from proxy import metrics
+from proxy.metrics import MetricsRegion
+
+# name{labels} value
+_SAMPLE = re.compile(r'^([a-z_]+)(?:\{([^}]*)\})? (\S+)$')
+
+def parse(text):
+    """text - str, the Prometheus text format
+    return - ({(name, labels): float}, {name: type}, {name: help})
+    """
+    samples, types, helps = {}, {}, {}
+    for line in text.splitlines():
+        if line.startswith("# HELP "):
+            name, help_text = line[len("# HELP "):].split(" ", 1)
+            helps[name] = help_text
+        elif line.startswith("# TYPE "):
+            name, type_ = line[len("# TYPE "):].split(" ")
+            types[name] = type_
+        else:
+            name, labels, value = _SAMPLE.match(line).groups()
+            samples[(name, labels or "")] = float(value)
+    return samples, types, helps
+
+class MetricsRegionTest(TestCase):
+
+    def setUp(self):
+        self.region = MetricsRegion(2)
+        self.first = self.region.allocate()
+        self.second = self.region.allocate()
+
+    def test_counters(self):
+        self.first.count("requests")
+        self.second.count("requests", 2)
+        self.second.count("tunnel_bytes_up", 100)
+        samples, types, helps = parse(self.region.exposition())
+        self.assertEqual(samples[("rarog_requests_total", "")], 3)
+        self.assertEqual(samples[("rarog_tunnel_bytes_up_total", "")], 100)
+        self.assertEqual(samples[("rarog_errors_total", "")], 0)
+        for counter, help_text in metrics.COUNTERS:
+            self.assertEqual(types["rarog_%s_total" % counter], "counter")
+            self.assertEqual(helps["rarog_%s_total" % counter], help_text)
+
+    def test_histograms(self):
+        self.first.observe("hit", 0.002)
+        self.second.observe("hit", 0.002)
+        self.second.observe("hit", 100.0)
+        self.first.observe("miss", 0.3)
+        samples, types, _ = parse(self.region.exposition())
+        self.assertEqual(types["rarog_request_duration_seconds"], "histogram")
+        self.assertEqual(types["rarog_phase_duration_seconds"], "histogram")
+        name = "rarog_request_duration_seconds"
+        hit_buckets = [samples[(name + "_bucket", 'path="hit",le="%s"' % bound)]
+                       for bound in metrics.BUCKETS + ("+Inf",)]
+        # cumulative
+        self.assertEqual(hit_buckets, sorted(hit_buckets))
+        self.assertEqual(samples[(name + "_bucket", 'path="hit",le="0.001"')], 0)
+        self.assertEqual(samples[(name + "_bucket", 'path="hit",le="0.0025"')], 2)
+        self.assertEqual(samples[(name + "_bucket", 'path="hit",le="10.0"')], 2)
+        self.assertEqual(hit_buckets[-1], 3)
+        self.assertEqual(samples[(name + "_count", 'path="hit"')], 3)
+        self.assertAlmostEqual(samples[(name + "_sum", 'path="hit"')], 100.004, places=3)
+        self.assertEqual(samples[(name + "_count", 'path="miss"')], 1)
+        self.assertEqual(samples[(name + "_bucket", 'path="miss",le="0.25"')], 0)
+        self.assertEqual(samples[(name + "_bucket", 'path="miss",le="0.5"')], 1)
+
+    def test_gauges(self):
+        samples, types, helps = parse(self.region.exposition([("workers", "Worker processes", 5)]))
+        self.assertEqual(samples[("rarog_workers", "")], 5)
+        self.assertEqual(types["rarog_workers"], "gauge")
+        self.assertEqual(helps["rarog_workers"], "Worker processes")
+
+    def test_released_slot(self):
+        self.first.count("hits")
+        self.region.release(self.first)
+        self.assertEqual(self.region.free_slots(), 1)
+        # the totals keep what a gone worker has counted
+        self.assertEqual(self.region.total("hits"), 1)
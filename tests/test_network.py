@@ -0,0 +1,93 @@
+"""
+Updated: 2017
+Author: Sergei Shliakhtin
+Contact: xxx.serj@gmail.com
+Parser: Python 3
+Notes: Tunnel unit tests, on local socket pairs
+
+To be run from the same directory where proxy.py resides!
+"""
+
+import socket
+import threading
+from unittest import TestCase, skipUnless
+
+import proxy.network as net
+
+class TunnelDirectionTest(TestCase):
+
+    def setUp(self):
+        # client <-> (proxy_client, proxy_orig) <-> orig
+        self.client, self.proxy_client = socket.socketpair()
+        self.proxy_orig, self.orig = socket.socketpair()
+        for sock in (self.client, self.proxy_client, self.proxy_orig, self.orig):
+            self.addCleanup(sock.close)
+        for sock in (self.proxy_client, self.proxy_orig):
+            sock.setblocking(False)
+
+    def relay(self, direction, data):
+        """Pass data through direction and read it on the other side"""
+        def client():
+            self.client.sendall(data)
+            self.client.shutdown(socket.SHUT_WR)
+        thread = threading.Thread(target=client)
+        thread.start()
+        self.addCleanup(thread.join)
+        received = b""
+        while not direction.done:
+            if direction.want_read():
+                direction.read()
+            while direction.want_write() and direction.write():
+                received += self.orig.recv(65536)
+        while True:
+            piece = self.orig.recv(65536)
+            if not piece:
+                break
+            received += piece
+        return received
+
+    @skipUnless(hasattr(net.os, "splice"), "no os.splice")
+    def test_splice(self):
+        direction = net.TunnelDirection(self.proxy_client, self.proxy_orig)
+        self.addCleanup(direction.close)
+        self.assertIsNotNone(direction._pipe)
+        data = b"x" * 100000
+        self.assertEqual(self.relay(direction, data), data)
+        self.assertEqual(direction.moved, len(data))
+        self.assertTrue(direction.eof)
+
+    def test_copy(self):
+        direction = net.TunnelDirection(self.proxy_client, self.proxy_orig)
+        # no pipe, the data goes through the buffer
+        direction.close()
+        data = b"y" * 100000
+        self.assertEqual(self.relay(direction, data), data)
+        self.assertEqual(direction.moved, len(data))
+
+    def test_nothing_to_read(self):
+        direction = net.TunnelDirection(self.proxy_client, self.proxy_orig)
+        self.addCleanup(direction.close)
+        self.assertFalse(direction.read())
+        self.assertTrue(direction.want_read())
+        self.assertFalse(direction.want_write())
+
+    def test_tunnel_counts_each_way(self):
+        def origin():
+            self.orig.sendall(b"d" * 3000)
+            self.orig.shutdown(socket.SHUT_WR)
+            while self.orig.recv(65536):
+                pass
+        thread = threading.Thread(target=origin)
+        thread.start()
+        self.client.sendall(b"u" * 1000)
+        self.client.shutdown(socket.SHUT_WR)
+        sent, received = net.tunnel(self.proxy_client, self.proxy_orig, 5)
+        thread.join()
+        self.assertEqual((sent, received), (1000, 3000))
+        data = b""
+        while True:
+            piece = self.client.recv(65536)
+            if not piece:
+                break
+            data += piece
+        self.assertEqual(data, b"d" * 3000)
@@ -0,0 +1,82 @@
+"""
+Updated: 2017
+Author: Sergei Shliakhtin
+Contact: xxx.serj@gmail.com
+Parser: Python 3
+Notes: PipelinePrefetcher unit tests, the fetches aren't run and the flights are taken on a
+    temporary lock dir
+
+To be run from the same directory where proxy.py resides!
+"""
+
+import concurrent.futures
+import tempfile
+from unittest import TestCase
+
+from proxy import pipeline
+from proxy.collapsed_forwarding import FlightRegistry
+from proxy.pipeline import PipelinePrefetcher
+
+REQUESTS = (b"GET http://localhost/a HTTP/1.1\r\nHost: localhost\r\n\r\n"
+            b"GET http://localhost/b HTTP/1.1\r\nHost: localhost\r\n\r\n")
+
+class PipelinePrefetcherTest(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.registry = FlightRegistry(self.tmp_dir.name, 0.05, 0.01)
+        self.spawned = []
+        self.prefetcher = PipelinePrefetcher(self.spawn, 4, self.registry)
+        self.addCleanup(self.prefetcher.clear)
+        self.first, self.second = pipeline.complete_requests(REQUESTS)
+
+    def join(self, key_path):
+        flight = self.registry.join(key_path)
+        self.addCleanup(flight.release)
+        return flight
+
+    def spawn(self, host, request_message):
+        future = concurrent.futures.Future()
+        self.spawned.append((host, request_message, future))
+        return future
+
+    def test_complete_requests(self):
+        self.assertEqual([request.cache_location for request in (self.first, self.second)],
+                         [b"localhost/a", b"localhost/b"])
+        # the second one is incomplete
+        self.assertEqual([request.cache_location
+                          for request in pipeline.complete_requests(REQUESTS[:-2])],
+                         [b"localhost/a"])
+
+    def test_leads_the_flight(self):
+        self.assertTrue(self.prefetcher.start(self.first))
+        self.assertEqual(len(self.spawned), 1)
+        # other processes wait for it
+        self.assertFalse(self.join(b"localhost/a").leader)
+        future, flight = self.prefetcher.take(self.first)
+        self.assertIs(future, self.spawned[0][2])
+        self.assertTrue(flight.leader)
+        flight.release()
+        self.assertTrue(self.join(b"localhost/a").leader)
+
+    def test_fetched_by_another_process(self):
+        self.join(b"localhost/a")
+        self.assertFalse(self.prefetcher.start(self.first))
+        self.assertEqual(self.spawned, [])
+        self.assertEqual(self.prefetcher.take(self.first), (None, None))
+
+    def test_clear_releases(self):
+        self.prefetcher.start(self.first)
+        self.prefetcher.start(self.second)
+        self.prefetcher.clear()
+        self.assertTrue(all(future.cancelled() for _, _, future in self.spawned))
+        self.assertTrue(self.join(b"localhost/b").leader)
+
+    def test_without_flights(self):
+        prefetcher = PipelinePrefetcher(self.spawn, 1)
+        self.assertTrue(prefetcher.start(self.first))
+        self.assertFalse(prefetcher.start(self.second))
+        future, flight = prefetcher.take(self.first)
+        self.assertIsNotNone(future)
+        self.assertIsNone(flight)
@@ -0,0 +1,202 @@
+"""
+Updated: 2017
+Author: Sergei Shliakhtin
+Contact: xxx.serj@gmail.com
+Parser: Python 3
+Notes: RequestHandling unit tests, the decisions are taken on canned messages with no worker
+    engine around them
+
+To be run from the same directory where proxy.py resides!
+"""
+
+import socket
+from unittest import TestCase
+from unittest.mock import Mock
+
+from proxy import request_handling
+from proxy.const import Const
+from proxy.freshness import CachePolicy
+from proxy.http_parser import HttpParser
+import proxy.http_response as Response
+from proxy.request_handling import RequestHandling
+from proxy.request_reader import RequestReader
+from proxy.response_reader import ResponseReader, ResponseRelay
+from proxy.tracing import RequestTrace
+
+CACHED = b"ETag: \"v1\"\r\nContent-Length: 5\r\n\r\nHello"
+
+def request(*fields):
+    """fields - bytes, header lines to add
+    return - RequestReader of a GET request
+    """
+    message = b"\r\n".join((b"GET http://localhost/a HTTP/1.1", b"Host: localhost") + fields)
+    parser = HttpParser()
+    parser.feed(message + b"\r\n\r\n")
+    read = RequestReader(None, parser=parser)
+    read.trace = RequestTrace(read.received)
+    return read
+
+def response(data):
+    """return - ResponseReader of the data read before the origin server has stopped"""
+    parser = HttpParser()
+    parser.feed(data)
+    return ResponseReader(None, parser=parser)
+
+class RequestHandlingTest(TestCase):
+
+    def setUp(self):
+        self.handling = RequestHandling()
+        self.handling._metrics = Mock()
+        self.handling._pool = None
+        self.handling._use_cache = True
+        self.handling._storage = Mock()
+        self.handling._flights = Mock()
+
+    def counted(self, counter):
+        return sum(call[0][1] if len(call[0]) > 1 else 1
+                   for call in self.handling._metrics.count.call_args_list
+                   if counter == call[0][0])
+
+    def outcome(self, data, reused=False, cached=None, stale_if_error=False):
+        return self.handling._origin_outcome(response(data), reused, cached, stale_if_error)
+
+    def test_origin_ok(self):
+        ok = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nOK"
+        self.assertEqual(self.outcome(ok), request_handling.SEND)
+        self.assertEqual(self.counted("bytes_in"), len(ok))
+        self.assertEqual(self.outcome(ok, cached=CACHED, stale_if_error=True),
+                         request_handling.SEND)
+
+    def test_origin_failed(self):
+        self.assertEqual(self.handling._origin_outcome(None, False, None, False),
+                         request_handling.BAD_GATEWAY)
+        self.assertEqual(self.handling._origin_outcome(None, False, CACHED, True),
+                         request_handling.STALE)
+        truncated = b"HTTP/1.1 200 OK\r\nContent-Length: 20\r\n\r\nOK"
+        self.assertEqual(self.outcome(truncated), request_handling.GATEWAY_TIMEOUT)
+        self.assertEqual(self.outcome(truncated, cached=CACHED, stale_if_error=True),
+                         request_handling.STALE)
+        # only a pooled connection closed with nothing sent is tried again
+        self.assertEqual(self.outcome(b"", reused=True), request_handling.RETRY)
+        self.assertEqual(self.outcome(truncated, reused=True), request_handling.GATEWAY_TIMEOUT)
+        self.assertEqual(self.outcome(b""), request_handling.GATEWAY_TIMEOUT)
+
+    def test_origin_revalidated(self):
+        not_modified = b"HTTP/1.1 304 Not Modified\r\n\r\n"
+        self.assertEqual(self.outcome(not_modified, cached=CACHED), request_handling.REVALIDATED)
+        # a client conditional request passed through
+        self.assertEqual(self.outcome(not_modified), request_handling.SEND)
+
+    def test_origin_server_error(self):
+        error = b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\n\r\n"
+        self.assertEqual(self.outcome(error, cached=CACHED, stale_if_error=True),
+                         request_handling.STALE)
+        self.assertEqual(self.outcome(error, cached=CACHED), request_handling.SEND)
+
+    def test_relay_outcome(self):
+        relay = ResponseRelay()
+        self.assertEqual(self.handling._relay_outcome(relay, 0, True), request_handling.RETRY)
+        self.assertEqual(self.handling._relay_outcome(relay, 0, False),
+                         request_handling.GATEWAY_TIMEOUT)
+        relay.feed(b"HTTP/1.1 200 OK\r\nContent-Length: 20\r\n\r\nOK")
+        self.assertEqual(self.handling._relay_outcome(relay, 40, True),
+                         request_handling.TRUNCATED)
+        self.assertEqual(self.counted("errors"), 1)
+        relay.feed(b"x" * 18)
+        self.assertEqual(self.handling._relay_outcome(relay, 58, False), request_handling.SEND)
+        self.assertEqual(self.counted("bytes_in"), 98)
+
+    def test_gateway_error(self):
+        first, second = request(), request()
+        self.assertEqual(self.handling._gateway_error(first, request_handling.BAD_GATEWAY),
+                         Response.RESPONSE_502)
+        self.assertEqual(first.trace.status, Const.HTTP_BAD_GATEWAY)
+        self.assertEqual(self.handling._gateway_error(second, request_handling.GATEWAY_TIMEOUT),
+                         Response.RESPONSE_504)
+        self.assertEqual(second.trace.status, Const.HTTP_GATEWAY_TIMEOUT)
+        self.assertEqual(self.counted("errors"), 2)
+
+    def test_revalidation(self):
+        message = request().message
+        conditional, stale_if_error = self.handling._revalidation(message, CACHED,
+                                                                  CachePolicy.STALE)
+        self.assertIn(b"If-None-Match: \"v1\"", conditional)
+        self.assertFalse(stale_if_error)
+        # gone meanwhile
+        self.assertIsNone(self.handling._revalidation(message, None, CachePolicy.STALE))
+        # no validators, it can be served on errors still
+        unvalidated = b"Content-Length: 5\r\n\r\nHello"
+        self.assertIsNone(self.handling._revalidation(message, unvalidated, CachePolicy.STALE))
+        self.assertEqual(self.handling._revalidation(message, unvalidated,
+                                                     CachePolicy.STALE_IF_ERROR),
+                         (message, True))
+
+    def test_cached_response(self):
+        plain = request()
+        self.assertEqual(self.handling._cached_response(plain, CACHED),
+                         Response.STATUS_200 + CACHED)
+        self.assertEqual(plain.trace.status, Const.HTTP_OK)
+        conditional = request(b"If-None-Match: \"v1\"")
+        self.assertTrue(self.handling._cached_response(conditional, CACHED).startswith(
+            b"HTTP/1.1 304 Not Modified"))
+        self.assertEqual(conditional.trace.status, Const.HTTP_NOT_MODIFIED)
+        self.assertEqual(self.handling._cached_response(request(b"If-None-Match: \"v2\""),
+                                                        CACHED),
+                         Response.STATUS_200 + CACHED)
+
+    def test_needs_flight(self):
+        for state in (CachePolicy.MISS, CachePolicy.STALE, CachePolicy.STALE_IF_ERROR):
+            self.assertTrue(self.handling._needs_flight(state, None))
+            # led since the fetch ahead
+            self.assertFalse(self.handling._needs_flight(state, Mock()))
+        for state in (CachePolicy.FRESH, CachePolicy.STALE_REVALIDATE):
+            self.assertFalse(self.handling._needs_flight(state, None))
+        self.handling._flights = None
+        self.assertFalse(self.handling._needs_flight(CachePolicy.MISS, None))
+
+    def test_lead_flight(self):
+        flight = Mock()
+        self.assertIs(self.handling._lead_flight(flight, CachePolicy.MISS), flight)
+        flight.release.assert_not_called()
+        # the previous leader has just landed
+        self.assertIsNone(self.handling._lead_flight(flight, CachePolicy.FRESH))
+        flight.release.assert_called_once_with()
+
+    def test_cache_sent(self):
+        hit = request()
+        self.assertTrue(self.handling._cache_sent(hit, True, "C", "Sent from cache"))
+        self.assertEqual(hit.trace.outcome, "hit")
+        self.assertFalse(self.handling._cache_sent(request(), False, "C", "Sent from cache"))
+        self.assertEqual((self.counted("hits"), self.counted("errors")), (1, 1))
+
+    def test_origin_sent(self):
+        miss = request()
+        self.assertTrue(self.handling._origin_sent(miss, True, Const.HTTP_OK, 10))
+        self.assertEqual((miss.trace.status, miss.trace.sent, miss.trace.outcome),
+                         (Const.HTTP_OK, 10, "miss"))
+        self.assertFalse(self.handling._origin_sent(request(), False, Const.HTTP_OK, 10))
+        self.assertEqual((self.counted("misses"), self.counted("bytes_out"),
+                          self.counted("errors")), (1, 10, 1))
+
+    def test_cacheable(self):
+        self.assertTrue(self.handling._cacheable(Const.HTTP_OK))
+        self.assertFalse(self.handling._cacheable(404))
+        self.handling._use_cache = False
+        self.assertFalse(self.handling._cacheable(Const.HTTP_OK))
+
+    def test_pipelined(self):
+        first = request()
+        ahead = (b"GET http://localhost/a HTTP/1.1\r\nHost: localhost\r\n\r\n"
+                 b"CONNECT localhost:443 HTTP/1.1\r\nHost: localhost\r\n\r\n"
+                 b"GET http://localhost/b HTTP/1.1\r\nHost: localhost\r\n\r\n"
+                 b"GET http://localhost/c HTTP/1.1\r\n")
+        first.tail = ahead[:60]
+        client_sock, client = socket.socketpair()
+        self.addCleanup(client_sock.close)
+        self.addCleanup(client.close)
+        client.sendall(ahead[60:])
+        # only the complete GET requests of other resources
+        self.assertEqual([read.cache_location
+                          for read in self.handling._pipelined(client_sock, first)],
+                         [b"localhost/b"])
+        self.assertEqual(first.tail, ahead)
@@ -0,0 +1,105 @@
+"""
+Updated: 2017
+Author: Sergei Shliakhtin
+Contact: xxx.serj@gmail.com
+Parser: Python 3
+Notes: Resolver unit tests, the system resolver isn't queried
+
+To be run from the same directory where proxy.py resides!
+"""
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from proxy.const import Const
+from proxy.metrics import MetricsRegion
+from proxy.resolver import Resolver
+
+def config_value(enable_cache):
+    """return - Config.value stand-in with the [Resolver] settings"""
+    values = {"enable_cache": enable_cache, "positive_ttl": "300", "negative_ttl": "30",
+              "hosts": "static.test=10.0.0.1, other.test = 10.0.0.3"}
+    def value(section, key):
+        assert Const.RESOLVER_SECTION == section
+        return values[key]
+    return value
+
+class ResolverTest(TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        clock = patch("proxy.resolver.time.time", side_effect=lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+        self.resolver = Resolver(10, 2, hosts={"static.test": "10.0.0.1"})
+
+    def test_static_table(self):
+        self.now += 1000000
+        self.assertEqual(self.resolver.cached("static.test"), (True, "10.0.0.1"))
+        self.assertEqual(self.resolver.cached("127.0.0.1"), (True, "127.0.0.1"))
+        self.assertEqual(self.resolver.hits + self.resolver.misses, 0)
+
+    def test_positive_ttl(self):
+        self.assertEqual(self.resolver.cached("origin.test"), (False, None))
+        self.resolver.store("origin.test", "10.0.0.2")
+        self.now += 9
+        self.assertEqual(self.resolver.cached("origin.test"), (True, "10.0.0.2"))
+        self.now += 2
+        self.assertEqual(self.resolver.cached("origin.test"), (False, None))
+
+    def test_negative_ttl(self):
+        self.resolver.store("nowhere.test", None)
+        self.assertEqual(self.resolver.failures, 1)
+        self.assertEqual(self.resolver.cached("nowhere.test"), (True, None))
+        self.now += 3
+        self.assertEqual(self.resolver.cached("nowhere.test"), (False, None))
+
+    def test_cache_disabled(self):
+        resolver = Resolver(0, 2)
+        resolver.store("origin.test", "10.0.0.2")
+        self.assertEqual(resolver.cached("origin.test"), (False, None))
+
+    def test_from_config(self):
+        with patch("proxy.resolver.Config.value", side_effect=config_value("True")):
+            resolver = Resolver.from_config()
+        self.assertEqual(resolver.cached("other.test"), (True, "10.0.0.3"))
+        resolver.store("origin.test", "10.0.0.2")
+        resolver.store("nowhere.test", None)
+        self.now += 299
+        self.assertEqual(resolver.cached("origin.test"), (True, "10.0.0.2"))
+        self.now -= 299 - 29
+        self.assertEqual(resolver.cached("nowhere.test"), (True, None))
+
+    def test_from_config_disabled(self):
+        with patch("proxy.resolver.Config.value", side_effect=config_value("False")):
+            resolver = Resolver.from_config()
+        self.assertEqual(resolver.cached("static.test"), (True, "10.0.0.1"))
+        resolver.store("origin.test", "10.0.0.2")
+        # a failure isn't kept either, the next lookup asks the system resolver again
+        resolver.store("nowhere.test", None)
+        self.assertEqual(resolver.failures, 1)
+        self.assertEqual(resolver.cached("origin.test"), (False, None))
+        self.assertEqual(resolver.cached("nowhere.test"), (False, None))
+
+    def test_hit_rate(self):
+        self.assertEqual(self.resolver.hit_rate, 0.0)
+        self.resolver.cached("origin.test")
+        self.resolver.store("origin.test", "10.0.0.2")
+        for _ in range(3):
+            self.resolver.cached("origin.test")
+        self.assertEqual((self.resolver.hits, self.resolver.misses), (3, 1))
+        self.assertEqual(self.resolver.hit_rate, 0.75)
+        self.assertIn("hit rate:0.75", self.resolver.summary())
+
+    def test_publish(self):
+        region = MetricsRegion(1)
+        metrics = region.allocate()
+        self.resolver.cached("origin.test")
+        self.resolver.store("origin.test", None)
+        self.resolver.publish(metrics)
+        self.resolver.cached("origin.test")
+        self.resolver.publish(metrics)
+        self.resolver.publish(metrics)
+        self.assertEqual(region.total("dns_hits"), 1)
+        self.assertEqual(region.total("dns_misses"), 1)
+        self.assertEqual(region.total("dns_failures"), 1)
@@ -0,0 +1,111 @@
+"""
+Updated: 2017
+Author: Sergei Shliakhtin
+Contact: xxx.serj@gmail.com
+Parser: Python 3
+Notes: Write-behind unit tests: a worker and a writer on a temporary FS storage, cache index
+    and lock dir, the queue is in memory
+
+To be run from the same directory where proxy.py resides!
+"""
+
+import os
+import queue
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from proxy.cache_index import CacheIndex, IndexedStorage
+from proxy.collapsed_forwarding import FlightRegistry
+from proxy.fs_storage import FSStorage, HASHED_LAYOUT
+from proxy.metrics import MetricsRegion
+from proxy.write_behind import CacheWriter, WriteBehindStorage
+
+class WriteQueue(queue.Queue):
+    """multiprocessing.Queue stand-in"""
+
+    def cancel_join_thread(self):
+        pass
+
+class WriteBehindTest(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        backend = FSStorage(os.path.join(self.tmp_dir.name, "cache"), HASHED_LAYOUT)
+        index_path = os.path.join(self.tmp_dir.name, "index")
+        CacheIndex.create(index_path, 64)
+        self.index = CacheIndex(index_path)
+        lock_dir = os.path.join(self.tmp_dir.name, "flights")
+        os.mkdir(lock_dir)
+        self.flights = FlightRegistry(lock_dir, 0.05, 0.01)
+        self.queue = WriteQueue(2)
+        self.region = MetricsRegion(1)
+        self.storage = WriteBehindStorage(IndexedStorage(backend, self.index), self.queue,
+                                          self.region.allocate(), 16, self.flights)
+        for target, value in (("proxy.storage.get_backend_storage", backend),
+                              ("proxy.write_behind.CacheIndex.from_config", self.index),
+                              ("proxy.write_behind.FlightRegistry.from_config", self.flights),
+                              ("proxy.write_behind.log_basic_config", None),
+                              ("proxy.write_behind.proc_state", None)):
+            patcher = patch(target, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.writer = CacheWriter()
+        self.writer._init_this_process()
+
+    def write_queued(self):
+        """The writer saves what has been queued"""
+        batch = []
+        while not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        self.writer._save(batch)
+
+    def test_indexed_once_written(self):
+        self.assertTrue(self.storage.save(b"localhost/a", b"data"))
+        # not cached for the lookups until the writer has saved it
+        self.assertIsNone(self.storage.cached_times(b"localhost/a"))
+        self.write_queued()
+        self.assertIsNotNone(self.storage.cached_times(b"localhost/a"))
+        self.assertEqual(self.storage.fetch(b"localhost/a"), b"data")
+
+    def test_followers_wait_for_writer(self):
+        leader = self.flights.join(b"localhost/a")
+        follower = self.flights.join(b"localhost/a")
+        self.storage.save(b"localhost/a", b"data")
+        leader.release()
+        self.assertFalse(follower.landed())
+        # joins the fetch handed over to the writer
+        late = self.flights.join(b"localhost/a")
+        self.assertFalse(late.leader)
+        self.write_queued()
+        self.assertTrue(follower.landed())
+        self.assertTrue(late.landed())
+        # found by the followers, the next miss leads a new fetch
+        self.assertEqual(self.storage.fetch(b"localhost/a"), b"data")
+        flight = self.flights.join(b"localhost/a")
+        self.assertTrue(flight.leader)
+        flight.release()
+
+    def test_large_written_by_worker(self):
+        leader = self.flights.join(b"localhost/a")
+        follower = self.flights.join(b"localhost/a")
+        writer = self.storage.writer(b"localhost/a")
+        writer.write(b"0123456789")
+        writer.write(b"0123456789")
+        self.assertTrue(writer.commit())
+        self.assertTrue(self.queue.empty())
+        self.assertIsNotNone(self.storage.cached_times(b"localhost/a"))
+        leader.release()
+        self.assertTrue(follower.landed())
+
+    def test_full_queue(self):
+        for key_path in (b"localhost/a", b"localhost/b"):
+            self.storage.save(key_path, b"data")
+        leader = self.flights.join(b"localhost/c")
+        follower = self.flights.join(b"localhost/c")
+        self.assertFalse(self.storage.save(b"localhost/c", b"data"))
+        self.assertEqual(self.region.total("dropped_writes"), 1)
+        # not handed over, the followers go on at once
+        leader.release()
+        self.assertTrue(follower.landed())